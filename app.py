@@ -1,19 +1,39 @@
-from ast import Str
 import os
-from unittest.util import strclass
-from flask import Flask, request, jsonify, abort
-from sqlalchemy import exc
+import hmac
+from datetime import timezone
+from flask import Flask, Response, request, jsonify, abort, stream_with_context
+from sqlalchemy import and_, exc, select
+from sqlalchemy.orm import selectinload
 import json
 from flask_cors import CORS
 
 from auth import AuthError, requires_auth
-from models import setup_db, Actor, Movie
+from idempotency import idempotent
+from ratelimit import RateLimitError
+from models import (setup_db, db, serialize_row, get_version, bulk_insert,
+                    bulk_update, bulk_delete, validate_fields, link_actors,
+                    unlink_actors, movie_actors, parse_date, Actor, Movie)
+from cache import response_cache
+from metrics import registry
+from search import parse_search_args, search_statement
+from timing import phase, setup_timing
+from encoding import json_response, setup_compression
+from queries import (parse_page_args, parse_fields, parse_include, parse_filters,
+                     parse_filter_value, parse_shape, page_items, select_fields, keyset_page,
+                     export_query, export_rows, collection_etag)
+
+# upper bound of the items of one bulk request
+BULK_MAX_ITEMS = int(os.environ.get('BULK_MAX_ITEMS', 5000))
+# bearer token of GET /metrics, the endpoint is off (404) while unset
+METRICS_TOKEN = os.environ.get('METRICS_TOKEN')
 
 def create_app(test_config=None):
   
     # initiate app and database
     app = Flask(__name__)
     setup_db(app)
+    setup_timing(app)
+    setup_compression(app)
     CORS(app)
 
     @app.route('/')
@@ -27,34 +47,340 @@ def create_app(test_config=None):
       return greeting
 
     '''
-    Endpoint to get all actors in database
-        roles with permission: Casting Assistant, Casting Director, Executive Producer
+    Endpoint to get the metrics of this worker in the Prometheus text format
+    it should be off unless METRICS_TOKEN is set
+    it should raise an AuthError if the request does not send the token
+        as its bearer token
     '''
-    @app.route('/actors', methods=['GET'])
-    @requires_auth('get:actors')
-    def get_actors(payload):
+    @app.route('/metrics')
+    def get_metrics():
+        if not METRICS_TOKEN:
+            abort(404)
+        sent = request.headers.get('Authorization', '').encode('latin-1')
+        if not hmac.compare_digest(sent, ('Bearer ' + METRICS_TOKEN).encode()):
+            raise AuthError({
+                'code': 'invalid_metrics_token',
+                'description': 'The metrics token is missing or invalid.'
+            }, 401)
+        return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+    '''
+    return the validators of the current request for the rows of the
+    given tables: their combined version, a weak ETag built from it and
+    the query string, and the Last-Modified time of the tables
+    '''
+    def collection_validators(table_names):
+        versions = [get_version(table_name) for table_name in table_names]
+        version = '.'.join(str(table_version) for table_version, _ in versions)
+        etag = collection_etag(table_names, version, request.query_string.decode())
+
+        updated_at = max((table_updated_at for _, table_updated_at in versions
+                          if table_updated_at is not None), default=None)
+        if updated_at is not None:
+            updated_at = updated_at.replace(microsecond=0, tzinfo=timezone.utc)
+        return version, etag, updated_at
+
+    '''
+    return true if the client copy matching If-None-Match or
+    If-Modified-Since is still current
+    '''
+    def is_not_modified(etag, updated_at):
+        if request.if_none_match:
+            return request.if_none_match.contains_weak(etag)
+        if request.if_modified_since and updated_at is not None:
+            return updated_at <= request.if_modified_since
+        return False
+
+    '''
+    return the relationship of model embedded by ?include=, and the
+    model on its other side
+    '''
+    def included_relationship(model, include):
+        relationship = getattr(model, model.INCLUDES[include])
+        return relationship, relationship.property.mapper.class_
+
+    '''
+    fetch a page of model rows matching the filter conditions
+    without ?include= only the requested columns are selected as plain
+    tuples, with it the page is loaded as model instances and the related
+    rows of the whole page are loaded with one more query (selectinload)
+    return (the serialized rows, next_cursor)
+    '''
+    def fetch_page(model, fields, include, conditions, after, limit, shape='objects'):
+        if include is None:
+            statement = select_fields(model, fields).where(*conditions)
+            rows, next_cursor = keyset_page(
+                db.session, statement, model.id, after, limit)
+            with phase('serialize'):
+                return page_items(fields, rows, shape), next_cursor
+
+        relationship, _ = included_relationship(model, include)
+        statement = (select(model).where(*conditions)
+                     .options(selectinload(relationship)))
+        rows, next_cursor = keyset_page(
+            db.session, statement, model.id, after, limit, scalars=True)
+        with phase('serialize'):
+            # the related rows are one more column of each row
+            rows = [tuple(getattr(row, name) for name in fields) +
+                    ([related.format() for related in getattr(row, relationship.key)],)
+                    for row in rows]
+            return page_items(fields + (include,), rows, shape), next_cursor
+
+    '''
+    respond with the json body returned by render(), a dict, for a read
+    of the given tables
+    unchanged tables are answered with 304 without reading any rows,
+    bodies already rendered for the current table versions are served
+    from the response cache
+    '''
+    def cached_response(table_names, render):
+        version, etag, updated_at = collection_validators(table_names)
+        if is_not_modified(etag, updated_at):
+            response = Response(status=304)
+        else:
+            body = response_cache.get(table_names[0], version, request)
+            if body is not None:
+                response = Response(body, mimetype='application/json')
+            else:
+                try:
+                    body = render()
+                    with phase('serialize'):
+                        response = json_response(body)
+                except:
+                    abort(422)
+                response_cache.set(table_names[0], version, request, response.get_data())
+
+        response.set_etag(etag, weak=True)
+        if updated_at is not None:
+            response.last_modified = updated_at
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+
+    '''
+    respond with a page of model rows, selecting only the columns
+    requested with ?fields= as plain tuples
+    '''
+    def list_response(model, key):
         try:
-            return jsonify({
+            limit, after = parse_page_args(request.args)
+            fields = parse_fields(request.args, model)
+            include = parse_include(request.args, model)
+            conditions = parse_filters(request.args, model)
+            shape = parse_shape(request.args)
+        except ValueError:
+            abort(400)
+
+        table_names = [model.__tablename__]
+        if include is not None:
+            table_names.append(included_relationship(model, include)[1].__tablename__)
+
+        def render():
+            items, next_cursor = fetch_page(
+                model, fields, include, conditions, after, limit, shape)
+            return {
                 'success': True,
-                'actors': [actor.format() for actor in Actor.query.all()]
-            }), 200
+                key: items,
+                'next_cursor': next_cursor
+            }
+        return cached_response(table_names, render)
+
+    '''
+    respond with a page of the rows of model related to the row id of
+    parent through the movie_actors association
+    '''
+    def related_response(parent, id, model, key):
+        if db.session.get(parent, id) is None:
+            abort(404)
+        try:
+            limit, after = parse_page_args(request.args)
+            fields = parse_fields(request.args, model)
+        except ValueError:
+            abort(400)
+
+        own_column = movie_actors.c.movie_id if parent is Movie else movie_actors.c.actor_id
+        other_column = movie_actors.c.actor_id if parent is Movie else movie_actors.c.movie_id
+        statement = (select_fields(model, fields)
+                     .join(movie_actors, other_column == model.id)
+                     .where(own_column == id))
+        try:
+            rows, next_cursor = keyset_page(db.session, statement, model.id, after, limit)
+            with phase('serialize'):
+                return json_response({
+                    'success': True,
+                    key: page_items(fields, rows),
+                    'next_cursor': next_cursor
+                })
         except:
             abort(422)
 
     '''
-    Endpoint to get all actors in database
+    stream a full-table export of model as json or, with ?format=ndjson,
+    as newline delimited json, narrowed by the same filters as the list
+    '''
+    def export_response(model, key):
+        export_format = request.args.get('format', 'json')
+        if export_format not in ('json', 'ndjson'):
+            abort(400)
+        try:
+            fields = parse_fields(request.args, model)
+            conditions = parse_filters(request.args, model)
+        except ValueError:
+            abort(400)
+
+        ndjson = export_format == 'ndjson'
+        statement = select_fields(model, fields).where(*conditions)
+        rows = export_query(db.session, statement, model.id)
+        return Response(
+            stream_with_context(export_rows(rows, key, fields, ndjson)),
+            mimetype='application/x-ndjson' if ndjson else 'application/json')
+
+    '''
+    Endpoint to get a page of actors in database
+        query parameters: limit (page size), after (cursor of the previous page),
+            fields (comma separated columns, i.e. id,name),
+            include (movies, to embed the movies of each actor),
+            name_prefix, name_contains, age_min, age_max, gender (filters)
+        roles with permission: Casting Assistant, Casting Director, Executive Producer
+    '''
+    @app.route('/actors', methods=['GET'])
+    @requires_auth('get:actors')
+    def get_actors(payload):
+        return list_response(Actor, 'actors')
+
+    '''
+    Endpoint to get a page of movies in database
+        query parameters: limit (page size), after (cursor of the previous page),
+            fields (comma separated columns, i.e. id,title),
+            include (cast, to embed the actors of each movie),
+            title_prefix, title_contains, release_from, release_to (filters)
         roles with permission: Casting Assistant, Casting Director, Executive Producer
     '''
     @app.route('/movies', methods=['GET'])
     @requires_auth('get:movies')
     def get_movies(payload):
+        return list_response(Movie, 'movies')
+
+    '''
+    Endpoint to export all actors in database
+        query parameters: format (json or ndjson), fields, the filters of /actors
+        roles with permission: Casting Assistant, Casting Director, Executive Producer
+    '''
+    @app.route('/actors/export', methods=['GET'])
+    @requires_auth('get:actors')
+    def export_actors(payload):
+        return export_response(Actor, 'actors')
+
+    '''
+    Endpoint to export all movies in database
+        query parameters: format (json or ndjson), fields, the filters of /movies
+        roles with permission: Casting Assistant, Casting Director, Executive Producer
+    '''
+    @app.route('/movies/export', methods=['GET'])
+    @requires_auth('get:movies')
+    def export_movies(payload):
+        return export_response(Movie, 'movies')
+
+    '''
+    Endpoint to search actors by name and movies by title, for typeahead
+        query parameters: q (the words to search, the last one may be
+            partially typed), limit (results per kind)
+        roles with permission: Casting Assistant, Casting Director, Executive Producer
+    '''
+    @app.route('/search', methods=['GET'])
+    @requires_auth('get:actors', 'get:movies')
+    def search(payload):
         try:
-            return jsonify({
-                'success': True,
-                'movies': [movie.format() for movie in Movie.query.all()]
-            }), 200
+            terms, limit = parse_search_args(request.args)
+        except ValueError:
+            abort(400)
+
+        dialect = db.engine.dialect.name
+        def render():
+            result = {'success': True}
+            for model, key in ((Actor, 'actors'), (Movie, 'movies')):
+                rows = db.session.execute(
+                    search_statement(dialect, model, terms, limit)).all()
+                with phase('serialize'):
+                    result[key] = [serialize_row(model.FIELDS, row) for row in rows]
+            return result
+        return cached_response(['actors', 'movies'], render)
+
+    '''
+    Endpoint to get the cast of a movie
+        query parameters: limit, after, fields
+        roles with permission: Casting Assistant, Casting Director, Executive Producer
+    '''
+    @app.route('/movies/<int:id>/actors', methods=['GET'])
+    @requires_auth('get:movies', 'get:actors')
+    def get_movie_actors(payload, id):
+        return related_response(Movie, id, Actor, 'actors')
+
+    '''
+    Endpoint to get the movies an actor is cast in
+        query parameters: limit, after, fields
+        roles with permission: Casting Assistant, Casting Director, Executive Producer
+    '''
+    @app.route('/actors/<int:id>/movies', methods=['GET'])
+    @requires_auth('get:actors', 'get:movies')
+    def get_actor_movies(payload, id):
+        return related_response(Actor, id, Movie, 'movies')
+
+    '''
+    read the "actor_ids" list of a cast request body
+    '''
+    def cast_actor_ids():
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict):
+            abort(400)
+        actor_ids = body.get('actor_ids')
+        if (not isinstance(actor_ids, list) or not actor_ids
+                or any(isinstance(id, bool) or not isinstance(id, int) for id in actor_ids)):
+            abort(400)
+        if len(actor_ids) > BULK_MAX_ITEMS:
+            abort(413)
+        return actor_ids
+
+    '''
+    Endpoint to add actors to the cast of a movie
+        request body: {"actor_ids": [...]}
+        roles with permission: Casting Director, Executive Producer
+    '''
+    @app.route('/movies/<int:id>/actors', methods=['POST'])
+    @requires_auth('patch:movies')
+    @idempotent
+    def add_movie_actors(payload, id):
+        actor_ids = cast_actor_ids()
+        if db.session.get(Movie, id) is None:
+            abort(404)
+        try:
+            linked, missing = link_actors(id, actor_ids)
         except:
             abort(422)
+        return jsonify({
+            'success': True,
+            'actors': linked,
+            'missing': missing
+        }), 200
+
+    '''
+    Endpoint to remove actors from the cast of a movie
+        request body: {"actor_ids": [...]}
+        roles with permission: Casting Director, Executive Producer
+    '''
+    @app.route('/movies/<int:id>/actors', methods=['DELETE'])
+    @requires_auth('patch:movies')
+    def remove_movie_actors(payload, id):
+        actor_ids = cast_actor_ids()
+        if db.session.get(Movie, id) is None:
+            abort(404)
+        try:
+            removed = unlink_actors(id, actor_ids)
+        except:
+            abort(422)
+        return jsonify({
+            'success': True,
+            'removed': removed
+        }), 200
 
     '''
     Endpoint to delete an actor with a specified id in database
@@ -106,6 +432,7 @@ def create_app(test_config=None):
     '''
     @app.route('/actors', methods=['POST'])
     @requires_auth('post:actors')
+    @idempotent
     def add_actor(payload):
         # get the body from request
         body = request.get_json()
@@ -131,6 +458,7 @@ def create_app(test_config=None):
     '''
     @app.route('/movies', methods=['POST'])
     @requires_auth('post:movies')
+    @idempotent
     def add_movie(payload):
         # get the body from request
         body = request.get_json()
@@ -142,6 +470,7 @@ def create_app(test_config=None):
           abort(422)
 
         try:
+            release_date = parse_date(release_date)
             movie = Movie(title = title, release_date = release_date)
             movie.insert()
             return jsonify({
@@ -151,12 +480,191 @@ def create_app(test_config=None):
         except:
             abort(422)
 
+    '''
+    validate every item of a bulk create request up front and insert them
+    all in a single transaction, or none of them if any item is invalid
+    '''
+    def bulk_create_response(model):
+        items = request.get_json(silent=True)
+        if not isinstance(items, list) or not items:
+            abort(400)
+        if len(items) > BULK_MAX_ITEMS:
+            abort(413)
+
+        rows = []
+        errors = []
+        for index, item in enumerate(items):
+            values, item_errors = validate_fields(item, model.SPEC)
+            if item_errors:
+                errors.append({'index': index, 'errors': item_errors})
+            rows.append(values)
+
+        if errors:
+            return jsonify({
+                'success': False,
+                'error': 422,
+                'message': 'Unprocessable recource',
+                'errors': errors
+            }), 422
+
+        try:
+            bulk_insert(model, rows)
+        except:
+            abort(422)
+        return jsonify({
+            'success': True,
+            'created': len(rows)
+        }), 200
+
+    '''
+    Endpoint to post many actors into database in one transaction
+        request body: a json array of actors
+        roles with permission: Casting Director, Executive Producer
+    '''
+    @app.route('/actors/bulk', methods=['POST'])
+    @requires_auth('post:actors')
+    @idempotent
+    def add_actors(payload):
+        return bulk_create_response(Actor)
+
+    '''
+    Endpoint to post many movies into database in one transaction
+        request body: a json array of movies
+        roles with permission: Executive Producer
+    '''
+    @app.route('/movies/bulk', methods=['POST'])
+    @requires_auth('post:movies')
+    @idempotent
+    def add_movies(payload):
+        return bulk_create_response(Movie)
+
+    '''
+    read the rows a bulk PATCH or DELETE applies to from the request body:
+    either "ids", a list of ids, or "filter", an object of column values
+    return (condition, ids), condition as bulk_update() takes it: the
+    list of ids, or a where clause with ids None for a filter
+    '''
+    def bulk_condition(model, body):
+        columns = model.__table__.c
+        if 'ids' in body:
+            ids = body['ids']
+            if (not isinstance(ids, list) or not ids
+                    or any(isinstance(id, bool) or not isinstance(id, int) for id in ids)):
+                abort(400)
+            if len(ids) > BULK_MAX_ITEMS:
+                abort(413)
+            return ids, ids
+
+        predicate = body.get('filter')
+        if not isinstance(predicate, dict) or not predicate:
+            abort(400)
+        if any(name not in model.FIELDS for name in predicate):
+            abort(400)
+        conditions = []
+        for name, value in predicate.items():
+            if value is not None:
+                try:
+                    value = parse_filter_value(columns[name], value, name)
+                except ValueError:
+                    abort(400)
+            conditions.append(columns[name] == value)
+        return and_(*conditions), None
+
+    '''
+    report the matched rows of a bulk request, and the requested ids
+    that did not match any row
+    '''
+    def bulk_result(matched, ids):
+        result = {
+            'success': True,
+            'matched': sorted(matched)
+        }
+        if ids is not None:
+            result['missing'] = sorted(set(ids).difference(matched))
+        return jsonify(result), 200
+
+    '''
+    apply the same changes to many rows with a single UPDATE statement
+    '''
+    def bulk_edit_response(model):
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict):
+            abort(400)
+        condition, ids = bulk_condition(model, body)
+        changes, errors = validate_fields(body.get('changes'), model.SPEC, partial=True)
+        if errors or not changes:
+            abort(422)
+
+        try:
+            matched = bulk_update(model, condition, changes)
+        except:
+            abort(422)
+        return bulk_result(matched, ids)
+
+    '''
+    delete many rows with a single DELETE statement
+    '''
+    def bulk_delete_response(model):
+        body = request.get_json(silent=True)
+        if not isinstance(body, dict):
+            abort(400)
+        condition, ids = bulk_condition(model, body)
+
+        try:
+            matched = bulk_delete(model, condition)
+        except:
+            abort(422)
+        return bulk_result(matched, ids)
+
+    '''
+    Endpoint to modify many actors in database in one statement
+        request body: {"ids": [...]} or {"filter": {...}}, and {"changes": {...}}
+        roles with permission: Casting Director, Executive Producer
+    '''
+    @app.route('/actors/bulk', methods=['PATCH'])
+    @requires_auth('patch:actors')
+    @idempotent
+    def edit_actors(payload):
+        return bulk_edit_response(Actor)
+
+    '''
+    Endpoint to modify many movies in database in one statement
+        request body: {"ids": [...]} or {"filter": {...}}, and {"changes": {...}}
+        roles with permission: Casting Director, Executive Producer
+    '''
+    @app.route('/movies/bulk', methods=['PATCH'])
+    @requires_auth('patch:movies')
+    @idempotent
+    def edit_movies(payload):
+        return bulk_edit_response(Movie)
+
+    '''
+    Endpoint to delete many actors in database in one statement
+        request body: {"ids": [...]} or {"filter": {...}}
+        roles with permission: Casting Director, Executive Producer
+    '''
+    @app.route('/actors/bulk', methods=['DELETE'])
+    @requires_auth('delete:actors')
+    def delete_actors(payload):
+        return bulk_delete_response(Actor)
+
+    '''
+    Endpoint to delete many movies in database in one statement
+        request body: {"ids": [...]} or {"filter": {...}}
+        roles with permission: Executive Producer
+    '''
+    @app.route('/movies/bulk', methods=['DELETE'])
+    @requires_auth('delete:movies')
+    def delete_movies(payload):
+        return bulk_delete_response(Movie)
+
     '''
     Endpoint to modify an existing actor with specified id in database
         roles with permission: Casting Director, Executive Producer
     '''
     @app.route('/actors/<id>', methods=['PATCH'])
     @requires_auth('patch:actors')
+    @idempotent
     def edit_actor(payload, id):
         actor = Actor.query.filter_by(id=id).one_or_none()
         # if the actor is not found, rise 404 erro
@@ -192,6 +700,7 @@ def create_app(test_config=None):
     '''
     @app.route('/movies/<id>', methods=['PATCH'])
     @requires_auth('patch:movies')
+    @idempotent
     def edit_movie(payload, id):
         movie = Movie.query.filter_by(id=id).one_or_none()
         # if the movie is not found, rise 404 erro
@@ -208,7 +717,7 @@ def create_app(test_config=None):
             if newTitle is not None:
                 movie.title = newTitle
             if newReleaseDate is not None:
-                movie.release_date = newReleaseDate
+                movie.release_date = parse_date(newReleaseDate)
             movie.update()
             return jsonify({
                 'success': True,
@@ -244,6 +753,14 @@ def create_app(test_config=None):
           "message": "Unprocessable recource"
       }), 422
     
+    @app.errorhandler(413)
+    def payload_too_large(error):
+      return jsonify({
+          "success": False,
+          'error': 413,
+          "message": "Payload too large"
+      }), 413
+
     @app.errorhandler(405)
     def invalid_method(error):
       return jsonify({
@@ -252,11 +769,26 @@ def create_app(test_config=None):
           "message": "Invalid method"
       }), 405
 
+    @app.errorhandler(409)
+    def conflict(error):
+      return jsonify({
+          "success": False,
+          'error': 409,
+          "message": "Conflict"
+      }), 409
+
     @app.errorhandler(AuthError)
     def handle_auth_error(error):
         response = jsonify(error.error)
         response.status_code = error.status_code
         return response
+
+    @app.errorhandler(RateLimitError)
+    def handle_rate_limit_error(error):
+        response = jsonify(error.error)
+        response.status_code = error.status_code
+        response.headers['Retry-After'] = str(error.retry_after)
+        return response
     
     
     return app
@@ -0,0 +1,372 @@
+'''
+ASGI entry point of the API, next to the WSGI one in app.py
+    uvicorn asgi:app
+    gunicorn asgi:app -k uvicorn.workers.UvicornWorker
+
+Flask 1.1 has no async views, so the routes of create_app() are split:
+- GET /actors and GET /movies, the hot read paths, are served natively
+  on the event loop: the page is read through the SQLAlchemy asyncio
+  engine and a token missing from the token cache is verified (JWKS
+  fetch included) in a worker thread, so slow I/O never blocks the loop
+- every other request, and any list request the native path does not
+  answer with a page, a 304, a 422 or a 429 (?include=, invalid arguments,
+  failed authentication), is handed to the WSGI app, run in the thread
+  pool of the event loop, so the responses of both modes stay the same
+
+needs the packages of requirements-asgi.txt
+'''
+import asyncio
+from datetime import timezone
+from types import SimpleNamespace
+from urllib.parse import parse_qsl
+
+try:
+    from asgiref.sync import sync_to_async
+    from asgiref.wsgi import WsgiToAsgi, WsgiToAsgiInstance
+    from sqlalchemy.ext.asyncio import create_async_engine
+except ImportError as error:
+    raise ImportError('the ASGI mode needs the packages of requirements-asgi.txt, '
+                      'pip install -r requirements-asgi.txt') from error
+from flask import jsonify
+from sqlalchemy import select
+from werkzeug.datastructures import MultiDict
+from werkzeug.exceptions import UnprocessableEntity
+from werkzeug.http import http_date, parse_date, parse_etags
+
+import auth
+from app import app as wsgi_app
+from cache import response_cache
+from encoding import dumps, encode_body
+from models import (db, TableVersion, Actor, Movie,
+                    DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE,
+                    DB_POOL_PRE_PING, DB_STATEMENT_TIMEOUT)
+from queries import (parse_page_args, parse_fields, parse_filters, parse_shape,
+                     page_items, select_fields, keyset_statement, keyset_rows,
+                     collection_etag)
+from ratelimit import RateLimitError
+from replicas import replica_router
+from timing import RequestTimer, finish_timer, native_timer, phase
+
+# the asyncio driver used for each database of DATABASE_URL
+ASYNC_DRIVERS = {
+    'sqlite': 'sqlite+aiosqlite',
+    'postgresql': 'postgresql+asyncpg'
+}
+
+'''
+async_engine_options(database_path)
+    return (url, options) of the asyncio engine for the database of
+    DATABASE_URL, sized like the engine of the WSGI app
+'''
+def async_engine_options(database_path):
+    scheme, rest = database_path.split(':', 1)
+    dialect = scheme.split('+')[0]
+    url = ASYNC_DRIVERS.get(dialect, scheme) + ':' + rest
+
+    options = {'pool_pre_ping': DB_POOL_PRE_PING, 'pool_recycle': DB_POOL_RECYCLE}
+    if dialect != 'sqlite':
+        options.update(pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW,
+                       pool_timeout=DB_POOL_TIMEOUT)
+    if dialect == 'postgresql' and DB_STATEMENT_TIMEOUT:
+        options['connect_args'] = {
+            'server_settings': {'statement_timeout': str(DB_STATEMENT_TIMEOUT)}
+        }
+    return url, options
+
+
+'''
+ThreadPoolWsgiInstance, ThreadPoolWsgiToAsgi
+    WsgiToAsgi running each WSGI request in the thread pool of the event
+    loop: asgiref runs them in thread-sensitive mode, i.e. one at a
+    time on a single shared thread, so a slow request or export would
+    hold up every other request handed to the WSGI app
+'''
+class ThreadPoolWsgiInstance(WsgiToAsgiInstance):
+    run_wsgi_app = sync_to_async(WsgiToAsgiInstance.__dict__['run_wsgi_app'].func,
+                                 thread_sensitive=False)
+
+
+class ThreadPoolWsgiToAsgi(WsgiToAsgi):
+    async def __call__(self, scope, receive, send):
+        await ThreadPoolWsgiInstance(self.wsgi_application)(scope, receive, send)
+
+
+'''
+closing_iterable(wsgi_app)
+    wrap wsgi_app so the iterable of each response is closed once sent,
+    as WSGI servers do: asgiref never calls its close(), which runs the
+    call_on_close callbacks of flask, i.e. the end of an export
+'''
+def closing_iterable(wsgi_app):
+    def application(environ, start_response):
+        iterable = wsgi_app(environ, start_response)
+        try:
+            yield from iterable
+        finally:
+            if hasattr(iterable, 'close'):
+                iterable.close()
+    return application
+
+
+'''
+AsgiApp
+    the ASGI application, wrapping a WSGI app built by create_app()
+    database_path defaults to the database of the WSGI app
+    the asyncio engines, one per database, are created on the first
+    native request reading it, in the event loop of the server, and
+    disposed on lifespan shutdown
+    reads go to the replica picked by the replica router of the WSGI
+    app, read-your-writes included
+'''
+class AsgiApp:
+    def __init__(self, wsgi_app, database_path=None):
+        self.wsgi_app = wsgi_app
+        self.wsgi = ThreadPoolWsgiToAsgi(closing_iterable(wsgi_app))
+        self.database_path = database_path or wsgi_app.config['SQLALCHEMY_DATABASE_URI']
+        self.engines = {}
+        self.routes = {
+            '/actors': (Actor, 'actors', auth.compile_permissions('get:actors')),
+            '/movies': (Movie, 'movies', auth.compile_permissions('get:movies'))
+        }
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            return await self.lifespan(receive, send)
+
+        route = self.routes.get(scope['path'])
+        if route is not None and scope['method'] == 'GET':
+            # timed like setup_timing() times the WSGI requests, the SQL
+            # listeners of models.py find the timer in the context of the task
+            timer = RequestTimer(scope['path'], 'GET')
+            token = native_timer.set(timer)
+            try:
+                response = await self.list_response(scope, *route)
+            finally:
+                native_timer.reset(token)
+            if response is not None:
+                status, headers, body = response
+                server_timing = finish_timer(timer, scope['path'], 'GET')
+                if server_timing is not None:
+                    headers.append(('Server-Timing', server_timing))
+                await self.send_response(send, scope, status, headers, body)
+                return
+        await self.wsgi(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                await self.dispose()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    '''
+    get_engine(bind=None)
+        the asyncio engine of the primary, or of the replica bind
+    '''
+    def get_engine(self, bind=None):
+        path = self.database_path if bind is None \
+            else self.wsgi_app.config['SQLALCHEMY_BINDS'][bind]
+        engine = self.engines.get(path)
+        if engine is None:
+            url, options = async_engine_options(path)
+            engine = self.engines[path] = create_async_engine(url, **options)
+        if bind is not None:
+            replica_router.track(bind, engine.sync_engine)
+        return engine
+
+    async def dispose(self):
+        engines, self.engines = self.engines, {}
+        for engine in engines.values():
+            await engine.dispose()
+
+    '''
+    the replica serving a read of subject, or None for the primary
+    the router checks the health of a replica with the blocking engine
+    of the WSGI app, so it runs in a worker thread
+    '''
+    async def choose_replica(self, subject):
+        if not replica_router.replicas:
+            return None
+        return await asyncio.get_running_loop().run_in_executor(
+            None, replica_router.choose,
+            lambda key: db.get_engine(self.wsgi_app, bind=key), subject)
+
+    '''
+    verify the bearer token of the request for the required permissions
+    and take its tokens from the rate limits of its subject
+    return the verified token, or None if the request does not pass,
+    the WSGI app then answers it with the right error
+    raise a RateLimitError when the subject is over its limits, answered
+    by the native path itself
+    '''
+    async def authorize(self, headers, required):
+        parts = headers.get('authorization', '').split()
+        if len(parts) != 2 or parts[0].lower() != 'bearer':
+            return None
+        try:
+            verified = auth.token_cache.get(parts[1])
+            if verified is None:
+                verified = await asyncio.get_running_loop().run_in_executor(
+                    None, auth.verify_token, parts[1])
+            auth.check_permissions(required, verified.payload, verified.permissions)
+        except auth.AuthError:
+            return None
+        auth.limiter.check(verified.payload.get('sub'), required)
+        return verified
+
+    '''
+    the response of the errorhandler of the WSGI app to a RateLimitError
+    the native path answers it itself: the request already took its
+    tokens, the WSGI app would take them again
+    '''
+    def rate_limit_response(self, error):
+        with self.wsgi_app.app_context():
+            body = jsonify(error.error).get_data()
+        return error.status_code, [
+            ('Content-Type', 'application/json'),
+            ('Retry-After', str(error.retry_after)),
+            ('Vary', 'Accept-Encoding')
+        ], body
+
+    '''
+    the response of the errorhandler of the WSGI app to an HTTPException
+    '''
+    def error_response(self, error):
+        with self.wsgi_app.test_request_context():
+            response = self.wsgi_app.make_response(
+                self.wsgi_app.handle_http_exception(error))
+        return response.status_code, [
+            ('Content-Type', response.content_type),
+            ('Vary', 'Accept-Encoding')
+        ], response.get_data()
+
+    '''
+    the validators of list_response() in app.py, read on connection
+    '''
+    async def collection_validators(self, connection, table_names, query_string):
+        rows = (await connection.execute(
+            select(TableVersion.table_name, TableVersion.version, TableVersion.updated_at)
+            .where(TableVersion.table_name.in_(table_names)))).all()
+        versions = {row.table_name: row for row in rows}
+        version = '.'.join(str(versions[name].version if name in versions else 0)
+                           for name in table_names)
+        etag = collection_etag(table_names, version, query_string)
+
+        updated_at = max((row.updated_at for row in rows), default=None)
+        if updated_at is not None:
+            updated_at = updated_at.replace(microsecond=0, tzinfo=timezone.utc)
+        return version, etag, updated_at
+
+    @staticmethod
+    def is_not_modified(headers, etag, updated_at):
+        if 'if-none-match' in headers:
+            return parse_etags(headers['if-none-match']).contains_weak(etag)
+        if 'if-modified-since' in headers and updated_at is not None:
+            since = parse_date(headers['if-modified-since'])
+            return since is not None and updated_at <= since
+        return False
+
+    '''
+    answer a list request natively with a page of model rows, the same
+    page, headers and cache entries as list_response() in app.py
+    return (status, headers, body), or None to hand the request to the
+    WSGI app
+    '''
+    async def list_response(self, scope, model, key, required):
+        query_string = scope['query_string'].decode('latin-1')
+        args = MultiDict(parse_qsl(query_string, keep_blank_values=True))
+        if 'include' in args:
+            return None
+        try:
+            limit, after = parse_page_args(args)
+            fields = parse_fields(args, model)
+            conditions = parse_filters(args, model)
+            shape = parse_shape(args)
+        except ValueError:
+            return None
+
+        headers = {name.decode('latin-1').lower(): value.decode('latin-1')
+                   for name, value in scope['headers']}
+        try:
+            with phase('auth'):
+                verified = await self.authorize(headers, required)
+            if verified is None:
+                return None
+            subject = verified.payload.get('sub')
+            with auth.limiter.in_flight(subject):
+                return await self.page_response(
+                    scope, headers, args, query_string, subject, model, key, fields,
+                    conditions, limit, after, shape)
+        except RateLimitError as error:
+            return self.rate_limit_response(error)
+
+    '''
+    the page of list_response(), built while the request counts as in
+    flight for its subject
+    '''
+    async def page_response(self, scope, headers, args, query_string, subject, model, key,
+                            fields, conditions, limit, after, shape):
+        table_names = [model.__tablename__]
+        bind = await self.choose_replica(subject)
+        async with self.get_engine(bind).connect() as connection:
+            version, etag, updated_at = await self.collection_validators(
+                connection, table_names, query_string)
+            response_headers = [
+                ('ETag', 'W/"{}"'.format(etag)),
+                ('Cache-Control', 'private, no-cache')
+            ]
+            if updated_at is not None:
+                response_headers.append(('Last-Modified', http_date(updated_at)))
+            response_headers.append(('Vary', 'Accept-Encoding'))
+            if self.is_not_modified(headers, etag, updated_at):
+                return 304, response_headers, b''
+
+            request = SimpleNamespace(path=scope['path'], args=args)
+            body = response_cache.get(table_names[0], version, request)
+            if body is None:
+                statement = keyset_statement(
+                    select_fields(model, fields).where(*conditions), model.id, after, limit)
+                try:
+                    rows, next_cursor = keyset_rows(
+                        (await connection.execute(statement)).all(), limit)
+                except Exception:
+                    # i.e. an integer beyond the range of the column, render()
+                    # of app.py answers 422 for it
+                    return self.error_response(UnprocessableEntity())
+                with phase('serialize'):
+                    body = dumps({
+                        'success': True,
+                        key: page_items(fields, rows, shape),
+                        'next_cursor': next_cursor
+                    })
+                response_cache.set(table_names[0], version, request, body)
+        response_headers.append(('Content-Type', 'application/json'))
+        # compressed like setup_compression() compresses the WSGI responses
+        body, coding = encode_body(body, 'application/json', headers.get('accept-encoding'))
+        if coding is not None:
+            response_headers.append(('Content-Encoding', coding))
+        return 200, response_headers, body
+
+    @staticmethod
+    async def send_response(send, scope, status, headers, body):
+        # the CORS headers flask-cors adds to every response of the WSGI app
+        origin = dict(scope['headers']).get(b'origin')
+        if origin:
+            headers = headers + [('Access-Control-Allow-Origin', origin.decode('latin-1')),
+                                 ('Vary', 'Origin')]
+        else:
+            headers = headers + [('Access-Control-Allow-Origin', '*')]
+        headers.append(('Content-Length', str(len(body))))
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                        for name, value in headers]
+        })
+        await send({'type': 'http.response.body', 'body': body})
+
+
+app = AsgiApp(wsgi_app)
@@ -1,14 +1,57 @@
 import os
-import json
-from flask import request, _request_ctx_stack
+import hashlib
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from flask import Response, g, request, _request_ctx_stack
 from functools import wraps
-from jose import jwt
-from urllib.request import urlopen
+from jose import jwk, jwt
+from jose.utils import base64url_decode
 
+from metrics import registry
+from ratelimit import limiter
+from timing import phase
+from jwks import JWKSCache, JWKSUnavailableError, file_fetcher, url_fetcher
+
+# required, like DATABASE_URL, the app fails to start without them
 AUTH0_DOMAIN = os.environ['AUTH0_DOMAIN']
-ALGORITHMS = [os.environ['ALGORITHMS']]
+ALGORITHMS = [os.environ.get('ALGORITHMS', 'RS256')]
 API_AUDIENCE = os.environ['API_AUDIENCE']
 
+# JWKS_PATH points at a local key set, used instead of Auth0 in tests
+JWKS_PATH = os.environ.get('JWKS_PATH')
+JWKS_CACHE_TTL = float(os.environ.get('JWKS_CACHE_TTL', 600))
+JWKS_MIN_REFRESH_INTERVAL = float(os.environ.get('JWKS_MIN_REFRESH_INTERVAL', 30))
+
+if JWKS_PATH:
+    jwks_fetcher = file_fetcher(JWKS_PATH)
+else:
+    jwks_fetcher = url_fetcher(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
+
+'''
+build_public_key(key)
+    construct the public key object of a jwk once, when the JWKS loads,
+    so verifying a token does not re-import the key every request
+'''
+def build_public_key(key):
+    return jwk.construct({
+        'kty': key['kty'],
+        'kid': key['kid'],
+        'use': key['use'],
+        'n': key['n'],
+        'e': key['e']
+    }, ALGORITHMS[0])
+
+
+jwks_cache = JWKSCache(
+    jwks_fetcher,
+    ttl=JWKS_CACHE_TTL,
+    min_refresh_interval=JWKS_MIN_REFRESH_INTERVAL,
+    key_builder=build_public_key)
+
+# maximum number of verified tokens kept in memory, 0 disables the cache
+TOKEN_CACHE_SIZE = int(os.environ.get('TOKEN_CACHE_SIZE', 1024))
+
 ## AuthError Exception
 '''
 AuthError Exception
@@ -20,6 +63,85 @@ class AuthError(Exception):
         self.status_code = status_code
 
 
+## Token Cache
+
+'''
+VerifiedToken
+    the decoded payload of a verified token together with its
+    permissions compiled into a frozenset
+'''
+VerifiedToken = namedtuple('VerifiedToken', ['payload', 'permissions'])
+
+'''
+TokenCache
+    a bounded LRU cache of verified tokens
+    entries are keyed by a sha256 digest of the token, so raw tokens are
+    never kept in memory, and expire at the token's own exp claim
+    hits and misses are counted for monitoring
+'''
+class TokenCache:
+    def __init__(self, maxsize=TOKEN_CACHE_SIZE, clock=time.time):
+        self.maxsize = maxsize
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    '''
+    get(token)
+        return the cached VerifiedToken of a token, or None
+    '''
+    def get(self, token):
+        digest = self._digest(token)
+        with self._lock:
+            entry = self._entries.get(digest)
+            if entry is not None and entry[0] > self.clock():
+                self._entries.move_to_end(digest)
+                self.hits += 1
+                return entry[1]
+            if entry is not None:
+                del self._entries[digest]
+            self.misses += 1
+            return None
+
+    '''
+    put(token, verified)
+        remember a VerifiedToken until the exp claim of its payload
+        tokens without an exp claim are not cached
+    '''
+    def put(self, token, verified):
+        exp = verified.payload.get('exp')
+        if self.maxsize <= 0 or not isinstance(exp, (int, float)):
+            return
+        digest = self._digest(token)
+        with self._lock:
+            self._entries[digest] = (exp, verified)
+            self._entries.move_to_end(digest)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def _digest(token):
+        return hashlib.sha256(token.encode('utf-8')).digest()
+
+
+token_cache = TokenCache()
+
+registry.counter('token_cache_hits_total',
+                 'Requests whose bearer token was already verified.',
+                 lambda: token_cache.hits)
+registry.counter('token_cache_misses_total',
+                 'Requests whose bearer token had to be verified.',
+                 lambda: token_cache.misses)
+
 ## Auth Header
 
 '''
@@ -63,22 +185,49 @@ def get_token_auth_header():
 
 '''
     @INPUTS
-        permission: string permission (i.e. 'post:drink')
+        permission: a string permission (i.e. 'post:drink'), an iterable
+            of them, or a frozenset compiled by compile_permissions
+
+    return the permissions as a frozenset, leaving out empty strings
+'''
+def compile_permissions(permission):
+    if isinstance(permission, frozenset):
+        return permission
+    if isinstance(permission, str):
+        permission = [permission]
+    return frozenset(p for p in permission if p)
+
+'''
+    @INPUTS
+        permission: string permission (i.e. 'post:drink'), or the set of
+            permissions compiled by compile_permissions
         payload: decoded jwt payload
+        granted: the token permissions as a frozenset, compiled from the
+            payload if not given
+        match: 'all' if every permission is required, 'any' if one is enough
 
     it should raise an AuthError if permissions are not included in the payload
-    it should raise an AuthError if the requested permission string is not in the payload permissions array
+    it should raise an AuthError if the requested permissions are not in the payload permissions array
 
     return true otherwise
 '''
-def check_permissions(permission, payload):
+def check_permissions(permission, payload, granted=None, match='all'):
     if 'permissions' not in payload:
         raise AuthError({
             'code': 'invalid_claims',
             'description': 'Permissions not included in JWT.'
         }, 400)
 
-    if permission not in payload['permissions']:
+    required = compile_permissions(permission)
+    if granted is None:
+        granted = frozenset(payload['permissions'])
+
+    if match == 'all':
+        allowed = required <= granted
+    else:
+        allowed = not required or not required.isdisjoint(granted)
+
+    if not allowed:
         raise AuthError({
             'code': 'unauthorized',
             'description': 'Permission not found.'
@@ -91,38 +240,39 @@ def check_permissions(permission, payload):
 
     it should be an Auth0 token with key id (kid)
     it should verify the token using Auth0 /.well-known/jwks.json
+        (pre-built public keys served from jwks_cache, see jwks.py)
     it should decode the payload from the token
     it should validate the claims
     return the decoded payload
 '''
 def verify_decode_jwt(token):
-    jsonurl = urlopen(f'https://{AUTH0_DOMAIN}/.well-known/jwks.json')
-    jwks = json.loads(jsonurl.read())
     unverified_header = jwt.get_unverified_header(token)
-    rsa_key = {}
     if 'kid' not in unverified_header:
         raise AuthError({
             'code': 'invalid_header',
             'description': 'Authorization malformed.'
         }, 401)
 
-    for key in jwks['keys']:
-        if key['kid'] == unverified_header['kid']:
-            rsa_key = {
-                'kty': key['kty'],
-                'kid': key['kid'],
-                'use': key['use'],
-                'n': key['n'],
-                'e': key['e']
-            }
-    if rsa_key:
+    try:
+        key = jwks_cache.get_key(unverified_header['kid'])
+    except JWKSUnavailableError:
+        raise AuthError({
+            'code': 'jwks_unavailable',
+            'description': 'Unable to load the signing keys.'
+        }, 503)
+
+    if key is not None:
         try:
+            verify_signature(token, key, unverified_header)
+            # the signature is already checked against the pre-built key,
+            # jose only validates the claims
             payload = jwt.decode(
                 token,
-                rsa_key,
+                None,
                 algorithms=ALGORITHMS,
                 audience=API_AUDIENCE,
-                issuer='https://' + AUTH0_DOMAIN + '/'
+                issuer='https://' + AUTH0_DOMAIN + '/',
+                options={'verify_signature': False}
             )
 
             return payload
@@ -150,21 +300,86 @@ def verify_decode_jwt(token):
 
 '''
     @INPUTS
-        permission: string permission (i.e. 'post:drink')
+        token: a json web token (string)
+        key: a public key object built by build_public_key
+        header: the unverified header of the token
+
+    it should raise a JWTError if the algorithm is not allowed
+    it should raise a JWTError if the signature does not match the key
+'''
+def verify_signature(token, key, header):
+    if header.get('alg') not in ALGORITHMS:
+        raise jwt.JWTError('The specified alg value is not allowed')
 
+    signing_input, _, signature = token.encode('utf-8').rpartition(b'.')
+    if not key.verify(signing_input, base64url_decode(signature)):
+        raise jwt.JWTError('Signature verification failed.')
+
+'''
+    @INPUTS
+        token: a json web token (string)
+
+    it should use the verify_decode_jwt method to decode the jwt,
+        unless the token was already verified and is in the token_cache
+    return the VerifiedToken with the payload and its compiled permissions
+'''
+def verify_token(token):
+    verified = token_cache.get(token)
+    if verified is None:
+        payload = verify_decode_jwt(token)
+        permissions = payload.get('permissions')
+        if not isinstance(permissions, list):
+            permissions = []
+        verified = VerifiedToken(payload, frozenset(permissions))
+        token_cache.put(token, verified)
+    return verified
+
+'''
+    @INPUTS
+        permissions: string permissions (i.e. 'post:drink')
+        match: 'all' (default) if every permission is required,
+            'any' if one of them is enough
+
+    the required permissions are compiled once, when the route is decorated
     it should use the get_token_auth_header method to get the token
-    it should use the verify_decode_jwt method to decode the jwt
-    it should use the check_permissions method validate claims and check the requested permission
-    return the decorator which passes the decoded payload to the decorated method
+    it should use the verify_token method to decode the jwt
+    it should use the check_permissions method validate claims and check the requested permissions
+    it should use the limiter to apply the rate limits of the subject (sub claim),
+        a streamed response counts as in flight until its body is closed
+    return the decorator which passes the decoded payload to the decorated method,
+        the payload is also kept in g.current_user for the request
+    EXAMPLE
+        @requires_auth('get:actors', 'get:movies', match='any')
 '''
-def requires_auth(permission=''):
+def requires_auth(*permissions, match='all'):
+    if match not in ('all', 'any'):
+        raise ValueError("match must be 'all' or 'any'")
+    required = compile_permissions(permissions)
+
     def requires_auth_decorator(f):
         @wraps(f)
         def wrapper(*args, **kwargs):
-            token = get_token_auth_header()
-            payload = verify_decode_jwt(token)
-            check_permissions(permission, payload)
-            return f(payload, *args, **kwargs)
+            with phase('auth'):
+                token = get_token_auth_header()
+                verified = verify_token(token)
+                check_permissions(required, verified.payload,
+                                  verified.permissions, match)
+                subject = verified.payload.get('sub')
+                limiter.check(subject, required)
+            g.current_user = verified.payload
+            release = limiter.acquire(subject)
+            try:
+                response = f(verified.payload, *args, **kwargs)
+            except BaseException:
+                release()
+                raise
+            if isinstance(response, Response) and response.is_streamed:
+                # the body, i.e. an export, is read after the handler
+                # returned, the request is in flight until it is sent
+                response.call_on_close(release)
+            else:
+                release()
+            return response
 
         return wrapper
     return requires_auth_decorator
\ No newline at end of file
@@ -0,0 +1,398 @@
+'''
+Load / throughput benchmark of every route of the API
+
+seeds a database, serves create_app() from a threaded werkzeug server
+(or, with --asgi, asgi.py from uvicorn) in this process and runs each route at several concurrency levels, with
+RS256 tokens minted by LocalAuth instead of Auth0
+reports req/s and p50 / p95 / p99 latency per route and concurrency,
+and writes them as json to compare releases
+
+    python benchmarks/bench_api.py [--actors 10000] [--movies 2000]
+        [--cast 5] [--concurrency 1,8,32] [--requests 200]
+        [--routes search,get_actors] [--output results.json]
+        [--baseline previous.json] [--tolerance 0.2] [--asgi]
+
+--database-url defaults to a temporary SQLite file; the tables of the
+database it points to are DROPPED and re-seeded
+the load generator shares the GIL with the server, so the numbers are
+a lower bound, compare them between runs on the same machine only
+with --baseline, routes whose p95 grew by more than --tolerance are
+listed and the script exits with status 1
+'''
+import argparse
+import datetime
+import http.client
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from local_auth import LocalAuth
+
+
+PERMISSIONS = [
+    'get:actors', 'get:movies', 'post:actors', 'post:movies',
+    'patch:actors', 'patch:movies', 'delete:actors', 'delete:movies'
+]
+# requests per route sent before measuring, to warm the caches
+WARMUP_REQUESTS = 10
+# words the seeded names and titles, and the searches, are made of
+NAMES = ['tom', 'meryl', 'denzel', 'cate', 'keanu', 'viola', 'idris', 'tilda']
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Benchmark every API route.')
+    parser.add_argument('--database-url', default=None)
+    parser.add_argument('--actors', type=int, default=10000)
+    parser.add_argument('--movies', type=int, default=2000)
+    parser.add_argument('--cast', type=int, default=5,
+                        help='actors linked to each movie')
+    parser.add_argument('--concurrency', default='1,8,32')
+    parser.add_argument('--requests', type=int, default=200,
+                        help='measured requests per route and concurrency')
+    parser.add_argument('--routes', default=None,
+                        help='comma separated endpoint names, default all')
+    parser.add_argument('--output', default='bench_api_results.json')
+    parser.add_argument('--baseline', default=None)
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    parser.add_argument('--asgi', action='store_true',
+                        help='serve asgi.py from uvicorn instead of werkzeug')
+    return parser.parse_args(argv)
+
+
+'''
+Seeder
+    fills the database with actors, movies and their casts, and hands
+    out fresh rows for the requests that delete them
+'''
+class Seeder:
+    def __init__(self, app):
+        self.app = app
+        self.actor_ids = []
+        self.movie_ids = []
+
+    def seed(self, actors, movies, cast):
+        from models import db, movie_actors, Actor, Movie
+
+        with self.app.app_context():
+            db.drop_all()
+            db.create_all()
+            self.actor_ids = self.insert(Actor, actors)
+            self.movie_ids = self.insert(Movie, movies)
+            links = [{'movie_id': movie_id, 'actor_id': actor_id}
+                     for movie_id in self.movie_ids
+                     for actor_id in random.sample(self.actor_ids, min(cast, actors))]
+            for start in range(0, len(links), 5000):
+                db.session.execute(movie_actors.insert(), links[start:start + 5000])
+            db.session.commit()
+
+    def insert(self, model, count):
+        from sqlalchemy import func, select
+        from models import db, bulk_insert
+
+        # nothing else writes while seeding, the new rows are those above
+        # the previous highest id
+        last_id = db.session.execute(select(func.max(model.id))).scalar() or 0
+        for start in range(0, count, 5000):
+            bulk_insert(model, [self.row(model, index)
+                                for index in range(start, min(start + 5000, count))])
+        return db.session.execute(
+            select(model.id).where(model.id > last_id).order_by(model.id)).scalars().all()
+
+    @staticmethod
+    def row(model, index):
+        if model.__tablename__ == 'actors':
+            return {
+                'name': 'actor {} {}'.format(random.choice(NAMES), index),
+                'age': random.randint(18, 90),
+                'gender': random.choice(('female', 'male'))
+            }
+        return {
+            'title': 'movie {} {}'.format(random.choice(NAMES), index),
+            'release_date': datetime.date(1950, 1, 1)
+                + datetime.timedelta(days=random.randint(0, 27000))
+        }
+
+    '''
+    reserve(model, count)
+        insert count rows only used to be deleted, return their ids
+    '''
+    def reserve(self, model, count):
+        with self.app.app_context():
+            return self.insert(model, count)
+
+    def any_actor(self):
+        return random.choice(self.actor_ids)
+
+    def any_movie(self):
+        return random.choice(self.movie_ids)
+
+'''
+the request sent to each endpoint, built from the seeder and the index of
+the request: (method, path, json body)
+requests that delete rows take them from ids reserved beforehand
+'''
+def route_cases(seeder, reserved):
+    def take(model_name):
+        return reserved[model_name].pop()
+
+    return {
+        'get_greeting': lambda i: ('GET', '/', None),
+        'after_login': lambda i: ('GET', '/redirect', None),
+        'get_metrics': lambda i: ('GET', '/metrics', None),
+        'get_actors': lambda i: ('GET', '/actors?limit=20', None),
+        'get_movies': lambda i: ('GET', '/movies?limit=20&include=cast', None),
+        'export_actors': lambda i: ('GET', '/actors/export?format=ndjson&age_min=89', None),
+        'export_movies': lambda i: ('GET', '/movies/export?release_from=2020-01-01', None),
+        'search': lambda i: ('GET', '/search?q={}'.format(random.choice(NAMES)[:3]), None),
+        'get_movie_actors': lambda i: (
+            'GET', '/movies/{}/actors'.format(seeder.any_movie()), None),
+        'get_actor_movies': lambda i: (
+            'GET', '/actors/{}/movies'.format(seeder.any_actor()), None),
+        'add_movie_actors': lambda i: (
+            'POST', '/movies/{}/actors'.format(seeder.any_movie()),
+            {'actor_ids': [seeder.any_actor()]}),
+        'remove_movie_actors': lambda i: (
+            'DELETE', '/movies/{}/actors'.format(seeder.any_movie()),
+            {'actor_ids': [seeder.any_actor()]}),
+        'delete_actor': lambda i: ('DELETE', '/actors/{}'.format(take('actors')), None),
+        'delete_movie': lambda i: ('DELETE', '/movies/{}'.format(take('movies')), None),
+        'add_actor': lambda i: (
+            'POST', '/actors', {'name': 'new actor {}'.format(i), 'age': 30, 'gender': 'female'}),
+        'add_movie': lambda i: (
+            'POST', '/movies', {'title': 'new movie {}'.format(i), 'release_date': '2030-01-01'}),
+        'add_actors': lambda i: ('POST', '/actors/bulk', [
+            {'name': 'bulk actor {}'.format(i), 'age': 40} for _ in range(10)]),
+        'add_movies': lambda i: ('POST', '/movies/bulk', [
+            {'title': 'bulk movie {}'.format(i), 'release_date': '2030-01-01'} for _ in range(10)]),
+        'edit_actors': lambda i: ('PATCH', '/actors/bulk', {
+            'ids': [seeder.any_actor() for _ in range(10)], 'changes': {'age': 50}}),
+        'edit_movies': lambda i: ('PATCH', '/movies/bulk', {
+            'ids': [seeder.any_movie() for _ in range(10)], 'changes': {'release_date': '2031-1-1'}}),
+        'delete_actors': lambda i: ('DELETE', '/actors/bulk', {
+            'ids': [take('actors') for _ in range(10)]}),
+        'delete_movies': lambda i: ('DELETE', '/movies/bulk', {
+            'ids': [take('movies') for _ in range(10)]}),
+        'edit_actor': lambda i: (
+            'PATCH', '/actors/{}'.format(seeder.any_actor()), {'age': 33}),
+        'edit_movie': lambda i: (
+            'PATCH', '/movies/{}'.format(seeder.any_movie()), {'title': 'edited {}'.format(i)})
+    }
+
+# endpoints deleting rows, and the rows each of their requests deletes
+DELETES = {
+    'delete_actor': ('actors', 1),
+    'delete_movie': ('movies', 1),
+    'delete_actors': ('actors', 10),
+    'delete_movies': ('movies', 10)
+}
+
+
+def send(port, token, method, path, body):
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=60)
+    headers = {'Authorization': 'Bearer ' + token}
+    payload = None
+    if body is not None:
+        payload = json.dumps(body)
+        headers['Content-Type'] = 'application/json'
+    start = time.perf_counter()
+    try:
+        connection.request(method, path, body=payload, headers=headers)
+        response = connection.getresponse()
+        response.read()
+        status = response.status
+    finally:
+        connection.close()
+    return time.perf_counter() - start, status
+
+
+def percentile(timings, share):
+    return timings[min(int(len(timings) * share), len(timings) - 1)]
+
+'''
+run(port, token, build, concurrency, requests)
+    send requests built by build(index) from concurrency threads
+    return the measured result of the level
+'''
+def run(port, token, build, concurrency, requests):
+    built = [build(index) for index in range(requests)]
+    timings = []
+    statuses = {}
+    lock = threading.Lock()
+
+    def worker(request):
+        elapsed, status = send(port, token, *request)
+        with lock:
+            timings.append(elapsed)
+            statuses[status] = statuses.get(status, 0) + 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        list(executor.map(worker, built))
+    wall = time.perf_counter() - start
+
+    timings.sort()
+    return {
+        'concurrency': concurrency,
+        'requests': requests,
+        'errors': sum(count for status, count in statuses.items() if status >= 400),
+        'statuses': {str(status): count for status, count in sorted(statuses.items())},
+        'rps': requests / wall,
+        'p50_ms': percentile(timings, 0.50) * 1000,
+        'p95_ms': percentile(timings, 0.95) * 1000,
+        'p99_ms': percentile(timings, 0.99) * 1000
+    }
+
+
+def environment(args, database_url):
+    try:
+        commit = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'commit': commit,
+        'timestamp': datetime.datetime.utcnow().isoformat() + 'Z',
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'database': database_url.split(':', 1)[0],
+        'actors': args.actors,
+        'movies': args.movies,
+        'cast': args.cast,
+        'server': 'asgi' if args.asgi else 'wsgi'
+    }
+
+'''
+compare(results, baseline, tolerance)
+    return the results whose p95 grew by more than tolerance (0.2 = 20%)
+    compared to the same route and concurrency in baseline
+'''
+def compare(results, baseline, tolerance):
+    previous = {(result['endpoint'], result['concurrency']): result
+                for result in baseline['results']}
+    regressions = []
+    for result in results:
+        before = previous.get((result['endpoint'], result['concurrency']))
+        if before and result['p95_ms'] > before['p95_ms'] * (1 + tolerance):
+            regressions.append((result, before))
+    return regressions
+
+
+'''
+serve app through asgi.py from uvicorn in a thread
+return (shutdown, port), shutdown() stops the server
+'''
+def serve_asgi(app):
+    import socket
+    import uvicorn
+    from asgi import AsgiApp
+
+    with socket.socket() as probe:
+        probe.bind(('127.0.0.1', 0))
+        port = probe.getsockname()[1]
+    server = uvicorn.Server(uvicorn.Config(
+        AsgiApp(app), host='127.0.0.1', port=port, log_level='error'))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.05)
+
+    def shutdown():
+        server.should_exit = True
+        thread.join()
+    return shutdown, port
+
+
+def main(argv):
+    args = parse_args(argv)
+    database_url = args.database_url or 'sqlite:///' + os.path.join(
+        tempfile.mkdtemp(prefix='bench_api_'), 'bench.db')
+    # create_app() reads DATABASE_URL
+    os.environ['DATABASE_URL'] = database_url
+    # every request uses one token, the per-subject limits would only
+    # measure themselves
+    os.environ.setdefault('RATE_LIMIT', '0')
+    os.environ.setdefault('RATE_LIMIT_CONCURRENCY', '0')
+
+    from werkzeug.serving import make_server
+    import app as app_module
+    from app import create_app
+    from models import Actor, Movie
+
+    local_auth = LocalAuth()
+    local_auth.install()
+    token = local_auth.make_token(PERMISSIONS)
+    # every request sends the same bearer token, GET /metrics included
+    app_module.METRICS_TOKEN = token
+
+    app = create_app()
+    seeder = Seeder(app)
+    print('seeding {} actors, {} movies'.format(args.actors, args.movies))
+    seeder.seed(args.actors, args.movies, args.cast)
+
+    # the per-request access log would dominate the timings
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    if args.asgi:
+        shutdown, port = serve_asgi(app)
+    else:
+        server = make_server('127.0.0.1', 0, app, threaded=True)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        shutdown, port = server.shutdown, server.server_port
+
+    levels = [int(level) for level in args.concurrency.split(',')]
+    wanted = set(args.routes.split(',')) if args.routes else None
+    reserved = {'actors': [], 'movies': []}
+    cases = route_cases(seeder, reserved)
+
+    results = []
+    for rule in app.url_map.iter_rules():
+        if rule.endpoint == 'static' or (wanted and rule.endpoint not in wanted):
+            continue
+        build = cases.get(rule.endpoint)
+        if build is None:
+            print('{:<22} no benchmark case, skipped'.format(rule.endpoint))
+            continue
+        method = sorted(rule.methods.difference(('HEAD', 'OPTIONS')))[0]
+
+        for concurrency in levels:
+            if rule.endpoint in DELETES:
+                table, per_request = DELETES[rule.endpoint]
+                model = Actor if table == 'actors' else Movie
+                reserved[table] = seeder.reserve(
+                    model, (args.requests + WARMUP_REQUESTS) * per_request)
+            run(port, token, build, min(concurrency, WARMUP_REQUESTS), WARMUP_REQUESTS)
+            result = run(port, token, build, concurrency, args.requests)
+            result.update(endpoint=rule.endpoint, method=method, rule=rule.rule)
+            results.append(result)
+            print('{:<22} {:<6} c={:<3} {:8.1f} req/s  p50 {:7.2f}ms  p95 {:7.2f}ms  '
+                  'p99 {:7.2f}ms  errors {}'.format(
+                      rule.endpoint, method, concurrency, result['rps'], result['p50_ms'],
+                      result['p95_ms'], result['p99_ms'], result['errors']))
+
+    shutdown()
+    report = {'environment': environment(args, database_url), 'results': results}
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=2)
+    print('results written to {}'.format(args.output))
+
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            regressions = compare(results, json.load(baseline), args.tolerance)
+        for result, before in regressions:
+            print('REGRESSION {} c={}: p95 {:.2f}ms -> {:.2f}ms'.format(
+                result['endpoint'], result['concurrency'],
+                before['p95_ms'], result['p95_ms']))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,63 @@
+'''
+Micro-benchmark of the per-subject rate limit check
+
+measures the time limiter.check() and limiter.in_flight() add to a
+request with the in-process store, for a few subjects and for many
+(the bucket dict lookup dominates), and with permission limits
+
+    python benchmarks/bench_ratelimit.py [iterations]
+'''
+import os
+import statistics
+import sys
+import time
+
+# make the app modules importable when run as `python benchmarks/<script>.py`
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from ratelimit import MemoryStore, RateLimiter, parse_permission_limits
+
+
+def measure(check, subjects, iterations):
+    timings = []
+    for index in range(iterations):
+        subject = subjects[index % len(subjects)]
+        start = time.perf_counter()
+        check(subject)
+        timings.append((time.perf_counter() - start) * 1e6)
+    timings.sort()
+    return {
+        'mean_us': statistics.mean(timings),
+        'p50_us': timings[len(timings) // 2],
+        'p95_us': timings[int(len(timings) * 0.95)]
+    }
+
+
+def main(iterations=200000):
+    required = frozenset(['get:actors'])
+    # limits high enough that no check fails
+    limiter = RateLimiter(MemoryStore(), rate=1e9, burst=1e9, permission_limits={})
+    per_permission = RateLimiter(MemoryStore(), rate=1e9, burst=1e9,
+                                 permission_limits=parse_permission_limits('get:actors=1e9/1e9'))
+
+    def check_and_enter(subject):
+        limiter.check(subject, required)
+        with limiter.in_flight(subject):
+            pass
+
+    few = ['auth0|{}'.format(index) for index in range(10)]
+    many = ['auth0|{}'.format(index) for index in range(100000)]
+    results = {
+        'check, 10 subjects': measure(lambda s: limiter.check(s, required), few, iterations),
+        'check, 100k subjects': measure(lambda s: limiter.check(s, required), many, iterations),
+        'check + permission': measure(lambda s: per_permission.check(s, required), few,
+                                      iterations),
+        'check + in_flight': measure(check_and_enter, few, iterations)
+    }
+    for name, result in results.items():
+        print('{:<22} mean {mean_us:7.2f}us  p50 {p50_us:7.2f}us  '
+              'p95 {p95_us:7.2f}us'.format(name, **result))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 200000)
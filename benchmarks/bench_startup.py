@@ -0,0 +1,119 @@
+'''
+Cold start benchmark of the app
+
+boots the app in fresh interpreters, the way a worker starts, and
+reports per run the wall time of the whole process, the time spent
+importing app.py (create_app() included) and the time of the first
+request, as the median over the runs
+
+    python benchmarks/bench_startup.py [--runs 10] [--repo .]
+        [--database-url sqlite:///...] [--output results.json]
+        [--baseline previous.json] [--tolerance 0.2]
+
+--repo points at the tree to boot, e.g. a git worktree of an older
+commit, to compare releases on the same machine
+--database-url defaults to an empty temporary SQLite file
+with --baseline, the script exits with status 1 if the median boot
+time grew by more than --tolerance
+'''
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+# run in each fresh interpreter, prints its timings as json
+CHILD = '''
+import json, sys, time
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+response = app.app.test_client().get('/')
+served = time.perf_counter()
+json.dump({
+    'import_ms': (imported - start) * 1000,
+    'first_request_ms': (served - imported) * 1000,
+    'status': response.status_code,
+    'modules': len(sys.modules)
+}, sys.stdout)
+'''
+
+METRICS = ('boot_ms', 'import_ms', 'first_request_ms')
+
+
+def parse_args(argv):
+    parser = argparse.ArgumentParser(description='Benchmark the cold start of the app.')
+    parser.add_argument('--runs', type=int, default=10)
+    parser.add_argument('--repo', default=os.path.dirname(
+        os.path.dirname(os.path.abspath(__file__))))
+    parser.add_argument('--database-url', default=None)
+    parser.add_argument('--output', default='bench_startup_results.json')
+    parser.add_argument('--baseline', default=None)
+    parser.add_argument('--tolerance', type=float, default=0.2)
+    return parser.parse_args(argv)
+
+
+'''
+boot the app once in a new interpreter
+return the timings printed by CHILD and the wall time of the process
+'''
+def boot(repo, env):
+    start = time.perf_counter()
+    process = subprocess.run([sys.executable, '-c', CHILD], cwd=repo, env=env,
+                             capture_output=True, text=True)
+    elapsed = (time.perf_counter() - start) * 1000
+    if process.returncode != 0:
+        raise RuntimeError('the app failed to boot:\n' + process.stderr)
+    result = json.loads(process.stdout)
+    result['boot_ms'] = elapsed
+    return result
+
+
+def main(argv):
+    args = parse_args(argv)
+    database_url = args.database_url or 'sqlite:///' + os.path.join(
+        tempfile.mkdtemp(prefix='bench_startup_'), 'bench.db')
+
+    env = dict(os.environ, DATABASE_URL=database_url)
+    # required when auth.py is imported
+    env.setdefault('AUTH0_DOMAIN', 'benchmark.local')
+    env.setdefault('ALGORITHMS', 'RS256')
+    env.setdefault('API_AUDIENCE', 'capstone_login')
+
+    # the first boot fills the OS file cache, it is not measured
+    boot(args.repo, env)
+    runs = [boot(args.repo, env) for _ in range(args.runs)]
+
+    summary = {metric: statistics.median(run[metric] for run in runs) for metric in METRICS}
+    summary['modules'] = runs[-1]['modules']
+    for metric in METRICS:
+        print('{:<18} median {:8.2f}ms  min {:8.2f}ms  max {:8.2f}ms'.format(
+            metric, summary[metric], min(run[metric] for run in runs),
+            max(run[metric] for run in runs)))
+    print('{:<18} {}'.format('modules loaded', summary['modules']))
+
+    report = {
+        'repo': os.path.abspath(args.repo),
+        'database': database_url.split(':', 1)[0],
+        'python': sys.version.split()[0],
+        'summary': summary,
+        'runs': runs
+    }
+    with open(args.output, 'w') as output:
+        json.dump(report, output, indent=2)
+    print('results written to {}'.format(args.output))
+
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            before = json.load(baseline)['summary']['boot_ms']
+        if summary['boot_ms'] > before * (1 + args.tolerance):
+            print('REGRESSION boot: {:.2f}ms -> {:.2f}ms'.format(before, summary['boot_ms']))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,72 @@
+'''
+Micro-benchmark of token verification latency
+
+compares the per-request rsa_key dict rebuild that verify_decode_jwt used
+to do with the public keys pre-built by the JWKS cache
+
+    python benchmarks/bench_verify.py [iterations]
+'''
+import statistics
+import sys
+import time
+
+from jose import jwt
+
+from local_auth import LocalAuth
+
+import auth
+
+
+def legacy_verify(token, jwks):
+    # the pre-cache code path: scan the key set and let jose import the jwk
+    unverified_header = jwt.get_unverified_header(token)
+    rsa_key = {}
+    for key in jwks['keys']:
+        if key['kid'] == unverified_header['kid']:
+            rsa_key = {
+                'kty': key['kty'],
+                'kid': key['kid'],
+                'use': key['use'],
+                'n': key['n'],
+                'e': key['e']
+            }
+    return jwt.decode(
+        token,
+        rsa_key,
+        algorithms=auth.ALGORITHMS,
+        audience=auth.API_AUDIENCE,
+        issuer='https://' + auth.AUTH0_DOMAIN + '/'
+    )
+
+
+def measure(verify, token, iterations):
+    timings = []
+    for _ in range(iterations):
+        start = time.perf_counter()
+        verify(token)
+        timings.append((time.perf_counter() - start) * 1e6)
+    timings.sort()
+    return {
+        'mean_us': statistics.mean(timings),
+        'p50_us': timings[len(timings) // 2],
+        'p95_us': timings[int(len(timings) * 0.95)]
+    }
+
+
+def main(iterations=500):
+    local_auth = LocalAuth()
+    local_auth.install()
+    token = local_auth.make_token(['get:actors'])
+
+    results = {
+        'rebuilt rsa_key': measure(
+            lambda t: legacy_verify(t, local_auth.jwks), token, iterations),
+        'pre-built key': measure(auth.verify_decode_jwt, token, iterations)
+    }
+    for name, result in results.items():
+        print('{:<16} mean {mean_us:9.1f}us  p50 {p50_us:9.1f}us  '
+              'p95 {p95_us:9.1f}us'.format(name, **result))
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 500)
@@ -0,0 +1,65 @@
+import os
+import sys
+import time
+
+import rsa
+from jose import jwt
+from jose.utils import long_to_base64
+
+# make the app modules importable when run as `python benchmarks/<script>.py`
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+os.environ.setdefault('AUTH0_DOMAIN', 'benchmark.local')
+os.environ.setdefault('ALGORITHMS', 'RS256')
+os.environ.setdefault('API_AUDIENCE', 'capstone_login')
+
+'''
+LocalAuth
+    a locally generated RS256 key pair and its JWKS, standing in for
+    Auth0 so benchmarks can mint their own tokens
+    EXAMPLE
+        local_auth = LocalAuth()
+        local_auth.install()
+        token = local_auth.make_token(['get:actors'])
+'''
+class LocalAuth:
+    def __init__(self, kid='benchmark-key', bits=2048):
+        self.kid = kid
+        self.public_key, self.private_key = rsa.newkeys(bits)
+        self.private_pem = self.private_key.save_pkcs1().decode()
+        self.jwks = {'keys': [{
+            'kty': 'RSA',
+            'kid': kid,
+            'use': 'sig',
+            'alg': 'RS256',
+            'n': long_to_base64(self.public_key.n).decode(),
+            'e': long_to_base64(self.public_key.e).decode()
+        }]}
+
+    '''
+    install()
+        serve the local JWKS to auth.py instead of Auth0
+    '''
+    def install(self):
+        import auth
+        from jwks import JWKSCache
+
+        auth.jwks_cache = JWKSCache(
+            lambda: self.jwks, key_builder=auth.build_public_key)
+        auth.token_cache.clear()
+
+    def make_token(self, permissions, expires_in=3600, subject='auth0|benchmark'):
+        import auth
+
+        now = int(time.time())
+        claims = {
+            'iss': 'https://' + auth.AUTH0_DOMAIN + '/',
+            'aud': auth.API_AUDIENCE,
+            'sub': subject,
+            'iat': now,
+            'exp': now + expires_in,
+            'permissions': list(permissions)
+        }
+        return jwt.encode(
+            claims, self.private_pem, algorithm='RS256',
+            headers={'kid': self.kid})
@@ -0,0 +1,193 @@
+import os
+import threading
+from collections import OrderedDict
+from urllib.parse import urlencode
+
+from metrics import Counter, registry
+from models import on_write
+
+# 'lru' keeps serialized list pages in process memory, 'off' disables caching
+RESPONSE_CACHE = os.environ.get('RESPONSE_CACHE', 'lru')
+RESPONSE_CACHE_SIZE = int(os.environ.get('RESPONSE_CACHE_SIZE', 512))
+# seconds a page is kept in a shared backend
+RESPONSE_CACHE_TTL = int(os.environ.get('RESPONSE_CACHE_TTL', 300))
+
+'''
+CacheBackend
+    the interface of a response cache backend
+    values are bytes and every entry is tagged with the table it was
+    read from, so a write to the table drops all of its entries
+'''
+class CacheBackend:
+    def get(self, tag, key):
+        raise NotImplementedError
+
+    def set(self, tag, key, value):
+        raise NotImplementedError
+
+    def invalidate(self, tag):
+        raise NotImplementedError
+
+
+'''
+NullBackend
+    a backend that never stores anything
+'''
+class NullBackend(CacheBackend):
+    def get(self, tag, key):
+        return None
+
+    def set(self, tag, key, value):
+        pass
+
+    def invalidate(self, tag):
+        pass
+
+
+'''
+LRUBackend
+    a bounded in-process LRU backend
+'''
+class LRUBackend(CacheBackend):
+    def __init__(self, maxsize=RESPONSE_CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, tag, key):
+        with self._lock:
+            value = self._entries.get((tag, key))
+            if value is not None:
+                self._entries.move_to_end((tag, key))
+            return value
+
+    def set(self, tag, key, value):
+        with self._lock:
+            self._entries[(tag, key)] = value
+            self._entries.move_to_end((tag, key))
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, tag):
+        with self._lock:
+            for entry in [entry for entry in self._entries if entry[0] == tag]:
+                del self._entries[entry]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+'''
+SharedBackend
+    a backend shared by every worker, over a key-value client with the
+    get / set(ex=) / incr methods of redis-py
+    invalidating a tag increments its generation instead of deleting
+    keys, the entries of older generations simply expire
+'''
+class SharedBackend(CacheBackend):
+    def __init__(self, client, ttl=RESPONSE_CACHE_TTL, prefix='capstone:'):
+        self.client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    def get(self, tag, key):
+        return self.client.get(self._key(tag, key))
+
+    def set(self, tag, key, value):
+        self.client.set(self._key(tag, key), value, ex=self.ttl)
+
+    def invalidate(self, tag):
+        self.client.incr(self._generation_key(tag))
+
+    def _generation_key(self, tag):
+        return '{}gen:{}'.format(self.prefix, tag)
+
+    def _key(self, tag, key):
+        generation = self.client.get(self._generation_key(tag)) or 0
+        return '{}page:{}:{}:{}'.format(self.prefix, tag, int(generation), key)
+
+
+'''
+FakeSharedClient
+    a local stand-in for a shared key-value store, used in tests
+    values round-trip through bytes like they would over the network
+'''
+class FakeSharedClient:
+    def __init__(self):
+        self.store = {}
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        return self.store.get(key)
+
+    def set(self, key, value, ex=None):
+        with self._lock:
+            self.store[key] = bytes(value)
+
+    def incr(self, key):
+        with self._lock:
+            value = int(self.store.get(key, 0)) + 1
+            self.store[key] = str(value).encode()
+            return value
+
+
+'''
+ResponseCache
+    a read-through cache of serialized list pages
+    keys are built from the route, the sorted query parameters and the
+    table version, so a page is never served across a write even when
+    the write happened in another worker
+    EXAMPLE
+        body = response_cache.get('actors', version, request)
+        if body is None:
+            body = render()
+            response_cache.set('actors', version, request, body)
+'''
+class ResponseCache:
+    def __init__(self, backend):
+        self.backend = backend
+        self.hits = Counter()
+        self.misses = Counter()
+
+    def get(self, table_name, version, request):
+        value = self.backend.get(table_name, self.key(version, request))
+        if value is None:
+            self.misses.inc()
+        else:
+            self.hits.inc()
+        return value
+
+    def set(self, table_name, version, request, value):
+        self.backend.set(table_name, self.key(version, request), value)
+
+    def invalidate(self, table_name):
+        self.backend.invalidate(table_name)
+
+    def hit_ratio(self):
+        total = self.hits.value + self.misses.value
+        return self.hits.value / total if total else 0.0
+
+    @staticmethod
+    def key(version, request):
+        # encoded, so a '&' or '=' inside a value cannot forge another query
+        query = urlencode(sorted(request.args.items(multi=True)))
+        return '{}:{}?{}'.format(version, request.path, query)
+
+
+if RESPONSE_CACHE == 'lru':
+    response_cache = ResponseCache(LRUBackend())
+else:
+    response_cache = ResponseCache(NullBackend())
+
+# every committed write through the models drops the table's pages
+on_write(response_cache.invalidate)
+
+registry.counter('response_cache_hits_total',
+                 'List pages served from the response cache.',
+                 lambda: response_cache.hits.value)
+registry.counter('response_cache_misses_total',
+                 'List pages rendered because they were not cached.',
+                 lambda: response_cache.misses.value)
+registry.gauge('response_cache_hit_ratio',
+               'Share of list page lookups served from the response cache.',
+               lambda: response_cache.hit_ratio())
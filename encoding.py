@@ -0,0 +1,124 @@
+import os
+import gzip
+import json
+
+from flask import Response, request
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# the json encoder of the list responses: 'auto' (orjson when it is
+# installed), 'orjson' or 'json'
+JSON_ENCODER = os.environ.get('JSON_ENCODER', 'auto')
+# responses smaller than this many bytes are sent uncompressed
+COMPRESS_MIN_SIZE = int(os.environ.get('COMPRESS_MIN_SIZE', 1024))
+# gzip level (1-9) and brotli quality (0-11), fast settings by default,
+# a list page is compressed on every request
+GZIP_LEVEL = int(os.environ.get('GZIP_LEVEL', 5))
+BROTLI_QUALITY = int(os.environ.get('BROTLI_QUALITY', 4))
+
+COMPRESSIBLE_TYPES = ('application/json', 'text/plain', 'text/csv', 'text/html')
+
+'''
+dumps(body)
+    encode body as compact json bytes, with orjson when it is installed
+    and allowed by JSON_ENCODER, with the json module otherwise
+'''
+if JSON_ENCODER != 'json' and orjson is not None:
+    def dumps(body):
+        return orjson.dumps(body)
+elif JSON_ENCODER == 'orjson':
+    raise ImportError('JSON_ENCODER=orjson needs the orjson package, '
+                      'pip install -r requirements-speedups.txt')
+else:
+    def dumps(body):
+        return json.dumps(body, ensure_ascii=False, separators=(',', ':')).encode()
+
+'''
+json_response(body, status=200)
+    a response with the compact json of body, used for the large list
+    payloads instead of jsonify
+'''
+def json_response(body, status=200):
+    return Response(dumps(body), status=status, mimetype='application/json')
+
+'''
+choose_encoding(accept_encoding)
+    return the content coding to send for an Accept-Encoding header: the
+    accepted coding with the highest q, 'br' (when brotli is installed)
+    before 'gzip' on a tie, or None
+    EXAMPLE
+        choose_encoding('gzip, deflate, br') == 'br'
+        choose_encoding('br;q=0.1, gzip;q=1.0') == 'gzip'
+'''
+def choose_encoding(accept_encoding):
+    accepted = {}
+    for part in (accept_encoding or '').split(','):
+        coding, _, params = part.strip().partition(';')
+        quality = 1.0
+        for param in params.split(';'):
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[coding.strip().lower()] = quality
+
+    def quality(coding):
+        return accepted.get(coding, accepted.get('*', 0.0))
+
+    codings = ['br', 'gzip'] if brotli is not None else ['gzip']
+    best = max(codings, key=quality)
+    if quality(best) <= 0:
+        return None
+    return best
+
+def compress(body, coding):
+    if coding == 'br':
+        return brotli.compress(body, quality=BROTLI_QUALITY)
+    return gzip.compress(body, compresslevel=GZIP_LEVEL, mtime=0)
+
+'''
+encode_body(body, mimetype, accept_encoding)
+    return (body, coding): body compressed with the coding negotiated
+    from accept_encoding, or unchanged with coding None when it is
+    small, not compressible or no coding is accepted
+'''
+def encode_body(body, mimetype, accept_encoding):
+    if len(body) < COMPRESS_MIN_SIZE or mimetype not in COMPRESSIBLE_TYPES:
+        return body, None
+    coding = choose_encoding(accept_encoding)
+    if coding is None:
+        return body, None
+    return compress(body, coding), coding
+
+'''
+setup_compression(app)
+    compress the responses of app above COMPRESS_MIN_SIZE bytes with the
+    best coding the client accepts; streamed responses, i.e. the
+    exports, are left alone
+'''
+def setup_compression(app):
+    @app.after_request
+    def compress_response(response):
+        if response.mimetype not in COMPRESSIBLE_TYPES:
+            return response
+        response.vary.add('Accept-Encoding')
+        if response.status_code != 200 or response.direct_passthrough \
+                or response.is_streamed or 'Content-Encoding' in response.headers:
+            return response
+
+        body, coding = encode_body(response.get_data(), response.mimetype,
+                                   request.headers.get('Accept-Encoding'))
+        if coding is not None:
+            response.set_data(body)
+            response.headers['Content-Encoding'] = coding
+        return response
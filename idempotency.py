@@ -0,0 +1,288 @@
+import os
+import time
+import hashlib
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from functools import wraps
+
+from flask import Response, abort, g, make_response, request
+from sqlalchemy import delete, exc, insert, select, update
+
+from metrics import Counter, registry
+from models import db, IdempotencyRecord
+
+# where the responses are kept: 'table' (idempotency_keys, shared by the
+# workers) or 'memory' (one worker)
+IDEMPOTENCY_STORE = os.environ.get('IDEMPOTENCY_STORE', 'table')
+# seconds a response is replayed for its key
+IDEMPOTENCY_TTL = int(os.environ.get('IDEMPOTENCY_TTL', 86400))
+# seconds a request holds its key while it runs, after that a crashed
+# worker's key can be taken over
+IDEMPOTENCY_LOCK_SECONDS = int(os.environ.get('IDEMPOTENCY_LOCK_SECONDS', 30))
+# seconds a duplicate waits for the request holding its key, then 409
+IDEMPOTENCY_WAIT = float(os.environ.get('IDEMPOTENCY_WAIT', 10))
+
+MAX_KEY_LENGTH = 255
+# expired keys are purged on one claim out of PURGE_EVERY
+PURGE_EVERY = 100
+# seconds between two looks at a key held by another worker
+POLL_INTERVAL = 0.05
+
+'''
+StoredResponse
+    the record of an idempotency key: the fingerprint of the request
+    body, and the response, status None while the request is running
+'''
+StoredResponse = namedtuple(
+    'StoredResponse', ['fingerprint', 'status', 'body', 'content_type'])
+
+'''
+IdempotencyStore
+    the interface of the stores of idempotency keys
+    - claim(key, fingerprint, expires_at): hold key for a new request
+      and return None, or return the StoredResponse of the request
+      holding it; a key past expires_at is free again
+    - complete(key, status, body, content_type, expires_at): store the
+      response of the request holding key
+    - release(key): free key, the request failed and may be retried
+'''
+class IdempotencyStore:
+    def claim(self, key, fingerprint, expires_at):
+        raise NotImplementedError
+
+    def complete(self, key, status, body, content_type, expires_at):
+        raise NotImplementedError
+
+    def release(self, key):
+        raise NotImplementedError
+
+
+'''
+MemoryStore
+    keys in a dict of this worker
+'''
+class MemoryStore(IdempotencyStore):
+    def __init__(self):
+        self._records = {}
+        self._claims = 0
+        self._lock = threading.Lock()
+
+    def claim(self, key, fingerprint, expires_at):
+        now = datetime.utcnow()
+        with self._lock:
+            self._claims += 1
+            if self._claims % PURGE_EVERY == 0:
+                for expired in [stored for stored, (_, expires) in self._records.items()
+                                if expires <= now]:
+                    del self._records[expired]
+
+            entry = self._records.get(key)
+            if entry is not None and entry[1] > now:
+                return entry[0]
+            self._records[key] = (StoredResponse(fingerprint, None, None, None), expires_at)
+            return None
+
+    def complete(self, key, status, body, content_type, expires_at):
+        with self._lock:
+            if key not in self._records:
+                return
+            record = self._records[key][0]
+            self._records[key] = (
+                record._replace(status=status, body=body, content_type=content_type),
+                expires_at)
+
+    def release(self, key):
+        with self._lock:
+            self._records.pop(key, None)
+
+
+'''
+TableStore
+    keys in the idempotency_keys table, shared by every worker: the
+    primary key of the table lets one request claim a key at a time
+'''
+class TableStore(IdempotencyStore):
+    def __init__(self):
+        self._claims = 0
+
+    def claim(self, key, fingerprint, expires_at):
+        now = datetime.utcnow()
+        self._claims += 1
+        if self._claims % PURGE_EVERY == 0:
+            db.session.execute(
+                delete(IdempotencyRecord).where(IdempotencyRecord.expires_at <= now))
+            db.session.commit()
+
+        try:
+            db.session.execute(insert(IdempotencyRecord).values(
+                key=key, fingerprint=fingerprint, expires_at=expires_at))
+            db.session.commit()
+            return None
+        except exc.IntegrityError:
+            db.session.rollback()
+
+        row = db.session.execute(
+            select(IdempotencyRecord.fingerprint, IdempotencyRecord.status,
+                   IdempotencyRecord.body, IdempotencyRecord.content_type,
+                   IdempotencyRecord.expires_at)
+            .where(IdempotencyRecord.key == key)).first()
+        if row is not None and row.expires_at > now:
+            return StoredResponse(row.fingerprint, row.status, row.body, row.content_type)
+
+        # expired, take the key over unless another request just did
+        result = db.session.execute(
+            update(IdempotencyRecord)
+            .where(IdempotencyRecord.key == key, IdempotencyRecord.expires_at <= now)
+            .values(fingerprint=fingerprint, status=None, body=None,
+                    content_type=None, expires_at=expires_at))
+        db.session.commit()
+        if result.rowcount == 1:
+            return None
+        return self.claim(key, fingerprint, expires_at)
+
+    def complete(self, key, status, body, content_type, expires_at):
+        db.session.execute(
+            update(IdempotencyRecord).where(IdempotencyRecord.key == key)
+            .values(status=status, body=body, content_type=content_type,
+                    expires_at=expires_at))
+        db.session.commit()
+
+    def release(self, key):
+        db.session.rollback()
+        db.session.execute(delete(IdempotencyRecord).where(IdempotencyRecord.key == key))
+        db.session.commit()
+
+
+'''
+KeyLocks
+    one lock per key held by the requests of this worker, so concurrent
+    duplicates wait for each other instead of polling the store
+    hold() waits up to timeout seconds for the lock, forever by default,
+    and yields whether it got it
+'''
+class KeyLocks:
+    def __init__(self):
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def hold(self, key, timeout=-1):
+        with self._lock:
+            entry = self._locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+        acquired = entry[0].acquire(timeout=timeout)
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                entry[0].release()
+            with self._lock:
+                entry[1] -= 1
+                if entry[1] == 0:
+                    del self._locks[key]
+
+
+if IDEMPOTENCY_STORE == 'memory':
+    store = MemoryStore()
+else:
+    store = TableStore()
+
+key_locks = KeyLocks()
+replays = Counter()
+conflicts = Counter()
+
+registry.counter('idempotency_replays_total',
+                 'Requests answered with the stored response of their Idempotency-Key.',
+                 lambda: replays.value)
+registry.counter('idempotency_conflicts_total',
+                 'Requests refused because their Idempotency-Key was in use.',
+                 lambda: conflicts.value)
+
+'''
+scoped_key(key)
+    the key of the store for an Idempotency-Key: a digest of the key,
+    the client (sub of its token), the method and the path, so two
+    clients or two endpoints never share a key
+'''
+def scoped_key(key):
+    subject = g.get('current_user', {}).get('sub', '')
+    scope = '\n'.join((subject, request.method, request.path, key))
+    return hashlib.sha256(scope.encode()).hexdigest()
+
+'''
+claim(key, fingerprint)
+    claim key in the store, waiting up to IDEMPOTENCY_WAIT for another
+    worker running the same key
+    return the StoredResponse of the key, or None if this request runs
+'''
+def claim(key, fingerprint):
+    deadline = time.monotonic() + IDEMPOTENCY_WAIT
+    while True:
+        record = store.claim(key, fingerprint, datetime.utcnow() +
+                             timedelta(seconds=IDEMPOTENCY_LOCK_SECONDS))
+        if record is None or record.status is not None:
+            return record
+        if record.fingerprint != fingerprint or time.monotonic() >= deadline:
+            return record
+        time.sleep(POLL_INTERVAL)
+
+'''
+@idempotent
+    run the decorated endpoint once per Idempotency-Key header
+    - a request without the header runs as usual
+    - the response of the first request with a key is stored for
+      IDEMPOTENCY_TTL seconds and replayed, with an Idempotent-Replayed
+      header, to the retries sending the same key and body
+    - a key reused with another body is refused with 422, a key still
+      held by a running request with 409
+    - a request failing with an error (abort or exception) frees its
+      key, so it can be retried
+    it goes below requires_auth, keys are scoped to the client
+    EXAMPLE
+        @app.route('/actors', methods=['POST'])
+        @requires_auth('post:actors')
+        @idempotent
+        def add_actor(payload):
+'''
+def idempotent(f):
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get('Idempotency-Key')
+        if key is None:
+            return f(*args, **kwargs)
+        if not key or len(key) > MAX_KEY_LENGTH:
+            abort(400)
+
+        key = scoped_key(key)
+        fingerprint = hashlib.sha256(request.get_data()).hexdigest()
+        with key_locks.hold(key, IDEMPOTENCY_WAIT) as acquired:
+            if not acquired:
+                # a duplicate of this worker is still running
+                conflicts.inc()
+                abort(409)
+            record = claim(key, fingerprint)
+            if record is not None:
+                if record.fingerprint != fingerprint:
+                    abort(422)
+                if record.status is None:
+                    conflicts.inc()
+                    abort(409)
+                replays.inc()
+                response = Response(record.body, status=record.status,
+                                    content_type=record.content_type)
+                response.headers['Idempotent-Replayed'] = 'true'
+                return response
+
+            try:
+                response = make_response(f(*args, **kwargs))
+            except BaseException:
+                store.release(key)
+                raise
+            store.complete(key, response.status_code, response.get_data(),
+                           response.content_type,
+                           datetime.utcnow() + timedelta(seconds=IDEMPOTENCY_TTL))
+            return response
+
+    return wrapper
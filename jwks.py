@@ -0,0 +1,159 @@
+import json
+import threading
+import time
+from urllib.request import urlopen
+
+
+'''
+JWKSUnavailableError Exception
+raised when no signing keys have ever been loaded and the JWKS endpoint
+can not be reached
+'''
+class JWKSUnavailableError(Exception):
+    pass
+
+
+'''
+url_fetcher(url)
+    returns a fetcher that downloads the JWKS document from url
+    EXAMPLE
+        fetch = url_fetcher('https://example.auth0.com/.well-known/jwks.json')
+        jwks = fetch()
+'''
+def url_fetcher(url, timeout=5):
+    def fetch():
+        with urlopen(url, timeout=timeout) as response:
+            return json.loads(response.read())
+    return fetch
+
+
+'''
+file_fetcher(path)
+    returns a fetcher that reads the JWKS document from a local file,
+    useful for tests and local development without an identity provider
+'''
+def file_fetcher(path):
+    def fetch():
+        with open(path) as jwks_file:
+            return json.load(jwks_file)
+    return fetch
+
+
+'''
+JWKSCache
+    keeps the signing keys of the identity provider in memory
+
+    - keys are refetched once they are older than ttl seconds
+    - an unknown kid triggers an immediate refetch, but at most once
+      every min_refresh_interval seconds so forged kids can not cause
+      a refetch storm
+    - concurrent refreshes share a single fetch
+    - if the identity provider is unreachable the last-known-good keys
+      keep being served
+    - key_builder turns each jwk into the object returned by get_key
+      once per load, e.g. a constructed public key, instead of once per
+      request; jwks the builder rejects are skipped
+'''
+class JWKSCache:
+    def __init__(self, fetcher, ttl=600, min_refresh_interval=30,
+                 clock=time.monotonic, key_builder=None):
+        self.fetcher = fetcher
+        self.key_builder = key_builder
+        self.ttl = ttl
+        self.min_refresh_interval = min_refresh_interval
+        self.clock = clock
+        self.fetch_count = 0
+        self._keys = {}
+        self._loaded_at = None
+        self._attempted_at = None
+        self._lock = threading.Lock()
+        self._inflight = None
+
+    '''
+    get_key(kid)
+        return the key with the given kid, or None if the identity
+        provider does not know it
+    '''
+    def get_key(self, kid):
+        if self._is_stale():
+            self.refresh()
+        key = self._keys.get(kid)
+        if key is None:
+            if self._may_refresh():
+                self.refresh()
+            else:
+                # a fetch started by another request may still be loading
+                self.wait_for_refresh()
+            key = self._keys.get(kid)
+        if key is None and self._loaded_at is None:
+            raise JWKSUnavailableError('Signing keys could not be loaded.')
+        return key
+
+    '''
+    refresh()
+        fetch the key set, sharing the fetch with any concurrent callers
+    '''
+    def refresh(self):
+        with self._lock:
+            inflight = self._inflight
+            if inflight is None:
+                inflight = self._inflight = threading.Event()
+                leader = True
+            else:
+                leader = False
+
+        if not leader:
+            inflight.wait()
+            return
+
+        try:
+            self._attempted_at = self.clock()
+            self.fetch_count += 1
+            jwks = self.fetcher()
+            self.load(jwks)
+        except Exception:
+            # keep serving the last-known-good keys
+            pass
+        finally:
+            with self._lock:
+                self._inflight = None
+            inflight.set()
+
+    '''
+    wait_for_refresh()
+        wait for the fetch of a concurrent refresh(), if there is one
+    '''
+    def wait_for_refresh(self):
+        inflight = self._inflight
+        if inflight is not None:
+            inflight.wait()
+
+    '''
+    load(jwks)
+        replace the cached keys with the keys of a JWKS document
+    '''
+    def load(self, jwks):
+        keys = {}
+        for key in jwks['keys']:
+            if 'kid' not in key:
+                continue
+            if self.key_builder is None:
+                keys[key['kid']] = key
+                continue
+            try:
+                keys[key['kid']] = self.key_builder(key)
+            except Exception:
+                continue
+        self._keys = keys
+        self._loaded_at = self.clock()
+
+    def _is_stale(self):
+        if self._loaded_at is None:
+            return self._may_refresh()
+        expired = self.clock() - self._loaded_at >= self.ttl
+        return expired and self._may_refresh()
+
+    def _may_refresh(self):
+        if self._attempted_at is None:
+            return True
+        return self.clock() - self._attempted_at >= self.min_refresh_interval
@@ -0,0 +1,116 @@
+import threading
+
+'''
+a small in-process metrics registry rendered in the Prometheus text
+exposition format by the /metrics endpoint
+'''
+
+'''
+Counter
+    a monotonically increasing value
+'''
+class Counter:
+    def __init__(self):
+        self.value = 0
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+
+'''
+Histogram
+    counts observations, i.e. durations in seconds, into cumulative buckets
+'''
+class Histogram:
+    DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1,
+                       0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * len(self.buckets)
+        self.sum = 0.0
+        self.count = 0
+        self._lock = threading.Lock()
+
+    def observe(self, value):
+        with self._lock:
+            self.sum += value
+            self.count += 1
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[index] += 1
+                    break
+
+    def render(self, name, labels):
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets, self.counts):
+            cumulative += count
+            lines.append('{}_bucket{} {}'.format(
+                name, format_labels(dict(labels, le=bound)), cumulative))
+        lines.append('{}_bucket{} {}'.format(
+            name, format_labels(dict(labels, le='+Inf')), self.count))
+        lines.append('{}_sum{} {}'.format(name, format_labels(labels), self.sum))
+        lines.append('{}_count{} {}'.format(name, format_labels(labels), self.count))
+        return lines
+
+
+'''
+Registry
+    collects metric families from callbacks at render time, so values
+    owned by other objects (i.e. cache hit counters) are read when scraped
+'''
+class Registry:
+    def __init__(self):
+        self._collectors = []
+
+    '''
+    gauge(name, help, callback) / counter(name, help, callback)
+        register a metric whose value is read from callback()
+        callback may also return a list of (labels, value) pairs
+    '''
+    def gauge(self, name, help, callback):
+        self._collectors.append((name, 'gauge', help, callback))
+
+    def counter(self, name, help, callback):
+        self._collectors.append((name, 'counter', help, callback))
+
+    '''
+    histogram(name, help, callback)
+        register histograms, callback() returns a Histogram or a list
+        of (labels, Histogram) pairs
+    '''
+    def histogram(self, name, help, callback):
+        self._collectors.append((name, 'histogram', help, callback))
+
+    '''
+    render()
+        return every registered metric in the Prometheus text format
+    '''
+    def render(self):
+        lines = []
+        for name, kind, help, callback in self._collectors:
+            lines.append('# HELP {} {}'.format(name, help))
+            lines.append('# TYPE {} {}'.format(name, kind))
+            samples = callback()
+            if not isinstance(samples, list):
+                samples = [({}, samples)]
+            for labels, value in samples:
+                if kind == 'histogram':
+                    lines.extend(value.render(name, labels))
+                else:
+                    lines.append('{}{} {}'.format(name, format_labels(labels), value))
+        return '\n'.join(lines) + '\n'
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(key, str(value).replace('"', '\\"'))
+        for key, value in sorted(labels.items())) + '}'
+
+
+registry = Registry()
@@ -0,0 +1,55 @@
+"""add table versions
+
+Revision ID: 3c9a4e1f2b7d
+Revises: ffff3e6ed331
+Create Date: 2026-10-18 09:12:44.218305
+
+"""
+from datetime import datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3c9a4e1f2b7d'
+down_revision = 'ffff3e6ed331'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # actors and movies used to be created by db.create_all() only,
+    # create them here when missing so the migrations are self-contained
+    tables = sa.inspect(op.get_bind()).get_table_names()
+    if 'movies' not in tables:
+        op.create_table('movies',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('title', sa.String(), nullable=True),
+        sa.Column('release_date', sa.String(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+        )
+    if 'actors' not in tables:
+        op.create_table('actors',
+        sa.Column('id', sa.Integer(), nullable=False),
+        sa.Column('name', sa.String(), nullable=True),
+        sa.Column('age', sa.Integer(), nullable=True),
+        sa.Column('gender', sa.String(), nullable=True),
+        sa.PrimaryKeyConstraint('id')
+        )
+
+    table_versions = op.create_table('table_versions',
+    sa.Column('table_name', sa.String(), nullable=False),
+    sa.Column('version', sa.Integer(), nullable=False),
+    sa.Column('updated_at', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('table_name')
+    )
+    now = datetime.utcnow()
+    op.bulk_insert(table_versions, [
+        {'table_name': 'actors', 'version': 1, 'updated_at': now},
+        {'table_name': 'movies', 'version': 1, 'updated_at': now}
+    ])
+
+
+def downgrade():
+    op.drop_table('table_versions')
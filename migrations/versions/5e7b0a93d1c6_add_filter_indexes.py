@@ -0,0 +1,59 @@
+"""add filter indexes
+
+Revision ID: 5e7b0a93d1c6
+Revises: 8d2f61b0c4a9
+Create Date: 2026-10-18 11:20:05.734118
+
+"""
+from alembic import op
+
+
+# revision identifiers, used by Alembic.
+revision = '5e7b0a93d1c6'
+down_revision = '8d2f61b0c4a9'
+branch_labels = None
+depends_on = None
+
+# (name, table, column, postgres operator class) of the B-tree indexes,
+# text_pattern_ops lets Postgres serve LIKE 'prefix%' under any collation
+BTREE_INDEXES = [
+    ('ix_actors_name', 'actors', 'name', 'text_pattern_ops'),
+    ('ix_actors_age', 'actors', 'age', None),
+    ('ix_actors_gender', 'actors', 'gender', None),
+    ('ix_movies_title', 'movies', 'title', 'text_pattern_ops'),
+    ('ix_movies_release_date', 'movies', 'release_date', None)
+]
+# trigram indexes serving the ILIKE '%substring%' of the *_contains filters
+TRIGRAM_INDEXES = [
+    ('ix_actors_name_trgm', 'actors', 'name'),
+    ('ix_movies_title_trgm', 'movies', 'title')
+]
+
+
+def upgrade():
+    if op.get_bind().dialect.name != 'postgresql':
+        for name, table, column, _ in BTREE_INDEXES:
+            op.create_index(name, table, [column], unique=False)
+        return
+
+    # build the indexes without locking out writes on large tables,
+    # CONCURRENTLY can not run inside the migration transaction
+    with op.get_context().autocommit_block():
+        op.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+        for name, table, column, ops in BTREE_INDEXES:
+            op.create_index(name, table, [column], unique=False,
+                            postgresql_concurrently=True,
+                            postgresql_ops={column: ops} if ops else {})
+        for name, table, column in TRIGRAM_INDEXES:
+            op.create_index(name, table, [column], unique=False,
+                            postgresql_concurrently=True,
+                            postgresql_using='gin',
+                            postgresql_ops={column: 'gin_trgm_ops'})
+
+
+def downgrade():
+    if op.get_bind().dialect.name == 'postgresql':
+        for name, table, _ in TRIGRAM_INDEXES:
+            op.drop_index(name, table_name=table)
+    for name, table, _, _ in BTREE_INDEXES:
+        op.drop_index(name, table_name=table)
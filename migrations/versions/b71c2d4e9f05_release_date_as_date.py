@@ -0,0 +1,116 @@
+"""release date as date
+
+Revision ID: b71c2d4e9f05
+Revises: 5e7b0a93d1c6
+Create Date: 2026-10-18 12:41:37.102496
+
+"""
+import logging
+import re
+from datetime import date, datetime
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b71c2d4e9f05'
+down_revision = '5e7b0a93d1c6'
+branch_labels = None
+depends_on = None
+
+# rows read and converted per round trip
+BATCH_SIZE = 1000
+# the dates the API stored, YYYY-MM-DD with or without zero padding
+DATE_PATTERN = re.compile(r'(\d{4})-(\d{1,2})-(\d{1,2})')
+
+logger = logging.getLogger('alembic.runtime.migration')
+
+movies = sa.table('movies',
+    sa.column('id', sa.Integer),
+    sa.column('release_date', sa.String),
+    sa.column('release_date_new', sa.Date))
+
+table_versions = sa.table('table_versions',
+    sa.column('table_name', sa.String),
+    sa.column('version', sa.Integer),
+    sa.column('updated_at', sa.DateTime))
+
+
+def parse(value):
+    match = DATE_PATTERN.fullmatch(value.strip())
+    if match is None:
+        raise ValueError(value)
+    return date(*(int(part) for part in match.groups()))
+
+
+def bump_movies_version(bind):
+    # every release date is rewritten, the ETags and cached bodies of
+    # the movies served before the migration must not match any more
+    now = datetime.utcnow()
+    result = bind.execute(
+        sa.update(table_versions)
+        .where(table_versions.c.table_name == 'movies')
+        .values(version=table_versions.c.version + 1, updated_at=now))
+    if result.rowcount == 0:
+        bind.execute(sa.insert(table_versions).values(
+            table_name='movies', version=1, updated_at=now))
+
+
+def upgrade():
+    bind = op.get_bind()
+    op.add_column('movies', sa.Column('release_date_new', sa.Date(), nullable=True))
+
+    # convert the strings in keyset batches, so neither the table nor the
+    # updates have to be held in memory at once; rows that can not be
+    # parsed are reported and left without a release date
+    update = (sa.update(movies)
+              .where(movies.c.id == sa.bindparam('movie_id'))
+              .values(release_date_new=sa.bindparam('parsed')))
+    unparseable = []
+    converted = 0
+    last_id = 0
+    while True:
+        rows = bind.execute(
+            sa.select(movies.c.id, movies.c.release_date)
+            .where(movies.c.id > last_id)
+            .order_by(movies.c.id)
+            .limit(BATCH_SIZE)).all()
+        if not rows:
+            break
+        last_id = rows[-1].id
+
+        batch = []
+        for movie_id, value in rows:
+            if value is None:
+                continue
+            try:
+                batch.append({'movie_id': movie_id, 'parsed': parse(str(value))})
+            except ValueError:
+                unparseable.append((movie_id, value))
+        if batch:
+            bind.execute(update, batch)
+            converted += len(batch)
+
+    logger.info('converted the release date of %d movies', converted)
+    for movie_id, value in unparseable:
+        logger.warning('movie %d: unparseable release date %r, set to NULL',
+                       movie_id, value)
+    if unparseable:
+        logger.warning('%d release dates could not be parsed', len(unparseable))
+
+    op.drop_index('ix_movies_release_date', table_name='movies')
+    op.drop_column('movies', 'release_date')
+    op.alter_column('movies', 'release_date_new', new_column_name='release_date')
+    op.create_index('ix_movies_release_date', 'movies', ['release_date'], unique=False)
+    bump_movies_version(bind)
+
+
+def downgrade():
+    op.add_column('movies', sa.Column('release_date_old', sa.String(), nullable=True))
+    op.execute('UPDATE movies SET release_date_old = CAST(release_date AS VARCHAR)')
+    op.drop_index('ix_movies_release_date', table_name='movies')
+    op.drop_column('movies', 'release_date')
+    op.alter_column('movies', 'release_date_old', new_column_name='release_date')
+    op.create_index('ix_movies_release_date', 'movies', ['release_date'], unique=False)
+    bump_movies_version(op.get_bind())
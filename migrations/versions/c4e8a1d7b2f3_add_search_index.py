@@ -0,0 +1,93 @@
+"""add search index
+
+Revision ID: c4e8a1d7b2f3
+Revises: b71c2d4e9f05
+Create Date: 2026-10-18 14:05:52.610337
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c4e8a1d7b2f3'
+down_revision = 'b71c2d4e9f05'
+branch_labels = None
+depends_on = None
+
+# the searched text column of each table
+SEARCH_COLUMNS = [('actors', 'name'), ('movies', 'title')]
+# rows whose search_vector is filled per transaction on Postgres
+BATCH_SIZE = 1000
+
+
+def upgrade():
+    bind = op.get_bind()
+    dialect = bind.dialect.name
+    if dialect == 'postgresql':
+        # a generated column would rewrite the tables under an ACCESS
+        # EXCLUSIVE lock, keep the tables writable instead: a plain
+        # nullable column (no rewrite), a trigger filling it for the new
+        # writes, a backfill in short transactions, then the GIN index
+        for table, column in SEARCH_COLUMNS:
+            op.execute('ALTER TABLE {} ADD COLUMN search_vector tsvector'.format(table))
+            op.execute(
+                "CREATE TRIGGER {0}_search_vector_update BEFORE INSERT OR UPDATE OF {1} "
+                "ON {0} FOR EACH ROW EXECUTE PROCEDURE "
+                "tsvector_update_trigger(search_vector, 'pg_catalog.simple', {1})"
+                .format(table, column))
+
+        with op.get_context().autocommit_block():
+            for table, column in SEARCH_COLUMNS:
+                backfill = sa.text(
+                    "UPDATE {0} SET search_vector = to_tsvector('simple', coalesce({1}, '')) "
+                    "WHERE id IN (SELECT id FROM {0} WHERE id > :last_id "
+                    "ORDER BY id LIMIT :limit) RETURNING id".format(table, column))
+                last_id = 0
+                while True:
+                    ids = [row.id for row in bind.execute(
+                        backfill, {'last_id': last_id, 'limit': BATCH_SIZE})]
+                    if not ids:
+                        break
+                    last_id = max(ids)
+            # CONCURRENTLY can not run inside the migration transaction
+            for table, _ in SEARCH_COLUMNS:
+                op.execute('CREATE INDEX CONCURRENTLY ix_{0}_search_vector '
+                           'ON {0} USING gin (search_vector)'.format(table))
+
+    elif dialect == 'sqlite':
+        for table, column in SEARCH_COLUMNS:
+            op.execute(
+                "CREATE VIRTUAL TABLE {0}_fts USING fts5("
+                "{1}, content='{0}', content_rowid='id', "
+                "tokenize='unicode61 remove_diacritics 2')".format(table, column))
+            op.execute(
+                "CREATE TRIGGER {0}_fts_insert AFTER INSERT ON {0} BEGIN "
+                "INSERT INTO {0}_fts(rowid, {1}) VALUES (new.id, new.{1}); END"
+                .format(table, column))
+            op.execute(
+                "CREATE TRIGGER {0}_fts_delete AFTER DELETE ON {0} BEGIN "
+                "INSERT INTO {0}_fts({0}_fts, rowid, {1}) VALUES ('delete', old.id, old.{1}); END"
+                .format(table, column))
+            op.execute(
+                "CREATE TRIGGER {0}_fts_update AFTER UPDATE OF {1} ON {0} BEGIN "
+                "INSERT INTO {0}_fts({0}_fts, rowid, {1}) VALUES ('delete', old.id, old.{1}); "
+                "INSERT INTO {0}_fts(rowid, {1}) VALUES (new.id, new.{1}); END"
+                .format(table, column))
+            # index the rows already in the table
+            op.execute("INSERT INTO {0}_fts({0}_fts) VALUES ('rebuild')".format(table))
+
+
+def downgrade():
+    dialect = op.get_bind().dialect.name
+    if dialect == 'postgresql':
+        for table, _ in SEARCH_COLUMNS:
+            op.execute('DROP INDEX IF EXISTS ix_{}_search_vector'.format(table))
+            op.execute('DROP TRIGGER IF EXISTS {0}_search_vector_update ON {0}'.format(table))
+            op.drop_column(table, 'search_vector')
+
+    elif dialect == 'sqlite':
+        for table, _ in SEARCH_COLUMNS:
+            for trigger in ('insert', 'delete', 'update'):
+                op.execute('DROP TRIGGER IF EXISTS {}_fts_{}'.format(table, trigger))
+            op.execute('DROP TABLE IF EXISTS {}_fts'.format(table))
@@ -17,10 +17,12 @@ depends_on = None
 
 
 def upgrade():
-    # ### commands auto generated by Alembic - please adjust! ###
-    op.drop_table('Movies')
-    op.drop_table('Actors')
-    # ### end Alembic commands ###
+    # the tables of the first schema only exist on the databases created
+    # before this revision, a fresh database has nothing to drop
+    inspector = sa.inspect(op.get_bind())
+    for table in ('Movies', 'Actors'):
+        if inspector.has_table(table):
+            op.drop_table(table)
 
 
 def downgrade():
@@ -1,48 +1,732 @@
 import os
-from sqlalchemy import Column, String, Integer
+import re
+import time
+import logging
+import sqlite3
+import weakref
+from collections import deque
+from datetime import date, datetime
+from sqlalchemy import (DDL, Column, String, Integer, delete, event, insert,
+                        select, update)
+from sqlalchemy.engine import Engine
+from sqlalchemy import orm
+from sqlalchemy.orm import validates
+from sqlalchemy.pool import QueuePool
+from flask import g, has_request_context, request
 from flask_sqlalchemy import SQLAlchemy
 import json
 
-database_path = os.environ['DATABASE_URL']
-if database_path.startswith("postgres://"):
-  database_path = database_path.replace("postgres://", "postgresql://", 1)
+from metrics import Counter, Histogram, registry
+from replicas import RoutingSession, note_request_write, replica_router
+from timing import native_timer, record_statement
 
-db = SQLAlchemy()
+'''
+database_url(name='DATABASE_URL')
+    return the database url of an environment variable, read when an
+    app is set up rather than when this module is imported
+    the postgres:// scheme of Heroku is renamed postgresql://
+'''
+def database_url(name='DATABASE_URL'):
+    return postgresql_scheme(os.environ[name])
+
+'''
+replica_urls(name='DATABASE_REPLICA_URLS')
+    return the comma separated database urls of the read replicas,
+    an empty list when the variable is not set
+'''
+def replica_urls(name='DATABASE_REPLICA_URLS'):
+    return [postgresql_scheme(url.strip())
+            for url in os.environ.get(name, '').split(',') if url.strip()]
+
+def postgresql_scheme(url):
+    if url.startswith("postgres://"):
+        url = url.replace("postgres://", "postgresql://", 1)
+    return url
+
+# connection pool of each worker, see engine_options()
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+DB_POOL_TIMEOUT = float(os.environ.get('DB_POOL_TIMEOUT', 30))
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+DB_POOL_PRE_PING = os.environ.get('DB_POOL_PRE_PING', 'true').lower() == 'true'
+# server-side statement timeout in milliseconds (Postgres), 0 disables it
+DB_STATEMENT_TIMEOUT = int(os.environ.get('DB_STATEMENT_TIMEOUT', 0))
+
+# diagnostics of the SQL layer, see QueryDiagnostics
+DB_DIAGNOSTICS = os.environ.get('DB_DIAGNOSTICS', 'false').lower() == 'true'
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS', 100))
+N_PLUS_ONE_THRESHOLD = int(os.environ.get('N_PLUS_ONE_THRESHOLD', 5))
+# ids per statement of the bulk writes, under the 999 bound parameters
+# of older SQLite builds
+BULK_WRITE_BATCH = 500
 
 '''
-setup_db(app)
+Database
+    the flask-sqlalchemy extension, keeping track of the engines it
+    creates so they can be reset in forked workers, with sessions
+    sending read-only requests to the replicas, see replicas.py
+'''
+engines = weakref.WeakSet()
+
+class Database(SQLAlchemy):
+    def create_engine(self, sa_url, engine_opts):
+        engine = super().create_engine(sa_url, engine_opts)
+        engines.add(engine)
+        return engine
+
+    def create_session(self, options):
+        return orm.sessionmaker(class_=RoutingSession, db=self, **options)
+
+
+db = Database()
+
+'''
+a worker forked from a process that already used the database, i.e.
+gunicorn --preload, must not share its connections: the child drops
+the pooled connections without closing them, they belong to the parent
+the old pool is replaced rather than disposed, engine.dispose(close=False)
+does the same but needs SQLAlchemy 1.4.33
+'''
+def reset_engines_after_fork():
+    for engine in list(engines):
+        engine.pool = engine.pool.recreate()
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reset_engines_after_fork)
+
+'''
+TimedQueuePool
+    a QueuePool that records how long each checkout waited for a
+    connection, and keeps track of its instances for the saturation gauge
+'''
+pool_checkout_wait = Histogram()
+pools = weakref.WeakSet()
+
+class TimedQueuePool(QueuePool):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        pools.add(self)
+
+    def _do_get(self):
+        start = time.perf_counter()
+        try:
+            return super()._do_get()
+        finally:
+            pool_checkout_wait.observe(time.perf_counter() - start)
+
+    def recreate(self):
+        pool = super().recreate()
+        pools.add(pool)
+        return pool
+
+'''
+pool_saturation()
+    return the share of the connections the pools may open that are
+    checked out, 1.0 means requests are waiting for connections
+'''
+def pool_saturation():
+    capacity = sum(pool.size() + max(pool._max_overflow, 0) for pool in pools)
+    if not capacity:
+        return 0.0
+    return sum(pool.checkedout() for pool in pools) / capacity
+
+registry.histogram('db_pool_checkout_wait_seconds',
+                   'Time spent waiting for a database connection.',
+                   lambda: pool_checkout_wait)
+registry.gauge('db_pool_checked_out',
+               'Database connections checked out of the pool.',
+               lambda: sum(pool.checkedout() for pool in pools))
+registry.gauge('db_pool_saturation',
+               'Checked out connections over pool size plus overflow.',
+               pool_saturation)
+
+'''
+engine_options(database_path)
+    return the SQLAlchemy engine options read from the environment:
+    DB_POOL_SIZE, DB_MAX_OVERFLOW, DB_POOL_TIMEOUT, DB_POOL_RECYCLE,
+    DB_POOL_PRE_PING and DB_STATEMENT_TIMEOUT
+    SQLite keeps its default pool, it does not take the sizing options
+'''
+def engine_options(database_path):
+    options = {
+        'pool_pre_ping': DB_POOL_PRE_PING,
+        'pool_recycle': DB_POOL_RECYCLE
+    }
+    if database_path.startswith('sqlite'):
+        return options
+
+    options.update({
+        'poolclass': TimedQueuePool,
+        'pool_size': DB_POOL_SIZE,
+        'max_overflow': DB_MAX_OVERFLOW,
+        'pool_timeout': DB_POOL_TIMEOUT
+    })
+    if DB_STATEMENT_TIMEOUT and database_path.startswith('postgresql'):
+        options['connect_args'] = {
+            'options': '-c statement_timeout={}'.format(DB_STATEMENT_TIMEOUT)
+        }
+    return options
+
+'''
+SQLite only enforces foreign keys, i.e. the ON DELETE CASCADE of
+movie_actors, when asked to on every connection
+'''
+@event.listens_for(Engine, 'connect')
+def enable_sqlite_foreign_keys(dbapi_connection, connection_record):
+    if isinstance(dbapi_connection, sqlite3.Connection):
+        cursor = dbapi_connection.cursor()
+        cursor.execute('PRAGMA foreign_keys=ON')
+        cursor.close()
+
+'''
+QueryDiagnostics
+    a diagnostics mode of the SQL layer, off unless DB_DIAGNOSTICS=true
+    - statements slower than slow_query_ms are logged with their
+      parameters and the route that issued them
+    - requests running the same statement shape more than
+      n_plus_one_threshold times are flagged as a likely N+1
+    every finding is logged on the capstone.queries logger and kept in
+    reports, the latest MAX_REPORTS of them, so tests can assert on them
+    EXAMPLE
+        query_diagnostics.enabled = True
+        client.get('/movies')
+        query_diagnostics.reports_of('n_plus_one')
+'''
+class QueryDiagnostics:
+    MAX_REPORTS = 1000
+    # a run of placeholders, i.e. the expanded IN (?, ?, ?) of a list
+    PLACEHOLDERS = re.compile(
+        r'(\?|%s|%\(\w+\)s|:\w+)(\s*,\s*(\?|%s|%\(\w+\)s|:\w+))+')
+
+    def __init__(self, enabled=DB_DIAGNOSTICS, slow_query_ms=SLOW_QUERY_MS,
+                 n_plus_one_threshold=N_PLUS_ONE_THRESHOLD):
+        self.enabled = enabled
+        self.slow_query_ms = slow_query_ms
+        self.n_plus_one_threshold = n_plus_one_threshold
+        self.reports = deque(maxlen=self.MAX_REPORTS)
+        self.slow_queries = Counter()
+        self.n_plus_ones = Counter()
+        self.logger = logging.getLogger('capstone.queries')
+
+    '''
+    shape(statement)
+        the statement with whitespace and placeholder lists collapsed,
+        so the same query with different parameters has one shape
+    '''
+    @classmethod
+    def shape(cls, statement):
+        return cls.PLACEHOLDERS.sub(r'\1', ' '.join(statement.split()))
+
+    def statement(self, statement, parameters, seconds):
+        if not self.enabled:
+            return
+        route, method = self._route()
+        if has_request_context():
+            shapes = g.setdefault('statement_shapes', {})
+            shape = self.shape(statement)
+            shapes[shape] = shapes.get(shape, 0) + 1
+
+        duration_ms = seconds * 1000
+        if duration_ms >= self.slow_query_ms:
+            self.slow_queries.inc()
+            self._report({
+                'type': 'slow_query',
+                'route': route,
+                'method': method,
+                'statement': statement,
+                'parameters': repr(parameters)[:500],
+                'duration_ms': round(duration_ms, 3)
+            }, 'slow query (%.1fms) on %s %s: %s %s', duration_ms, method, route,
+                statement, repr(parameters)[:500])
+
+    '''
+    finish_request()
+        flag the statement shapes the request ran too many times
+    '''
+    def finish_request(self, error=None):
+        shapes = g.pop('statement_shapes', None)
+        if not self.enabled or not shapes:
+            return
+        route, method = self._route()
+        for shape, count in shapes.items():
+            if count > self.n_plus_one_threshold:
+                self.n_plus_ones.inc()
+                self._report({
+                    'type': 'n_plus_one',
+                    'route': route,
+                    'method': method,
+                    'statement': shape,
+                    'count': count
+                }, 'possible N+1 on %s %s: %d runs of %s', method, route, count, shape)
+
+    def reports_of(self, kind):
+        return [report for report in self.reports if report['type'] == kind]
+
+    def clear(self):
+        self.reports.clear()
+
+    def _report(self, report, message, *args):
+        self.reports.append(report)
+        self.logger.warning(message, *args)
+
+    @staticmethod
+    def _route():
+        if not has_request_context():
+            timer = native_timer.get()
+            return (timer.route, timer.method) if timer is not None else (None, None)
+        return (request.url_rule.rule if request.url_rule else request.path,
+                request.method)
+
+
+query_diagnostics = QueryDiagnostics()
+
+registry.counter('db_slow_queries_total',
+                 'Statements slower than SLOW_QUERY_MS, with DB_DIAGNOSTICS on.',
+                 lambda: query_diagnostics.slow_queries.value)
+registry.counter('db_n_plus_one_total',
+                 'Requests repeating a statement more than N_PLUS_ONE_THRESHOLD times.',
+                 lambda: query_diagnostics.n_plus_ones.value)
+
+'''
+time every SQL statement of every engine and add it to the db phase of
+the current request, see timing.py, and to the query diagnostics
+the start times are a stack on the connection, a statement failing
+drops its start in handle_error
+'''
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_statement_timer(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault('statement_start', []).append(time.perf_counter())
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def stop_statement_timer(conn, cursor, statement, parameters, context, executemany):
+    elapsed = time.perf_counter() - conn.info['statement_start'].pop()
+    record_statement(elapsed)
+    query_diagnostics.statement(statement, parameters, elapsed)
+
+@event.listens_for(Engine, 'handle_error')
+def drop_statement_timer(exception_context):
+    starts = exception_context.connection.info.get('statement_start') \
+        if exception_context.connection is not None else None
+    if starts:
+        starts.pop()
+
+'''
+setup_db(app, database_path=None, create_tables=False, replica_paths=None)
     binds a flask application and a SQLAlchemy service
+    and checks the statements of each request with the query diagnostics
+    database_path defaults to DATABASE_URL, replica_paths, the read
+    replicas, to DATABASE_REPLICA_URLS
+    nothing connects to the database until the first query: the schema
+    is created by the migrations, create_tables=True creates the tables
+    of a throwaway database directly
 '''
-def setup_db(app, database_path=database_path):
+def setup_db(app, database_path=None, create_tables=False, replica_paths=None):
+    if database_path is None:
+        database_path = database_url()
+    if replica_paths is None:
+        replica_paths = replica_urls()
     app.config["SQLALCHEMY_DATABASE_URI"] = database_path
+    app.config["SQLALCHEMY_BINDS"] = {
+        'replica_{}'.format(index): path for index, path in enumerate(replica_paths)}
+    replica_router.configure(app.config["SQLALCHEMY_BINDS"])
     app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = engine_options(database_path)
     db.app = app
     db.init_app(app)
-    db.create_all()
+    if 'query_diagnostics' not in app.extensions:
+        app.extensions['query_diagnostics'] = query_diagnostics
+        app.teardown_request(query_diagnostics.finish_request)
+    if create_tables:
+        db.create_all()
+
+'''
+serialize_row(fields, row)
+    return a row in json form, shared by the models and the list endpoints
+    row can be a plain tuple selected with the Core, so no model
+    instance has to be built just to serialize it
+    EXAMPLE
+        serialize_row(('id', 'name'), (1, 'Tony'))
+    dates are written as ISO strings (YYYY-MM-DD)
+'''
+def serialize_row(fields, row):
+    return {field: value.isoformat() if isinstance(value, date) else value
+            for field, value in zip(fields, row)}
+
+'''
+serialize_values(row)
+    return the values of a row in json form, in the order of its
+    columns, the rows of the columnar list responses
+    EXAMPLE
+        serialize_values((1, date(2022, 1, 1))) == [1, '2022-01-01']
+'''
+def serialize_values(row):
+    return [value.isoformat() if isinstance(value, date) else value for value in row]
+
+'''
+parse_date(value)
+    parse a date sent to the API, an ISO date (YYYY-MM-DD) or the
+    unpadded form the API used to store (YYYY-M-D)
+    it should raise a ValueError if value is not such a date
+    EXAMPLE
+        parse_date('2022-1-1') == date(2022, 1, 1)
+'''
+DATE_PATTERN = re.compile(r'(\d{4})-(\d{1,2})-(\d{1,2})')
+
+def parse_date(value):
+    if isinstance(value, date):
+        return value
+    match = DATE_PATTERN.fullmatch(value) if isinstance(value, str) else None
+    if match is None:
+        raise ValueError('expected a date as YYYY-MM-DD')
+    return date(*(int(part) for part in match.groups()))
+
+'''
+TableVersion
+    a per-table version and updated-at watermark, bumped in the same
+    transaction as every insert(), update() and delete() of the table
+    the list endpoints build their ETag / Last-Modified from it, so an
+    unchanged poll costs one primary key lookup
+'''
+class TableVersion(db.Model):
+    __tablename__ = 'table_versions'
+
+    table_name = Column(String, primary_key=True)
+    version = Column(Integer, nullable=False, default=0)
+    updated_at = Column(db.DateTime, nullable=False)
+
+'''
+IdempotencyRecord
+    the stored response of a request sent with an Idempotency-Key, see
+    idempotency.py; status is None while the first request is running
+'''
+class IdempotencyRecord(db.Model):
+    __tablename__ = 'idempotency_keys'
+
+    key = Column(String(64), primary_key=True)
+    fingerprint = Column(String(64), nullable=False)
+    status = Column(Integer)
+    body = Column(db.LargeBinary)
+    content_type = Column(String)
+    expires_at = Column(db.DateTime, nullable=False, index=True)
+
+'''
+bump_version(table_name)
+    increment the version of a table in the current transaction
+    it should be called before the commit of every write to the table
+'''
+def bump_version(table_name):
+    now = datetime.utcnow()
+    result = db.session.execute(
+        update(TableVersion.__table__)
+        .where(TableVersion.table_name == table_name)
+        .values(version=TableVersion.version + 1, updated_at=now))
+    if result.rowcount == 0:
+        db.session.add(
+            TableVersion(table_name=table_name, version=1, updated_at=now))
+
+'''
+on_write(listener)
+    register listener(table_name) to be called after every committed
+    insert(), update() and delete(), i.e. to invalidate caches
+'''
+write_listeners = []
+
+def on_write(listener):
+    write_listeners.append(listener)
+    return listener
+
+# a client reads its own writes from the primary for a while
+on_write(note_request_write)
+
+def notify_write(table_name):
+    for listener in write_listeners:
+        listener(table_name)
+
+'''
+get_version(table_name)
+    return (version, updated_at) of a table, (0, None) if it was never written
+'''
+def get_version(table_name):
+    row = db.session.execute(
+        select(TableVersion.version, TableVersion.updated_at)
+        .where(TableVersion.table_name == table_name)).first()
+    if row is None:
+        return 0, None
+    return row.version, row.updated_at
+
+'''
+bulk_insert(model, rows)
+    insert many rows of model with a single executemany in one transaction
+    rows are dicts of column values, validated beforehand
+    EXAMPLE
+        bulk_insert(Actor, [{'name': 'Tony', 'age': 40, 'gender': 'male'}])
+'''
+def bulk_insert(model, rows):
+    try:
+        db.session.execute(insert(model.__table__), rows)
+        bump_version(model.__tablename__)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    notify_write(model.__tablename__)
+
+'''
+bulk_update(model, condition, values) / bulk_delete(model, condition)
+    update or delete every row of model matching condition, a where
+    clause or a list of ids, with set-based statements, i.e.
+    UPDATE ... WHERE id IN (...) RETURNING id
+    a list of ids is written BULK_WRITE_BATCH ids per statement
+    return the ids of the matched rows
+    databases without UPDATE/DELETE ... RETURNING first select the
+    matching ids in the same transaction, then write them in batches
+    of BULK_WRITE_BATCH ids
+    EXAMPLE
+        bulk_delete(Actor, [1, 2, 3])
+        bulk_update(Actor, Actor.gender == 'male', {'age': 30})
+'''
+def bulk_update(model, condition, values):
+    return _bulk_write(model, update(model.__table__).values(**values), condition)
+
+def bulk_delete(model, condition):
+    return _bulk_write(model, delete(model.__table__), condition)
+
+def _id_batches(id_column, ids):
+    return [id_column.in_(ids[start:start + BULK_WRITE_BATCH])
+            for start in range(0, len(ids), BULK_WRITE_BATCH)]
+
+def _bulk_write(model, statement, condition):
+    id_column = model.__table__.c.id
+    if isinstance(condition, list):
+        conditions = _id_batches(id_column, condition)
+    else:
+        conditions = [condition]
+    ids = []
+    try:
+        for condition in conditions:
+            if db.engine.dialect.full_returning:
+                result = db.session.execute(
+                    statement.where(condition).returning(id_column))
+                ids.extend(row.id for row in result)
+            else:
+                matched = [row.id for row in db.session.execute(
+                    select(id_column).where(condition).with_for_update())]
+                for batch in _id_batches(id_column, matched):
+                    db.session.execute(statement.where(batch))
+                ids.extend(matched)
+        if ids:
+            bump_version(model.__tablename__)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    if ids:
+        notify_write(model.__tablename__)
+    return ids
+
+'''
+validate_fields(data, spec, partial)
+    check a json object against spec, a dict of field name to
+    (accepted types, required) and optionally a parser of the value,
+    whose ValueError is reported as the error of the field
+    with partial=True only the fields present in data are checked and
+    returned, as for a PATCH
+    return (values, errors), errors maps field names to messages
+'''
+def validate_fields(data, spec, partial=False):
+    if not isinstance(data, dict):
+        return {}, {'_': 'expected an object'}
+
+    values = {}
+    errors = {}
+    for name, (types, required, *parser) in spec.items():
+        if partial and name not in data:
+            continue
+        value = data.get(name)
+        if value is None:
+            if required:
+                errors[name] = 'is required'
+            else:
+                values[name] = None
+        elif isinstance(value, bool) or not isinstance(value, types):
+            errors[name] = 'must be of type {}'.format(
+                ' or '.join(t.__name__ for t in types))
+        elif parser:
+            try:
+                values[name] = parser[0](value)
+            except ValueError as error:
+                errors[name] = str(error)
+        else:
+            values[name] = value
+    for name in data:
+        if name not in spec:
+            errors[name] = 'is not a field'
+    return values, errors
+
+'''
+movie_actors
+    the cast of the movies, associating movies and actors many-to-many
+    rows are removed with their movie or actor (ON DELETE CASCADE)
+'''
+movie_actors = db.Table('movie_actors',
+    Column('movie_id', Integer,
+           db.ForeignKey('movies.id', ondelete='CASCADE'), primary_key=True),
+    Column('actor_id', Integer,
+           db.ForeignKey('actors.id', ondelete='CASCADE'), primary_key=True),
+    db.Index('ix_movie_actors_actor_id', 'actor_id'))
+
+'''
+link_actors(movie_id, actor_ids) / unlink_actors(movie_id, actor_ids)
+    add actors to or remove actors from the cast of a movie with one
+    set-based statement
+    link_actors returns (linked, missing), the ids of the actors now in
+    the cast and the requested ids that are not actors
+    unlink_actors returns the ids of the actors removed from the cast
+'''
+def link_actors(movie_id, actor_ids):
+    actor_id = Actor.__table__.c.id
+    try:
+        existing = set(db.session.execute(
+            select(actor_id).where(actor_id.in_(actor_ids))).scalars())
+        linked = set(db.session.execute(
+            select(movie_actors.c.actor_id).where(
+                movie_actors.c.movie_id == movie_id,
+                movie_actors.c.actor_id.in_(existing))).scalars())
+        new_links = sorted(existing - linked)
+        if new_links:
+            db.session.execute(insert(movie_actors), [
+                {'movie_id': movie_id, 'actor_id': id} for id in new_links])
+            _bump_cast_versions()
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    if new_links:
+        _notify_cast_write()
+    return sorted(existing), sorted(set(actor_ids) - existing)
+
+def unlink_actors(movie_id, actor_ids):
+    condition = (movie_actors.c.movie_id == movie_id) & movie_actors.c.actor_id.in_(actor_ids)
+    try:
+        removed = sorted(db.session.execute(
+            select(movie_actors.c.actor_id).where(condition)).scalars())
+        if removed:
+            db.session.execute(delete(movie_actors).where(condition))
+            _bump_cast_versions()
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    if removed:
+        _notify_cast_write()
+    return removed
+
+def _bump_cast_versions():
+    bump_version('movies')
+    bump_version('actors')
+
+def _notify_cast_write():
+    notify_write('movies')
+    notify_write('actors')
+
+'''
+add_search_index(table, column)
+    keep a full-text index of one text column of table, created and
+    dropped with the table by create_all() / drop_all()
+    - Postgres: a tsvector column, search_vector, filled by a trigger and
+      with a GIN index
+    - SQLite: an external content FTS5 table, <table>_fts, kept in sync
+      by triggers
+    the migrations create the same objects in existing databases
+'''
+def add_search_index(table, column):
+    name = table.name
+    postgresql = [
+        "ALTER TABLE {0} ADD COLUMN search_vector tsvector",
+        "CREATE TRIGGER {0}_search_vector_update BEFORE INSERT OR UPDATE OF {1} "
+        "ON {0} FOR EACH ROW EXECUTE PROCEDURE "
+        "tsvector_update_trigger(search_vector, 'pg_catalog.simple', {1})",
+        "CREATE INDEX ix_{0}_search_vector ON {0} USING gin (search_vector)"
+    ]
+    sqlite = [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS {0}_fts USING fts5("
+        "{1}, content='{0}', content_rowid='id', "
+        "tokenize='unicode61 remove_diacritics 2')",
+        "CREATE TRIGGER IF NOT EXISTS {0}_fts_insert AFTER INSERT ON {0} BEGIN "
+        "INSERT INTO {0}_fts(rowid, {1}) VALUES (new.id, new.{1}); END",
+        "CREATE TRIGGER IF NOT EXISTS {0}_fts_delete AFTER DELETE ON {0} BEGIN "
+        "INSERT INTO {0}_fts({0}_fts, rowid, {1}) VALUES ('delete', old.id, old.{1}); END",
+        "CREATE TRIGGER IF NOT EXISTS {0}_fts_update AFTER UPDATE OF {1} ON {0} BEGIN "
+        "INSERT INTO {0}_fts({0}_fts, rowid, {1}) VALUES ('delete', old.id, old.{1}); "
+        "INSERT INTO {0}_fts(rowid, {1}) VALUES (new.id, new.{1}); END",
+        "INSERT INTO {0}_fts({0}_fts) VALUES ('rebuild')"
+    ]
+    for statement in postgresql:
+        event.listen(table, 'after_create', DDL(
+            statement.format(name, column)).execute_if(dialect='postgresql'))
+    for statement in sqlite:
+        event.listen(table, 'after_create', DDL(
+            statement.format(name, column)).execute_if(dialect='sqlite'))
+    # the triggers are dropped with the table, the FTS table is not
+    event.listen(table, 'before_drop', DDL(
+        'DROP TABLE IF EXISTS {}_fts'.format(name)).execute_if(dialect='sqlite'))
 
 '''
 Movies with attributes title and release date
 '''
 class Movie(db.Model):
     __tablename__ = 'movies'
+    # columns in the order they are serialized
+    FIELDS = ('id', 'title', 'release_date')
+    # ?include= names, mapped to the relationship they embed
+    INCLUDES = {'cast': 'actors'}
+    # filter parameters of the list endpoints, mapped to (column, operator)
+    FILTERS = {
+        'title_prefix': ('title', 'prefix'),
+        'title_contains': ('title', 'contains'),
+        'release_from': ('release_date', 'min'),
+        'release_to': ('release_date', 'max')
+    }
+    # text column of the full-text index searched by /search
+    SEARCH = 'title'
+    # B-tree indexes backing the filters, the trigram index used by
+    # title_contains is Postgres only and created by the migrations
+    __table_args__ = (
+        db.Index('ix_movies_title', 'title',
+                 postgresql_ops={'title': 'text_pattern_ops'}),
+        db.Index('ix_movies_release_date', 'release_date'),
+    )
+    # accepted types of the writable fields, and whether they are required
+    SPEC = {
+        'title': ((str,), True),
+        'release_date': ((str,), True, parse_date)
+    }
 
     id = Column(db.Integer, primary_key=True)
     title = Column(db.String)
-    release_date = Column(db.String)
+    release_date = Column(db.Date)
+    # the cast, load it with selectinload() when listing many movies
+    actors = db.relationship('Actor', secondary=movie_actors,
+                             order_by='Actor.id', passive_deletes=True,
+                             backref=db.backref('movies', order_by='Movie.id',
+                                                passive_deletes=True))
 
     def __init__(self, title, release_date):
         self.title = title
         self.release_date = release_date
 
+    # the endpoints pass parsed dates, strings are still accepted here
+    @validates('release_date')
+    def validate_release_date(self, key, value):
+        return None if value is None else parse_date(value)
+
     '''
     format()
         return the movie model in json form
     '''
     def format(self):
-        return {
-            'id': self.id,
-            'title': self.title,
-            'release_date': self.release_date}
+        return serialize_row(
+            Movie.FIELDS, (self.id, self.title, self.release_date))
 
     '''
     insert()
@@ -54,7 +738,9 @@ class Movie(db.Model):
     '''
     def insert(self):
         db.session.add(self)
+        bump_version(self.__tablename__)
         db.session.commit()
+        notify_write(self.__tablename__)
 
     '''
     delete()
@@ -66,7 +752,9 @@ class Movie(db.Model):
     '''
     def delete(self):
         db.session.delete(self)
+        bump_version(self.__tablename__)
         db.session.commit()
+        notify_write(self.__tablename__)
 
     '''
     update()
@@ -78,13 +766,43 @@ class Movie(db.Model):
             movie.update()
     '''
     def update(self):
+        bump_version(self.__tablename__)
         db.session.commit()
+        notify_write(self.__tablename__)
 
 '''
 Actors with attributes name, age and gender
 '''
 class Actor(db.Model):
     __tablename__ = 'actors'
+    # columns in the order they are serialized
+    FIELDS = ('id', 'name', 'age', 'gender')
+    # ?include= names, mapped to the relationship they embed
+    INCLUDES = {'movies': 'movies'}
+    # filter parameters of the list endpoints, mapped to (column, operator)
+    FILTERS = {
+        'name_prefix': ('name', 'prefix'),
+        'name_contains': ('name', 'contains'),
+        'age_min': ('age', 'min'),
+        'age_max': ('age', 'max'),
+        'gender': ('gender', 'eq')
+    }
+    # text column of the full-text index searched by /search
+    SEARCH = 'name'
+    # B-tree indexes backing the filters, the trigram index used by
+    # name_contains is Postgres only and created by the migrations
+    __table_args__ = (
+        db.Index('ix_actors_name', 'name',
+                 postgresql_ops={'name': 'text_pattern_ops'}),
+        db.Index('ix_actors_age', 'age'),
+        db.Index('ix_actors_gender', 'gender'),
+    )
+    # accepted types of the writable fields, and whether they are required
+    SPEC = {
+        'name': ((str,), True),
+        'age': ((int,), False),
+        'gender': ((str,), False)
+    }
 
     id = Column(db.Integer, primary_key=True)
     name = Column(db.String)
@@ -101,11 +819,8 @@ class Actor(db.Model):
         return the actor model in json form
     '''
     def format(self):
-        return {
-            'id': self.id,
-            'name': self.name,
-            'age': self.age,
-            'gender': self.gender,}
+        return serialize_row(
+            Actor.FIELDS, (self.id, self.name, self.age, self.gender))
 
     '''
     insert()
@@ -117,7 +832,9 @@ class Actor(db.Model):
     '''
     def insert(self):
         db.session.add(self)
+        bump_version(self.__tablename__)
         db.session.commit()
+        notify_write(self.__tablename__)
 
     '''
     delete()
@@ -129,7 +846,9 @@ class Actor(db.Model):
     '''
     def delete(self):
         db.session.delete(self)
+        bump_version(self.__tablename__)
         db.session.commit()
+        notify_write(self.__tablename__)
 
     '''
     update()
@@ -141,6 +860,12 @@ class Actor(db.Model):
             actor.update()
     '''
     def update(self):
+        bump_version(self.__tablename__)
         db.session.commit()
+        notify_write(self.__tablename__)
 
     
+
+
+add_search_index(Movie.__table__, Movie.SEARCH)
+add_search_index(Actor.__table__, Actor.SEARCH)
@@ -0,0 +1,307 @@
+import os
+import base64
+import hashlib
+import binascii
+
+from sqlalchemy import Date, Integer, select
+
+from encoding import dumps
+from models import parse_date, serialize_row, serialize_values
+
+# server-enforced upper bound of a page, larger ?limit= values are clamped
+MAX_PAGE_SIZE = int(os.environ.get('MAX_PAGE_SIZE', 100))
+DEFAULT_PAGE_SIZE = int(os.environ.get('DEFAULT_PAGE_SIZE', MAX_PAGE_SIZE))
+# shortest ?*_contains= value, shorter ones can not use the trigram index
+MIN_CONTAINS_LENGTH = int(os.environ.get('MIN_CONTAINS_LENGTH', 3))
+# rows fetched from the server-side cursor and written per chunk on export
+EXPORT_CHUNK_SIZE = int(os.environ.get('EXPORT_CHUNK_SIZE', 1000))
+
+'''
+encode_cursor(last_id)
+    return the opaque cursor pointing after the row with id last_id
+'''
+def encode_cursor(last_id):
+    raw = 'id:{}'.format(last_id).encode('ascii')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+'''
+decode_cursor(cursor)
+    return the id a cursor points after
+    it should raise a ValueError if the cursor is malformed
+'''
+def decode_cursor(cursor):
+    padded = cursor + '=' * (-len(cursor) % 4)
+    try:
+        raw = base64.urlsafe_b64decode(padded.encode('ascii')).decode('ascii')
+    except (binascii.Error, UnicodeError):
+        raise ValueError('malformed cursor')
+    prefix, _, last_id = raw.partition(':')
+    if prefix != 'id' or not last_id.isdigit():
+        raise ValueError('malformed cursor')
+    return int(last_id)
+
+'''
+parse_page_args(args)
+    read ?limit= and ?after= from the request arguments
+    it should raise a ValueError if either of them is invalid
+    return (limit, after), after is None for the first page
+'''
+def parse_page_args(args):
+    limit = args.get('limit', DEFAULT_PAGE_SIZE)
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        raise ValueError('limit must be an integer')
+    if limit < 1:
+        raise ValueError('limit must be positive')
+    limit = min(limit, MAX_PAGE_SIZE)
+
+    after = args.get('after')
+    if after is not None:
+        after = decode_cursor(after)
+    return limit, after
+
+'''
+parse_fields(args, model)
+    read the ?fields=id,name projection from the request arguments
+    id is always selected since the cursors are built from it
+    it should raise a ValueError if a field is not a column of model
+    return the field names in the order of model.FIELDS
+'''
+def parse_fields(args, model):
+    requested = args.get('fields')
+    if not requested:
+        return model.FIELDS
+
+    names = set(name.strip() for name in requested.split(',') if name.strip())
+    unknown = names.difference(model.FIELDS)
+    if unknown:
+        raise ValueError('unknown fields: {}'.format(', '.join(sorted(unknown))))
+    names.add('id')
+    return tuple(name for name in model.FIELDS if name in names)
+
+'''
+parse_include(args, model)
+    read ?include= from the request arguments, the name of the related
+    rows to embed in each row of model (model.INCLUDES)
+    it should raise a ValueError for an unknown name
+    return the include name, or None
+'''
+def parse_include(args, model):
+    include = args.get('include')
+    if not include:
+        return None
+    if include not in model.INCLUDES:
+        raise ValueError('unknown include: {}'.format(include))
+    return include
+
+'''
+parse_shape(args)
+    read ?shape= from the request arguments, the form of the rows of a
+    list response
+    - objects (default): a list of {field: value} objects
+    - columnar: {"columns": [fields], "rows": [[values]]}, the field
+      names are sent once per page instead of once per row
+    it should raise a ValueError for an unknown shape
+'''
+SHAPES = ('objects', 'columnar')
+
+def parse_shape(args):
+    shape = args.get('shape', 'objects')
+    if shape not in SHAPES:
+        raise ValueError('unknown shape: {}'.format(shape))
+    return shape
+
+'''
+page_items(fields, rows, shape)
+    return the rows of a page, tuples of the fields, in the json form
+    of shape
+    EXAMPLE
+        page_items(('id', 'name'), [(1, 'Tony')], 'columnar') ==
+            {'columns': ['id', 'name'], 'rows': [[1, 'Tony']]}
+'''
+def page_items(fields, rows, shape='objects'):
+    if shape == 'columnar':
+        return {'columns': list(fields), 'rows': [serialize_values(row) for row in rows]}
+    return [serialize_row(fields, row) for row in rows]
+
+'''
+parse_filters(args, model)
+    read the filter parameters declared in model.FILTERS from the request
+    arguments, i.e. ?name_prefix=To&age_min=30
+    every operator is served by an index, filters that could only be
+    answered by a full scan are refused:
+    - prefix and contains escape the LIKE wildcards of the value
+    - contains needs at least MIN_CONTAINS_LENGTH characters
+    - min above max is refused
+    it should raise a ValueError for an invalid or refused filter
+    return the list of conditions
+'''
+def parse_filters(args, model):
+    columns = model.__table__.c
+    conditions = []
+    bounds = {}
+    for name, (column_name, operator) in model.FILTERS.items():
+        value = args.get(name)
+        if value is None:
+            continue
+        column = columns[column_name]
+
+        if operator in ('prefix', 'contains'):
+            if not value:
+                raise ValueError('{} must not be empty'.format(name))
+            if operator == 'contains' and len(value) < MIN_CONTAINS_LENGTH:
+                raise ValueError('{} needs at least {} characters'.format(
+                    name, MIN_CONTAINS_LENGTH))
+            pattern = escape_like(value)
+            if operator == 'prefix':
+                conditions.append(column.like(pattern + '%', escape='\\'))
+            else:
+                conditions.append(column.ilike('%' + pattern + '%', escape='\\'))
+            continue
+
+        value = parse_filter_value(column, value, name)
+        if operator == 'eq':
+            conditions.append(column == value)
+        elif operator == 'min':
+            conditions.append(column >= value)
+            bounds.setdefault(column_name, [None, None])[0] = value
+        else:
+            conditions.append(column <= value)
+            bounds.setdefault(column_name, [None, None])[1] = value
+
+    for column_name, (low, high) in bounds.items():
+        if low is not None and high is not None and low > high:
+            raise ValueError('empty {} range'.format(column_name))
+    return conditions
+
+'''
+parse_filter_value(column, value, name)
+    convert a filter value, a query string argument or a json value of
+    a bulk filter, to the type of the column it filters
+    integer columns take integers or their digits, date columns ISO
+    dates (YYYY-MM-DD), the other columns strings
+    it should raise a ValueError for any other value
+'''
+def parse_filter_value(column, value, name):
+    try:
+        if isinstance(value, bool) or not isinstance(value, (int, str)):
+            raise ValueError
+        if isinstance(column.type, Integer):
+            return int(value)
+        if isinstance(column.type, Date):
+            return parse_date(value)
+        if not isinstance(value, str):
+            raise ValueError
+    except ValueError:
+        raise ValueError('invalid value for {}'.format(name))
+    return value
+
+'''
+escape_like(value)
+    escape the LIKE wildcards of value, so it is matched literally
+'''
+def escape_like(value):
+    return value.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+
+'''
+select_fields(model, fields)
+    return a Core select of only the given columns of model
+    the rows come back as plain tuples, no model instances are built
+'''
+def select_fields(model, fields):
+    columns = model.__table__.c
+    return select(*[columns[name] for name in fields])
+
+'''
+keyset_page(session, statement, id_column, after, limit, scalars)
+    fetch the page of statement following the id after, ordered by id
+    seeking on the primary key keeps deep pages as cheap as the first one
+    with scalars=True the statement selects model instances, i.e. to
+    eager load their relationships, instead of row tuples
+    return (rows, next_cursor), next_cursor is None on the last page
+    EXAMPLE
+        statement = select_fields(Actor, Actor.FIELDS)
+        rows, next_cursor = keyset_page(db.session, statement, Actor.id, None, 20)
+'''
+def keyset_page(session, statement, id_column, after, limit, scalars=False):
+    result = session.execute(keyset_statement(statement, id_column, after, limit))
+    rows = result.scalars().all() if scalars else result.all()
+    return keyset_rows(rows, limit)
+
+'''
+keyset_statement(statement, id_column, after, limit) / keyset_rows(rows, limit)
+    the two halves of keyset_page, for callers executing the statement
+    themselves, i.e. on an asyncio connection
+    keyset_rows returns (rows, next_cursor)
+'''
+def keyset_statement(statement, id_column, after, limit):
+    if after is not None:
+        statement = statement.where(id_column > after)
+    return statement.order_by(id_column).limit(limit + 1)
+
+def keyset_rows(rows, limit):
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(rows[-1].id)
+    return rows, next_cursor
+
+'''
+collection_etag(table_names, version, query_string)
+    the ETag of a read of the given tables at their combined version
+    (the versions joined with '.'), for the given query string
+'''
+def collection_etag(table_names, version, query_string):
+    return hashlib.sha1('{}:{}:{}'.format(
+        ','.join(table_names), version, query_string).encode()).hexdigest()
+
+'''
+export_query(session, statement, id_column)
+    order statement by id and read it through a server-side cursor,
+    yielding EXPORT_CHUNK_SIZE rows at a time
+'''
+def export_query(session, statement, id_column):
+    statement = statement.order_by(id_column).execution_options(stream_results=True)
+    result = session.execute(statement)
+    for partition in result.partitions(EXPORT_CHUNK_SIZE):
+        for row in partition:
+            yield row
+
+'''
+export_rows(rows, key, fields, ndjson)
+    generate a full-table export in chunks of bytes, so only one chunk of
+    rows and encoded text is held in memory at a time, each row encoded
+    by encoding.dumps() like the rows of the list pages
+    - json: {"success":true,"<key>":[...]}
+    - ndjson: one json object per line
+    EXAMPLE
+        rows = export_query(db.session, select_fields(Actor, Actor.FIELDS), Actor.id)
+        export_rows(rows, 'actors', Actor.FIELDS)
+'''
+def export_rows(rows, key, fields, ndjson=False, chunk_size=None):
+    chunk_size = chunk_size or EXPORT_CHUNK_SIZE
+    separator = b'\n' if ndjson else b','
+    if not ndjson:
+        yield b'{"success":true,' + dumps(key) + b':['
+
+    chunk = []
+    first = True
+    for row in rows:
+        chunk.append(dumps(serialize_row(fields, row)))
+        if len(chunk) >= chunk_size:
+            yield _join_chunk(chunk, separator, first, ndjson)
+            chunk = []
+            first = False
+    if chunk:
+        yield _join_chunk(chunk, separator, first, ndjson)
+
+    if not ndjson:
+        yield b']}'
+
+
+def _join_chunk(chunk, separator, first, ndjson):
+    text = separator.join(chunk)
+    if ndjson:
+        return text + b'\n'
+    return text if first else separator + text
@@ -0,0 +1,354 @@
+import os
+import math
+import time
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from metrics import Counter, registry
+
+# requests per second of each subject (sub claim), 0 (the default)
+# disables the limit
+RATE_LIMIT = float(os.environ.get('RATE_LIMIT', 0))
+# requests a subject may send at once after being idle
+RATE_LIMIT_BURST = float(os.environ.get('RATE_LIMIT_BURST', 40))
+# tighter limits of some permissions, as permission=rate/burst pairs
+# i.e. 'post:actors=1/5,delete:actors=0.5/2'
+RATE_LIMIT_PERMISSIONS = os.environ.get('RATE_LIMIT_PERMISSIONS', '')
+# requests of a subject running at the same time, 0 (the default)
+# disables the cap
+RATE_LIMIT_CONCURRENCY = int(os.environ.get('RATE_LIMIT_CONCURRENCY', 0))
+# seconds an in-flight entry of the shared store outlives a crashed worker
+CONCURRENCY_TTL = 60
+# buckets kept by a worker, the least recently used are dropped
+MAX_BUCKETS = 100000
+
+'''
+RateLimitError Exception
+    a request over the limits of its subject, answered with 429 and
+    a Retry-After header of retry_after seconds
+'''
+class RateLimitError(Exception):
+    def __init__(self, error, retry_after):
+        self.error = error
+        self.status_code = 429
+        self.retry_after = retry_after
+
+
+'''
+parse_permission_limits(value)
+    parse RATE_LIMIT_PERMISSIONS into {permission: (rate, burst)}
+    it should raise a ValueError on a malformed pair
+    EXAMPLE
+        parse_permission_limits('post:actors=1/5') == {'post:actors': (1.0, 5.0)}
+'''
+def parse_permission_limits(value):
+    limits = {}
+    for pair in filter(None, (pair.strip() for pair in value.split(','))):
+        permission, _, limit = pair.partition('=')
+        rate, _, burst = limit.partition('/')
+        rate, burst = float(rate), float(burst or rate)
+        if not permission or rate <= 0 or burst < 1:
+            raise ValueError('expected permission=rate/burst, got {!r}'.format(pair))
+        limits[permission] = (rate, burst)
+    return limits
+
+
+'''
+LimitStore
+    the interface of the stores of the limits, keyed by subject
+    - take(buckets, now): buckets is a list of (key, rate, burst); take
+      one token from every bucket and return 0, or take none and return
+      the seconds until all of them have one
+    - enter(key, limit): count one more request in flight for key and
+      return True, or return False if limit are already in flight
+    - leave(key): count one request in flight less
+'''
+class LimitStore:
+    def take(self, buckets, now):
+        raise NotImplementedError
+
+    def enter(self, key, limit):
+        raise NotImplementedError
+
+    def leave(self, key):
+        raise NotImplementedError
+
+    def clear(self):
+        pass
+
+
+'''
+MemoryStore
+    the limits of this worker: token buckets as [tokens, updated] lists
+    in an LRU dict of at most maxsize buckets, behind one lock held for
+    a few dict lookups
+    a dropped bucket comes back full, the least recently used one is
+    the one most likely to be full already
+'''
+class MemoryStore(LimitStore):
+    def __init__(self, maxsize=MAX_BUCKETS):
+        self.maxsize = maxsize
+        self._buckets = OrderedDict()
+        self._in_flight = {}
+        self._lock = threading.Lock()
+
+    def take(self, buckets, now):
+        with self._lock:
+            wait = 0.0
+            states = []
+            for key, rate, burst in buckets:
+                state = self._buckets.get(key)
+                if state is None:
+                    state = self._buckets[key] = [burst, now]
+                    while len(self._buckets) > self.maxsize:
+                        self._buckets.popitem(last=False)
+                else:
+                    self._buckets.move_to_end(key)
+                tokens = min(burst, state[0] + max(now - state[1], 0) * rate)
+                if tokens < 1:
+                    wait = max(wait, (1 - tokens) / rate)
+                states.append((state, tokens))
+            if wait:
+                return wait
+            for state, tokens in states:
+                state[0] = tokens - 1
+                state[1] = now
+            return 0.0
+
+    def enter(self, key, limit):
+        with self._lock:
+            count = self._in_flight.get(key, 0)
+            if count >= limit:
+                return False
+            self._in_flight[key] = count + 1
+            return True
+
+    def leave(self, key):
+        with self._lock:
+            count = self._in_flight.pop(key, 0) - 1
+            if count > 0:
+                self._in_flight[key] = count
+
+    def clear(self):
+        with self._lock:
+            self._buckets.clear()
+            self._in_flight.clear()
+
+
+'''
+SharedStore
+    limits shared by every worker, over a client with the eval / incr /
+    decr / expire methods of redis-py
+    the buckets of a request are taken atomically by TAKE_SCRIPT, now is
+    the clock of the worker, keep the workers in sync with NTP
+'''
+TAKE_SCRIPT = '''
+local now = tonumber(ARGV[1])
+local wait = 0
+local tokens = {}
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 2])
+    local burst = tonumber(ARGV[i * 2 + 1])
+    local bucket = redis.call('HMGET', key, 'tokens', 'updated')
+    local available = tonumber(bucket[1]) or burst
+    local updated = tonumber(bucket[2]) or now
+    available = math.min(burst, available + math.max(now - updated, 0) * rate)
+    if available < 1 then
+        wait = math.max(wait, (1 - available) / rate)
+    end
+    tokens[i] = available
+end
+if wait > 0 then
+    return tostring(wait)
+end
+for i, key in ipairs(KEYS) do
+    local rate = tonumber(ARGV[i * 2])
+    local burst = tonumber(ARGV[i * 2 + 1])
+    redis.call('HSET', key, 'tokens', tokens[i] - 1, 'updated', now)
+    redis.call('EXPIRE', key, math.ceil(burst / rate) + 1)
+end
+return '0'
+'''
+
+class SharedStore(LimitStore):
+    def __init__(self, client, prefix='capstone:limit:'):
+        self.client = client
+        self.prefix = prefix
+
+    def take(self, buckets, now):
+        keys = [self.prefix + key for key, _, _ in buckets]
+        args = [now]
+        for _, rate, burst in buckets:
+            args += [rate, burst]
+        return float(self.client.eval(TAKE_SCRIPT, len(keys), *keys, *args))
+
+    def enter(self, key, limit):
+        key = self.prefix + 'flight:' + key
+        if self.client.incr(key) > limit:
+            self.client.decr(key)
+            return False
+        self.client.expire(key, CONCURRENCY_TTL)
+        return True
+
+    def leave(self, key):
+        self.client.decr(self.prefix + 'flight:' + key)
+
+
+'''
+FakeSharedClient
+    a local stand-in for the shared store of the limits, used in tests
+    eval runs TAKE_SCRIPT in Python over hashes kept in a dict
+'''
+class FakeSharedClient:
+    def __init__(self):
+        self.store = {}
+        self._lock = threading.Lock()
+
+    def eval(self, script, numkeys, *keys_and_args):
+        if script != TAKE_SCRIPT:
+            raise NotImplementedError('FakeSharedClient only runs TAKE_SCRIPT')
+        keys, args = keys_and_args[:numkeys], [float(arg) for arg in keys_and_args[numkeys:]]
+        now = args[0]
+        with self._lock:
+            wait = 0.0
+            tokens = []
+            for i, key in enumerate(keys):
+                rate, burst = args[1 + i * 2], args[2 + i * 2]
+                bucket = self.store.get(key, {})
+                available = float(bucket.get('tokens', burst))
+                updated = float(bucket.get('updated', now))
+                available = min(burst, available + max(now - updated, 0) * rate)
+                if available < 1:
+                    wait = max(wait, (1 - available) / rate)
+                tokens.append(available)
+            if wait > 0:
+                return str(wait).encode()
+            for key, available in zip(keys, tokens):
+                self.store[key] = {'tokens': str(available - 1), 'updated': str(now)}
+            return b'0'
+
+    def incr(self, key):
+        with self._lock:
+            value = int(self.store.get(key, 0)) + 1
+            self.store[key] = str(value).encode()
+            return value
+
+    def decr(self, key):
+        with self._lock:
+            value = int(self.store.get(key, 0)) - 1
+            self.store[key] = str(value).encode()
+            return value
+
+    def expire(self, key, seconds):
+        return True
+
+
+'''
+RateLimiter
+    the limits of the requests of each subject
+    - a token bucket of rate requests per second and burst tokens per
+      subject, and one per subject and permission for the permissions of
+      permission_limits, all taken together by check()
+    - at most concurrency requests of a subject in flight, see acquire()
+    the buckets of each set of required permissions are planned once
+    the clock is the wall clock, a shared store compares the times of
+    every worker
+    EXAMPLE
+        limiter.check('auth0|123', frozenset({'post:actors'}))
+        with limiter.in_flight('auth0|123'):
+            ...
+'''
+class RateLimiter:
+    def __init__(self, store, rate=RATE_LIMIT, burst=RATE_LIMIT_BURST,
+                 permission_limits=None, concurrency=RATE_LIMIT_CONCURRENCY,
+                 clock=time.time):
+        self.store = store
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.permission_limits = permission_limits if permission_limits is not None \
+            else parse_permission_limits(RATE_LIMIT_PERMISSIONS)
+        self.concurrency = concurrency
+        self.clock = clock
+        self.limited = Counter()
+        self.capped = Counter()
+        self._plans = {}
+
+    def plan(self, required):
+        plan = self._plans.get(required)
+        if plan is None:
+            plan = []
+            if self.rate > 0:
+                plan.append(('', self.rate, self.burst))
+            for permission in sorted(required):
+                if permission in self.permission_limits:
+                    rate, burst = self.permission_limits[permission]
+                    plan.append(('|' + permission, rate, burst))
+            self._plans[required] = plan
+        return plan
+
+    '''
+    check(subject, required)
+        take a token from each bucket of subject for a request needing
+        the required permissions, a frozenset
+        it should raise a RateLimitError if one of them is empty
+    '''
+    def check(self, subject, required):
+        plan = self.plan(required)
+        if not plan or subject is None:
+            return
+        wait = self.store.take([(subject + suffix, rate, burst)
+                                for suffix, rate, burst in plan], self.clock())
+        if wait:
+            self.limited.inc()
+            raise RateLimitError({
+                'code': 'rate_limited',
+                'description': 'Too many requests, retry in {} seconds.'.format(
+                    math.ceil(wait))
+            }, math.ceil(wait))
+
+    '''
+    acquire(subject)
+        count a request of subject in flight until the returned release()
+        is called, once or more
+        it should raise a RateLimitError if the subject already has
+        concurrency requests in flight
+    '''
+    def acquire(self, subject):
+        if self.concurrency <= 0 or subject is None:
+            return lambda: None
+        if not self.store.enter(subject, self.concurrency):
+            self.capped.inc()
+            raise RateLimitError({
+                'code': 'too_many_in_flight',
+                'description': 'Too many requests in flight.'
+            }, 1)
+        once = threading.Lock()
+
+        def release():
+            if once.acquire(blocking=False):
+                self.store.leave(subject)
+        return release
+
+    '''
+    in_flight(subject)
+        a context manager counting the request of subject while it runs,
+        see acquire()
+    '''
+    @contextmanager
+    def in_flight(self, subject):
+        release = self.acquire(subject)
+        try:
+            yield
+        finally:
+            release()
+
+
+limiter = RateLimiter(MemoryStore())
+
+registry.counter('rate_limited_total',
+                 'Requests refused because their subject was over its rate limit.',
+                 lambda: limiter.limited.value)
+registry.counter('rate_limit_in_flight_refused_total',
+                 'Requests refused because their subject had too many in flight.',
+                 lambda: limiter.capped.value)
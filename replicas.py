@@ -0,0 +1,218 @@
+import os
+import time
+import logging
+import itertools
+import threading
+import weakref
+from collections import OrderedDict
+
+from flask import g, has_request_context, request
+from flask_sqlalchemy import SignallingSession, get_state
+from sqlalchemy import event, exc, text
+from sqlalchemy.engine import Engine
+
+from metrics import Counter, registry
+
+# seconds a replica found down, or up, is trusted before it is checked again
+REPLICA_HEALTH_INTERVAL = float(os.environ.get('REPLICA_HEALTH_INTERVAL', 10))
+# seconds the reads of a client stay on the primary after it wrote
+READ_YOUR_WRITES_SECONDS = float(os.environ.get('READ_YOUR_WRITES_SECONDS', 5))
+# clients remembered for read-your-writes, the oldest are dropped first
+READ_YOUR_WRITES_SIZE = int(os.environ.get('READ_YOUR_WRITES_SIZE', 10000))
+
+# the methods of the read-only handlers, the ones routed to replicas
+READ_METHODS = ('GET', 'HEAD')
+
+'''
+ReplicaRouter
+    picks the database of each read-only request
+    - the replicas are the binds replica_0, replica_1, ... of
+      DATABASE_REPLICA_URLS, taken round-robin, one per request so the
+      table versions and the page of a response agree
+    - a replica is checked with SELECT 1 when its last check is older
+      than health_interval, and marked down as soon as one of its
+      connections is lost; reads fall back to the primary when no
+      replica is up
+    - a client, the sub claim of its token, reads from the primary for
+      read_your_writes seconds after each of its writes, so it sees them
+      through the replica lag
+    the window is kept per worker: with several workers a write and the
+    next read may land on different workers, keep read_your_writes above
+    the replica lag rather than relying on it alone
+    EXAMPLE
+        replica_router.configure(['replica_0', 'replica_1'])
+'''
+class ReplicaRouter:
+    def __init__(self, health_interval=REPLICA_HEALTH_INTERVAL,
+                 read_your_writes=READ_YOUR_WRITES_SECONDS,
+                 maxsize=READ_YOUR_WRITES_SIZE, clock=time.monotonic):
+        self.health_interval = health_interval
+        self.read_your_writes = read_your_writes
+        self.maxsize = maxsize
+        self.clock = clock
+        self.replica_reads = Counter()
+        self.primary_reads = Counter()
+        self.fallbacks = Counter()
+        self.logger = logging.getLogger('capstone.replicas')
+        self._writers = OrderedDict()
+        self._lock = threading.Lock()
+        self.configure([])
+
+    '''
+    configure(keys)
+        route reads to the binds named keys, forgetting their health
+    '''
+    def configure(self, keys):
+        self.replicas = list(keys)
+        self.health = {}
+        self._engine_keys = weakref.WeakKeyDictionary()
+        self._turn = itertools.count()
+
+    '''
+    route(engine_for)
+        return the bind key of the replica serving the current request,
+        or None to use the primary; engine_for(key) returns the engine
+        of a bind, it is only called to check a replica
+    '''
+    def route(self, engine_for):
+        if not self.replicas or not has_request_context() \
+                or request.method not in READ_METHODS:
+            return None
+        if 'replica_bind' not in g:
+            g.replica_bind = self.choose(engine_for, current_subject())
+        return g.replica_bind
+
+    '''
+    choose(engine_for, subject)
+        return the bind key of the replica serving a read of subject, or
+        None to use the primary; it may check a replica, blocking
+    '''
+    def choose(self, engine_for, subject):
+        if self.wrote_recently(subject):
+            self.primary_reads.inc()
+            return None
+        for _ in range(len(self.replicas)):
+            key = self.replicas[next(self._turn) % len(self.replicas)]
+            if self.is_healthy(key, engine_for):
+                self.replica_reads.inc()
+                return key
+        self.fallbacks.inc()
+        return None
+
+    def is_healthy(self, key, engine_for):
+        healthy, checked_at = self.health.get(key, (True, None))
+        if checked_at is None or self.clock() - checked_at >= self.health_interval:
+            healthy = self.check(key, engine_for(key))
+        return healthy
+
+    def check(self, key, engine):
+        self.track(key, engine)
+        try:
+            with engine.connect() as connection:
+                connection.execute(text('SELECT 1'))
+            healthy = True
+        except exc.SQLAlchemyError as error:
+            self.logger.warning('replica %s is down: %s', key, error)
+            healthy = False
+        self.health[key] = (healthy, self.clock())
+        return healthy
+
+    '''
+    track(key, engine)
+        let mark_down() find the replica of another engine of key, i.e.
+        the asyncio engine of asgi.py
+    '''
+    def track(self, key, engine):
+        self._engine_keys[engine] = key
+
+    '''
+    mark_down(engine)
+        take the replica of engine out of the rotation until its next check
+    '''
+    def mark_down(self, engine):
+        key = self._engine_keys.get(engine)
+        if key is not None:
+            self.health[key] = (False, self.clock())
+
+    def healthy_count(self):
+        return sum(1 for key in self.replicas if self.health.get(key, (True, None))[0])
+
+    def note_write(self, subject):
+        if subject is None or self.read_your_writes <= 0:
+            return
+        with self._lock:
+            self._writers[subject] = self.clock() + self.read_your_writes
+            self._writers.move_to_end(subject)
+            while len(self._writers) > self.maxsize:
+                self._writers.popitem(last=False)
+
+    def wrote_recently(self, subject):
+        if subject is None:
+            return False
+        with self._lock:
+            expires = self._writers.get(subject)
+            if expires is None:
+                return False
+            if expires <= self.clock():
+                del self._writers[subject]
+                return False
+            return True
+
+    def clear(self):
+        with self._lock:
+            self._writers.clear()
+
+
+'''
+current_subject()
+    the sub claim of the token of the current request, set by requires_auth
+'''
+def current_subject():
+    if not has_request_context():
+        return None
+    return g.get('current_user', {}).get('sub')
+
+
+replica_router = ReplicaRouter()
+
+'''
+note_request_write(table_name)
+    the write listener of models.py, starts the read-your-writes window
+    of the client of the current request
+'''
+def note_request_write(table_name):
+    replica_router.note_write(current_subject())
+
+@event.listens_for(Engine, 'handle_error')
+def mark_replica_down(exception_context):
+    if exception_context.is_disconnect:
+        replica_router.mark_down(exception_context.engine)
+
+registry.counter('db_replica_reads_total',
+                 'Read-only requests served by a replica.',
+                 lambda: replica_router.replica_reads.value)
+registry.counter('db_primary_reads_total',
+                 'Read-only requests kept on the primary to read their own writes.',
+                 lambda: replica_router.primary_reads.value)
+registry.counter('db_replica_fallbacks_total',
+                 'Read-only requests sent to the primary because no replica was up.',
+                 lambda: replica_router.fallbacks.value)
+registry.gauge('db_replicas_healthy',
+               'Replicas in the read rotation.',
+               lambda: replica_router.healthy_count())
+
+'''
+RoutingSession
+    the session of the db extension: inside a read-only request, the
+    statements of a clean session go to the replica picked by
+    replica_router, everything else goes to the primary
+'''
+class RoutingSession(SignallingSession):
+    def get_bind(self, mapper=None, clause=None):
+        if replica_router.replicas and not self._flushing and self._is_clean():
+            state = get_state(self.app)
+            key = replica_router.route(
+                lambda key: state.db.get_engine(self.app, bind=key))
+            if key is not None:
+                return state.db.get_engine(self.app, bind=key)
+        return super().get_bind(mapper, clause)
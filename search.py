@@ -0,0 +1,83 @@
+import os
+import re
+
+from sqlalchemy import func, literal_column, table, column
+
+from queries import select_fields
+
+# results returned per model, and the upper bound of ?limit=
+SEARCH_LIMIT = int(os.environ.get('SEARCH_LIMIT', 10))
+MAX_SEARCH_LIMIT = int(os.environ.get('MAX_SEARCH_LIMIT', 50))
+# shortest query, a single letter would match a large share of the rows
+SEARCH_MIN_LENGTH = int(os.environ.get('SEARCH_MIN_LENGTH', 2))
+# words kept from a query
+SEARCH_MAX_TERMS = 8
+
+'''
+parse_search_args(args)
+    read ?q= and ?limit= from the request arguments
+    q is split into words, the last one is matched as a prefix so
+    results show up while the word is still being typed
+    it should raise a ValueError for a missing, too short or invalid query
+    return (terms, limit)
+'''
+def parse_search_args(args):
+    terms = re.findall(r'\w+', args.get('q', '').lower())[:SEARCH_MAX_TERMS]
+    if len(''.join(terms)) < SEARCH_MIN_LENGTH:
+        raise ValueError('q needs at least {} characters'.format(SEARCH_MIN_LENGTH))
+
+    limit = args.get('limit', SEARCH_LIMIT)
+    try:
+        limit = int(limit)
+    except (TypeError, ValueError):
+        raise ValueError('limit must be an integer')
+    if limit < 1:
+        raise ValueError('limit must be positive')
+    return terms, min(limit, MAX_SEARCH_LIMIT)
+
+'''
+escape_like(term)
+    escape the wildcards of LIKE in term, with a backslash, so a '_'
+    of a word matches itself
+'''
+def escape_like(term):
+    return re.sub(r'([\\%_])', r'\\\1', term)
+
+'''
+search_statement(dialect, model, terms, limit)
+    return a select of model.FIELDS for the rows whose model.SEARCH
+    column matches every term, best match first
+    - postgresql: the search_vector column and its GIN index, ranked by ts_rank
+    - sqlite: the <table>_fts FTS5 table, ranked by bm25
+    - other databases: an unranked substring match, ordered by id
+    EXAMPLE
+        statement = search_statement(db.engine.dialect.name, Actor, ['tom'], 10)
+        rows = db.session.execute(statement).all()
+'''
+def search_statement(dialect, model, terms, limit):
+    statement = select_fields(model, model.FIELDS)
+    id_column = model.__table__.c.id
+
+    if dialect == 'postgresql':
+        query = func.to_tsquery('simple', ' & '.join(
+            term + (':*' if index == len(terms) - 1 else '')
+            for index, term in enumerate(terms)))
+        vector = literal_column(model.__tablename__ + '.search_vector')
+        return (statement.where(vector.op('@@')(query))
+                .order_by(func.ts_rank(vector, query).desc(), id_column)
+                .limit(limit))
+
+    if dialect == 'sqlite':
+        name = model.__tablename__ + '_fts'
+        fts = table(name, column('rowid'), column('rank'))
+        query = ' '.join('"{}"'.format(term) for term in terms) + '*'
+        return (statement.join(fts, fts.c.rowid == id_column)
+                .where(literal_column(name).op('MATCH')(query))
+                .order_by(fts.c.rank, id_column)
+                .limit(limit))
+
+    search_column = model.__table__.c[model.SEARCH]
+    return (statement.where(*[search_column.ilike('%' + escape_like(term) + '%', escape='\\')
+                              for term in terms])
+            .order_by(id_column)
+            .limit(limit))
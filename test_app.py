@@ -1,11 +1,74 @@
 import os
+import asyncio
 import unittest
+import unittest.mock
 import json
 import time
+import gzip
+import hashlib
+import datetime
+import tempfile
+import threading
+import subprocess
+import sys
+import rsa
+import flask
 from flask_sqlalchemy import SQLAlchemy
+from jose import jwt
+from sqlalchemy import create_engine, event, inspect
+from jose.utils import long_to_base64
 
+import auth
 from app import create_app
-from models import setup_db, Actor, Movie
+import models
+from models import setup_db, db, Actor, Movie
+from jwks import JWKSCache, JWKSUnavailableError, file_fetcher
+import queries
+from queries import keyset_page, select_fields
+import cache
+import ratelimit
+import idempotency
+import replicas
+import encoding
+import search
+
+try:
+    import asgi
+except ImportError:
+    asgi = None
+
+
+'''
+a local RS256 key pair and JWKS standing in for Auth0,
+so tests can mint their own tokens
+'''
+LOCAL_KID = 'local-test-key'
+local_public_key, local_private_key = rsa.newkeys(1024)
+LOCAL_JWKS = {'keys': [{
+    'kty': 'RSA',
+    'kid': LOCAL_KID,
+    'use': 'sig',
+    'alg': 'RS256',
+    'n': long_to_base64(local_public_key.n).decode(),
+    'e': long_to_base64(local_public_key.e).decode()
+}]}
+
+
+def make_token(permissions, expires_in=3600, subject='auth0|local'):
+    now = int(time.time())
+    claims = {
+        'iss': 'https://' + auth.AUTH0_DOMAIN + '/',
+        'aud': auth.API_AUDIENCE,
+        'sub': subject,
+        'iat': now,
+        'exp': now + expires_in,
+        'permissions': list(permissions)
+    }
+    return jwt.encode(
+        claims,
+        local_private_key.save_pkcs1().decode(),
+        algorithm='RS256',
+        headers={'kid': LOCAL_KID})
 
 
 class appTestCase(unittest.TestCase):
@@ -20,7 +83,7 @@ class appTestCase(unittest.TestCase):
         self.casting_director = os.environ['CASTING_DIRECTOR']
         self.executive_producer = os.environ['EXECUTIVE_PRODUCER']
 
-        setup_db(self.app, self.database_path)
+        setup_db(self.app, self.database_path, create_tables=True)
 
         # binds the app to the current context
         with self.app.app_context():
@@ -393,6 +456,1855 @@ class appTestCase(unittest.TestCase):
         self.assertEqual(data["deleted id"], str(newMovie_id))
 
 
+class jwksCacheTestCase(unittest.TestCase):
+    """This class represents the JWKS cache test case"""
+
+    def setUp(self):
+        self.now = 0
+        self.jwks = {'keys': [{'kid': 'key_1', 'kty': 'RSA'}]}
+        self.fetches = 0
+        self.fail = False
+
+    def fetch(self):
+        self.fetches += 1
+        if self.fail:
+            raise OSError('identity provider is down')
+        return self.jwks
+
+    def make_cache(self, **kwargs):
+        return JWKSCache(self.fetch, clock=lambda: self.now, **kwargs)
+
+    # test that keys are fetched once and served from memory within the ttl
+    def test_keys_are_cached(self):
+        cache = self.make_cache(ttl=600)
+        for _ in range(5):
+            self.assertEqual(cache.get_key('key_1')['kid'], 'key_1')
+        self.assertEqual(self.fetches, 1)
+
+        self.now = 601
+        cache.get_key('key_1')
+        self.assertEqual(self.fetches, 2)
+
+    # test that an unknown kid refetches, but only once per refresh interval
+    def test_unknown_kid_refetch_is_rate_limited(self):
+        cache = self.make_cache(ttl=600, min_refresh_interval=30)
+        cache.get_key('key_1')
+        self.jwks = {'keys': [{'kid': 'key_1'}, {'kid': 'key_2'}]}
+
+        self.now = 31
+        self.assertEqual(cache.get_key('key_2')['kid'], 'key_2')
+        self.assertEqual(self.fetches, 2)
+
+        for _ in range(10):
+            self.assertIsNone(cache.get_key('forged'))
+        self.assertEqual(self.fetches, 2)
+
+    # test that the last-known-good keys are served while the provider is down
+    def test_serves_last_known_good_keys(self):
+        cache = self.make_cache(ttl=600)
+        cache.get_key('key_1')
+        self.fail = True
+        self.now = 700
+        self.assertEqual(cache.get_key('key_1')['kid'], 'key_1')
+
+    # test that an unreachable provider without any cached keys is reported
+    def test_unavailable_without_keys(self):
+        self.fail = True
+        cache = self.make_cache()
+        with self.assertRaises(JWKSUnavailableError):
+            cache.get_key('key_1')
+
+    # test that concurrent refreshes share a single fetch
+    def test_concurrent_refresh_is_single_flight(self):
+        release = threading.Event()
+
+        def slow_fetch():
+            release.wait(5)
+            return self.fetch()
+
+        def get_key():
+            try:
+                keys.append(cache.get_key('key_1'))
+            except JWKSUnavailableError as error:
+                keys.append(error)
+
+        cache = JWKSCache(slow_fetch)
+        keys = []
+        threads = [threading.Thread(target=get_key) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(self.fetches, 1)
+        # the requests that came during the fetch waited for its keys
+        self.assertEqual([key['kid'] for key in keys], ['key_1'] * 8)
+
+    # test that keys can be loaded from a local JWKS file
+    def test_file_fetcher(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.json', delete=False) as f:
+            json.dump(self.jwks, f)
+        cache = JWKSCache(file_fetcher(f.name))
+        self.assertEqual(cache.get_key('key_1')['kty'], 'RSA')
+        os.remove(f.name)
+
+
+'''
+send one request to an ASGI app, the way a server would
+return (status, [(header, value)], body)
+'''
+def asgi_request(asgi_app, method, url, headers=None, body=b''):
+    path, _, query_string = url.partition('?')
+    headers = dict(headers or {}, **{'Content-Length': str(len(body))})
+    scope = {
+        'type': 'http', 'asgi': {'version': '3.0'}, 'http_version': '1.1',
+        'method': method, 'scheme': 'http', 'path': path, 'raw_path': path.encode(),
+        'query_string': query_string.encode(), 'root_path': '',
+        'headers': [(name.lower().encode(), value.encode())
+                    for name, value in headers.items()],
+        'client': ('127.0.0.1', 50000), 'server': ('localhost', 80)
+    }
+    messages = []
+
+    async def receive():
+        return {'type': 'http.request', 'body': body, 'more_body': False}
+
+    async def send(message):
+        messages.append(message)
+
+    async def run():
+        await asgi_app(scope, receive, send)
+        await asgi_app.dispose()
+    asyncio.run(run())
+
+    start = messages[0]
+    response_headers = [(name.decode('latin-1'), value.decode('latin-1'))
+                        for name, value in start['headers']]
+    return start['status'], response_headers, b''.join(
+        message.get('body', b'') for message in messages[1:])
+
+
+class AsgiClient:
+    """A stand-in for the flask test client sending its requests to an ASGI app"""
+
+    def __init__(self, asgi_app):
+        self.asgi_app = asgi_app
+
+    def open(self, url, method='GET', headers=None, json=None, data=None):
+        headers = dict(headers or {})
+        if json is not None:
+            data = flask.json.dumps(json)
+            headers.setdefault('Content-Type', 'application/json')
+        if isinstance(data, str):
+            data = data.encode()
+        status, response_headers, body = asgi_request(
+            self.asgi_app, method, url, headers, data or b'')
+        return flask.Response(body, status=status, headers=response_headers)
+
+    def get(self, url, **kwargs):
+        return self.open(url, 'GET', **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.open(url, 'POST', **kwargs)
+
+    def patch(self, url, **kwargs):
+        return self.open(url, 'PATCH', **kwargs)
+
+    def delete(self, url, **kwargs):
+        return self.open(url, 'DELETE', **kwargs)
+
+
+class localAuthTestCase(unittest.TestCase):
+    """Base test case running the app against the local JWKS and test database"""
+
+    def setUp(self):
+        self.app = create_app()
+        self.client = self.app.test_client
+        setup_db(self.app, os.environ['DATABASE_TEST_URL'])
+        with self.app.app_context():
+            db.drop_all()
+            db.create_all()
+
+        self.saved_jwks_cache = auth.jwks_cache
+        auth.jwks_cache = JWKSCache(
+            lambda: LOCAL_JWKS, key_builder=auth.build_public_key)
+        auth.token_cache.clear()
+        ratelimit.limiter.store.clear()
+
+    def tearDown(self):
+        auth.jwks_cache = self.saved_jwks_cache
+        auth.token_cache.clear()
+
+    def get_metrics(self):
+        with unittest.mock.patch('app.METRICS_TOKEN', 'metrics-token'):
+            return self.client().get('/metrics',
+                headers={'Authorization': 'Bearer metrics-token'})
+
+    def headers(self, *permissions):
+        return {"Authorization": "Bearer {}".format(make_token(permissions))}
+
+
+class tokenCacheTestCase(localAuthTestCase):
+    """This class represents the verified token cache test case"""
+
+    # test that a reused token is verified once and then served from the cache
+    def test_reused_token_is_cached(self):
+        headers = self.headers('get:actors')
+        hits = auth.token_cache.hits
+        for _ in range(3):
+            response = self.client().get('/actors', headers=headers)
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(auth.token_cache.hits - hits, 2)
+        self.assertEqual(len(auth.token_cache), 1)
+
+    # test that cached entries expire at the token's exp claim
+    def test_entries_expire_at_exp(self):
+        now = [1000]
+        cache = auth.TokenCache(maxsize=10, clock=lambda: now[0])
+        cache.put('token', auth.VerifiedToken({'exp': 1060}, frozenset()))
+        self.assertEqual(cache.get('token').payload, {'exp': 1060})
+        now[0] = 1060
+        self.assertIsNone(cache.get('token'))
+        self.assertEqual((cache.hits, cache.misses), (1, 1))
+        self.assertEqual(len(cache), 0)
+
+    # test that the least recently used token is evicted at the size cap
+    def test_size_cap_evicts_least_recently_used(self):
+        cache = auth.TokenCache(maxsize=2, clock=lambda: 0)
+        verified = auth.VerifiedToken({'exp': 1}, frozenset())
+        cache.put('a', verified)
+        cache.put('b', verified)
+        cache.get('a')
+        cache.put('c', verified)
+        self.assertIsNotNone(cache.get('a'))
+        self.assertIsNone(cache.get('b'))
+        self.assertIsNotNone(cache.get('c'))
+
+
+class publicKeyTestCase(localAuthTestCase):
+    """This class represents the pre-built public key test case"""
+
+    # test that the JWKS is turned into public key objects once per load
+    def test_keys_are_built_on_load(self):
+        key = auth.jwks_cache.get_key(LOCAL_KID)
+        self.assertTrue(hasattr(key, 'verify'))
+        self.assertIs(auth.jwks_cache.get_key(LOCAL_KID), key)
+
+    # test that a valid token is verified against the pre-built key
+    def test_verify_decode_jwt(self):
+        payload = auth.verify_decode_jwt(make_token(['get:actors']))
+        self.assertEqual(payload['permissions'], ['get:actors'])
+
+    # test that a token with a tampered payload is rejected
+    def test_tampered_token_is_rejected(self):
+        header, _, signature = make_token(['get:actors']).split('.')
+        forged_claims = make_token(['delete:movies']).split('.')[1]
+        with self.assertRaises(auth.AuthError) as context:
+            auth.verify_decode_jwt('.'.join([header, forged_claims, signature]))
+        self.assertEqual(context.exception.status_code, 400)
+
+    # test that an expired token is still rejected
+    def test_expired_token_is_rejected(self):
+        with self.assertRaises(auth.AuthError) as context:
+            auth.verify_decode_jwt(make_token(['get:actors'], expires_in=-10))
+        self.assertEqual(context.exception.error['code'], 'token_expired')
+
+
+class permissionsTestCase(unittest.TestCase):
+    """This class represents the compiled permissions test case"""
+
+    def setUp(self):
+        self.payload = {'permissions': ['get:actors', 'get:movies']}
+        self.granted = frozenset(self.payload['permissions'])
+
+    # test that the token permissions are compiled into the cached entry
+    def test_verified_token_permissions(self):
+        saved = auth.jwks_cache
+        auth.jwks_cache = JWKSCache(
+            lambda: LOCAL_JWKS, key_builder=auth.build_public_key)
+        try:
+            verified = auth.verify_token(make_token(['get:actors']))
+        finally:
+            auth.jwks_cache = saved
+            auth.token_cache.clear()
+        self.assertEqual(verified.permissions, frozenset(['get:actors']))
+
+    # test that every permission is required by default
+    def test_match_all(self):
+        required = auth.compile_permissions(['get:actors', 'get:movies'])
+        self.assertTrue(auth.check_permissions(required, self.payload, self.granted))
+        required = auth.compile_permissions(['get:actors', 'post:actors'])
+        with self.assertRaises(auth.AuthError) as context:
+            auth.check_permissions(required, self.payload, self.granted)
+        self.assertEqual(context.exception.status_code, 403)
+
+    # test that one of the permissions is enough with match='any'
+    def test_match_any(self):
+        required = auth.compile_permissions(['post:actors', 'get:movies'])
+        self.assertTrue(auth.check_permissions(
+            required, self.payload, self.granted, match='any'))
+        with self.assertRaises(auth.AuthError):
+            auth.check_permissions(
+                frozenset(['post:actors']), self.payload, self.granted, match='any')
+
+    # test that a single string permission is still accepted
+    def test_string_permission(self):
+        self.assertTrue(auth.check_permissions('get:actors', self.payload))
+        with self.assertRaises(auth.AuthError):
+            auth.check_permissions('delete:actors', self.payload)
+
+    # test that an unknown match mode is refused at decoration time
+    def test_invalid_match(self):
+        with self.assertRaises(ValueError):
+            auth.requires_auth('get:actors', match='some')
+
+
+class paginationTestCase(localAuthTestCase):
+    """This class represents the keyset pagination test case"""
+
+    def setUp(self):
+        super().setUp()
+        for i in range(5):
+            Actor(name='actor_{}'.format(i), age=20 + i, gender='female').insert()
+
+    # test that following next_cursor walks every actor exactly once
+    def test_walk_pages(self):
+        headers = self.headers('get:actors')
+        names = []
+        url = '/actors?limit=2'
+        while True:
+            response = self.client().get(url, headers=headers)
+            data = json.loads(response.data)
+            self.assertEqual(response.status_code, 200)
+            self.assertLessEqual(len(data['actors']), 2)
+            names += [actor['name'] for actor in data['actors']]
+            if data['next_cursor'] is None:
+                break
+            url = '/actors?limit=2&after={}'.format(data['next_cursor'])
+        self.assertEqual(names, ['actor_{}'.format(i) for i in range(5)])
+
+    # test that the page size is capped by the server
+    def test_limit_is_clamped(self):
+        with unittest.mock.patch('queries.MAX_PAGE_SIZE', 3):
+            response = self.client().get('/actors?limit=1000',
+                headers=self.headers('get:actors'))
+        data = json.loads(response.data)
+        self.assertEqual(len(data['actors']), 3)
+        self.assertIsNotNone(data['next_cursor'])
+
+    # test that a malformed cursor is a bad request
+    def test_malformed_cursor(self):
+        response = self.client().get('/actors?after=not-a-cursor',
+            headers=self.headers('get:actors'))
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(data["success"], False)
+
+
+class exportTestCase(localAuthTestCase):
+    """This class represents the streaming export test case"""
+
+    def setUp(self):
+        super().setUp()
+        for i in range(5):
+            Movie(title='movie_{}'.format(i), release_date='2022-1-1').insert()
+
+    # test that the json export contains every movie across chunks
+    def test_export_json(self):
+        with unittest.mock.patch('queries.EXPORT_CHUNK_SIZE', 2):
+            response = self.client().get('/movies/export',
+                headers=self.headers('get:movies'))
+            data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data["success"], True)
+        self.assertEqual([movie['title'] for movie in data['movies']],
+                         ['movie_{}'.format(i) for i in range(5)])
+
+    # test that the ndjson export writes one movie per line
+    def test_export_ndjson(self):
+        response = self.client().get('/movies/export?format=ndjson',
+            headers=self.headers('get:movies'))
+        lines = response.data.decode().splitlines()
+        self.assertEqual(response.mimetype, 'application/x-ndjson')
+        self.assertEqual(len(lines), 5)
+        self.assertEqual(json.loads(lines[0])['title'], 'movie_0')
+
+    # test that the rows are encoded like the rows of the list pages
+    def test_export_matches_list_encoding(self):
+        headers = self.headers('get:movies')
+        page = self.client().get('/movies?limit=5', headers=headers).data
+        export = self.client().get('/movies/export', headers=headers).data
+        ndjson = self.client().get('/movies/export?format=ndjson', headers=headers).data
+        rows = json.loads(page)['movies']
+        self.assertEqual(export, encoding.dumps({'success': True, 'movies': rows}))
+        self.assertEqual(ndjson, b''.join(encoding.dumps(row) + b'\n' for row in rows))
+
+    # test that an empty table is still a valid json document
+    def test_export_empty_table(self):
+        response = self.client().get('/actors/export',
+            headers=self.headers('get:actors'))
+        self.assertEqual(json.loads(response.data), {'success': True, 'actors': []})
+
+
+class projectionTestCase(localAuthTestCase):
+    """This class represents the ?fields= projection test case"""
+
+    def setUp(self):
+        super().setUp()
+        Actor(name='actor_1', age=22, gender='male').insert()
+
+    # test that only the requested columns (and id) are returned
+    def test_fields_projection(self):
+        response = self.client().get('/actors?fields=name',
+            headers=self.headers('get:actors'))
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['actors'], [{'id': 1, 'name': 'actor_1'}])
+
+    # test that the projected rows are selected without building models
+    def test_projection_builds_no_models(self):
+        with self.app.test_request_context('/actors?fields=id,name'):
+            rows, _ = keyset_page(db.session,
+                select_fields(Actor, ('id', 'name')), Actor.id, None, 10)
+            self.assertEqual(tuple(rows[0]), (1, 'actor_1'))
+            self.assertEqual(len(db.session.identity_map), 0)
+
+    # test that an unknown field is a bad request
+    def test_unknown_field(self):
+        response = self.client().get('/actors?fields=name,salary',
+            headers=self.headers('get:actors'))
+        self.assertEqual(response.status_code, 400)
+
+    # test that the export honours the projection too
+    def test_export_projection(self):
+        response = self.client().get('/actors/export?format=ndjson&fields=name',
+            headers=self.headers('get:actors'))
+        self.assertEqual(json.loads(response.data), {'id': 1, 'name': 'actor_1'})
+
+
+class conditionalGetTestCase(localAuthTestCase):
+    """This class represents the ETag / 304 test case"""
+
+    def setUp(self):
+        super().setUp()
+        Actor(name='actor_1', age=22, gender='male').insert()
+
+    def get_actors(self, **headers):
+        headers.update(self.headers('get:actors'))
+        return self.client().get('/actors', headers=headers)
+
+    # test that an unchanged table is answered with 304
+    def test_if_none_match(self):
+        response = self.get_actors()
+        etag = response.headers['ETag']
+        self.assertEqual(response.status_code, 200)
+
+        response = self.get_actors(**{'If-None-Match': etag})
+        self.assertEqual(response.status_code, 304)
+        self.assertEqual(response.data, b'')
+        self.assertEqual(response.headers['ETag'], etag)
+
+    # test that every write changes the ETag
+    def test_writes_change_etag(self):
+        etag = self.get_actors().headers['ETag']
+        actor = Actor(name='actor_2', age=23, gender='female')
+        actor.insert()
+        response = self.get_actors(**{'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+
+        etag = response.headers['ETag']
+        actor.name = 'renamed'
+        actor.update()
+        self.assertNotEqual(self.get_actors().headers['ETag'], etag)
+
+    # test that different pages of the same table have different ETags
+    def test_etag_depends_on_query(self):
+        headers = self.headers('get:actors')
+        first = self.client().get('/actors?limit=1', headers=headers)
+        second = self.client().get('/actors?limit=2', headers=headers)
+        self.assertNotEqual(first.headers['ETag'], second.headers['ETag'])
+
+    # test that If-Modified-Since is honoured through Last-Modified
+    def test_if_modified_since(self):
+        last_modified = self.get_actors().headers['Last-Modified']
+        response = self.get_actors(**{'If-Modified-Since': last_modified})
+        self.assertEqual(response.status_code, 304)
+
+
+class responseCacheTestCase(localAuthTestCase):
+    """This class represents the list response cache test case"""
+
+    def setUp(self):
+        super().setUp()
+        self.response_cache = cache.response_cache
+        self.saved_backend = self.response_cache.backend
+        self.response_cache.backend = cache.LRUBackend()
+        self.response_cache.hits = cache.Counter()
+        self.response_cache.misses = cache.Counter()
+        Actor(name='actor_1', age=22, gender='male').insert()
+
+    def tearDown(self):
+        self.response_cache.backend = self.saved_backend
+        super().tearDown()
+
+    def get_actors(self, url='/actors'):
+        response = self.client().get(url, headers=self.headers('get:actors'))
+        return json.loads(response.data)
+
+    # test that a repeated page is served from the cache
+    def test_repeated_page_is_cached(self):
+        response_cache = self.response_cache
+        first = self.get_actors()
+        second = self.get_actors()
+        self.get_actors('/actors?fields=name')
+        self.assertEqual(first, second)
+        self.assertEqual(response_cache.hits.value, 1)
+        self.assertEqual(response_cache.misses.value, 2)
+        self.assertAlmostEqual(response_cache.hit_ratio(), 1 / 3)
+
+    # test that a write through the models invalidates the cached pages
+    def test_write_invalidates(self):
+        backend = self.response_cache.backend
+        self.get_actors()
+        self.assertEqual(len(backend), 1)
+        Actor(name='actor_2', age=23, gender='female').insert()
+        self.assertEqual(len(backend), 0)
+        self.assertEqual(len(self.get_actors()['actors']), 2)
+
+    # test that an encoded '&' in a value is not read as another argument
+    def test_key_escapes_values(self):
+        self.assertEqual(len(self.get_actors('/actors?gender=male&limit=1')['actors']), 1)
+        self.assertEqual(self.get_actors('/actors?gender=male%26limit%3D1')['actors'], [])
+        self.assertEqual(self.response_cache.hits.value, 0)
+
+    # test the shared backend against the local fake store
+    def test_shared_backend(self):
+        backend = cache.SharedBackend(cache.FakeSharedClient())
+        backend.set('actors', '1:/actors?', b'page')
+        self.assertEqual(backend.get('actors', '1:/actors?'), b'page')
+        backend.invalidate('actors')
+        self.assertIsNone(backend.get('actors', '1:/actors?'))
+
+    # test that the hit ratio is exported on /metrics
+    def test_metrics(self):
+        response = self.get_metrics()
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'response_cache_hit_ratio', response.data)
+        self.assertIn(b'token_cache_hits_total', response.data)
+
+    # test that /metrics is off without METRICS_TOKEN and needs the token otherwise
+    def test_metrics_token(self):
+        with unittest.mock.patch('app.METRICS_TOKEN', None):
+            self.assertEqual(self.client().get('/metrics').status_code, 404)
+        with unittest.mock.patch('app.METRICS_TOKEN', 'metrics-token'):
+            for headers in ({}, {'Authorization': 'Bearer other-token'},
+                            self.headers('get:actors')):
+                response = self.client().get('/metrics', headers=headers)
+                self.assertEqual(response.status_code, 401)
+                self.assertEqual(json.loads(response.data)['code'], 'invalid_metrics_token')
+
+
+class bulkCreateTestCase(localAuthTestCase):
+    """This class represents the bulk create test case"""
+
+    # test that every actor of the batch is inserted
+    def test_bulk_create_actors(self):
+        actors = [{'name': 'actor_{}'.format(i), 'age': 20 + i, 'gender': 'male'}
+                  for i in range(50)]
+        response = self.client().post('/actors/bulk',
+            headers=self.headers('post:actors'), json=actors)
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['created'], 50)
+        with self.app.app_context():
+            self.assertEqual(Actor.query.count(), 50)
+
+    # test that invalid items are reported per item and nothing is inserted
+    def test_bulk_create_reports_errors(self):
+        movies = [
+            {'title': 'movie_1', 'release_date': '2022-1-1'},
+            {'title': 'movie_2', 'release_date': 202211},
+            {'release_date': '2022-1-1'}
+        ]
+        response = self.client().post('/movies/bulk',
+            headers=self.headers('post:movies'), json=movies)
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual([error['index'] for error in data['errors']], [1, 2])
+        self.assertIn('release_date', data['errors'][0]['errors'])
+        self.assertEqual(data['errors'][1]['errors']['title'], 'is required')
+        with self.app.app_context():
+            self.assertEqual(Movie.query.count(), 0)
+
+    # test that the bulk endpoint needs the post permission
+    def test_bulk_create_permission(self):
+        response = self.client().post('/movies/bulk',
+            headers=self.headers('post:actors'), json=[{'title': 't'}])
+        self.assertEqual(response.status_code, 403)
+
+
+class bulkEditDeleteTestCase(localAuthTestCase):
+    """This class represents the bulk PATCH / DELETE test case"""
+
+    def setUp(self):
+        super().setUp()
+        for i in range(4):
+            Actor(name='actor_{}'.format(i), age=20, gender='male').insert()
+
+    # test that listed ids are updated and unknown ids are reported missing
+    def test_bulk_edit_by_ids(self):
+        response = self.client().patch('/actors/bulk',
+            headers=self.headers('patch:actors'),
+            json={'ids': [1, 2, 99], 'changes': {'age': 30}})
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['matched'], [1, 2])
+        self.assertEqual(data['missing'], [99])
+        with self.app.app_context():
+            self.assertEqual(Actor.query.filter_by(age=30).count(), 2)
+
+    # test that a filter predicate selects the rows to delete
+    def test_bulk_delete_by_filter(self):
+        Actor(name='actor_4', age=20, gender='female').insert()
+        response = self.client().delete('/actors/bulk',
+            headers=self.headers('delete:actors'),
+            json={'filter': {'gender': 'male'}})
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(data['matched'], [1, 2, 3, 4])
+        self.assertNotIn('missing', data)
+        with self.app.app_context():
+            self.assertEqual([actor.name for actor in Actor.query.all()], ['actor_4'])
+
+    # test that invalid changes and unknown filter columns are refused
+    def test_bulk_edit_validation(self):
+        headers = self.headers('patch:actors')
+        response = self.client().patch('/actors/bulk', headers=headers,
+            json={'ids': [1], 'changes': {'age': 'old'}})
+        self.assertEqual(response.status_code, 422)
+        response = self.client().patch('/actors/bulk', headers=headers,
+            json={'filter': {'salary': 1}, 'changes': {'age': 1}})
+        self.assertEqual(response.status_code, 400)
+
+    # test that filter values of the wrong type are refused
+    def test_bulk_filter_validation(self):
+        headers = self.headers('patch:actors')
+        for predicate in ({'age': 'abc'}, {'age': True}, {'age': [20]},
+                          {'name': 5}, {'gender': {'eq': 'male'}}):
+            response = self.client().patch('/actors/bulk', headers=headers,
+                json={'filter': predicate, 'changes': {'age': 1}})
+            self.assertEqual(response.status_code, 400)
+        response = self.client().patch('/actors/bulk', headers=headers,
+            json={'filter': {'age': '20'}, 'changes': {'age': 21}})
+        self.assertEqual(json.loads(response.data)['matched'], [1, 2, 3, 4])
+
+    # test that the ids without RETURNING are looked up and written in batches
+    def test_bulk_write_batches(self):
+        statements = []
+        with self.app.app_context():
+            engine = db.engine
+            returning = engine.dialect.full_returning
+
+            def count(conn, cursor, statement, parameters, *args):
+                if statement.startswith(('UPDATE actors', 'SELECT actors.id')):
+                    statements.append((statement.split()[0], len(parameters)))
+            event.listen(engine, 'before_cursor_execute', count)
+            engine.dialect.full_returning = False
+        try:
+            with unittest.mock.patch.object(models, 'BULK_WRITE_BATCH', 3):
+                by_filter = self.client().patch('/actors/bulk',
+                    headers=self.headers('patch:actors'),
+                    json={'filter': {'gender': 'male'}, 'changes': {'age': 30}})
+                filter_statements, statements[:] = statements[:], []
+                by_ids = self.client().patch('/actors/bulk',
+                    headers=self.headers('patch:actors'),
+                    json={'ids': [1, 2, 3, 4, 99], 'changes': {'age': 31}})
+        finally:
+            engine.dialect.full_returning = returning
+            event.remove(engine, 'before_cursor_execute', count)
+        self.assertEqual(json.loads(by_filter.data)['matched'], [1, 2, 3, 4])
+        self.assertEqual([name for name, _ in filter_statements], ['SELECT', 'UPDATE', 'UPDATE'])
+        # the ids are looked up in batches too, no statement binds more than 3 of them
+        self.assertEqual(json.loads(by_ids.data)['matched'], [1, 2, 3, 4])
+        self.assertEqual([name for name, _ in statements],
+                         ['SELECT', 'UPDATE', 'SELECT', 'UPDATE'])
+        self.assertTrue(all(size <= 4 for _, size in statements))
+        with self.app.app_context():
+            self.assertEqual(Actor.query.filter_by(age=31).count(), 4)
+
+
+class poolTestCase(unittest.TestCase):
+    """This class represents the connection pool configuration test case"""
+
+    # test that Postgres gets the sized, pre-pinged and instrumented pool
+    def test_postgres_engine_options(self):
+        with unittest.mock.patch('models.DB_STATEMENT_TIMEOUT', 5000):
+            options = models.engine_options('postgresql://localhost/capstone')
+        self.assertIs(options['poolclass'], models.TimedQueuePool)
+        self.assertEqual(options['pool_size'], models.DB_POOL_SIZE)
+        self.assertTrue(options['pool_pre_ping'])
+        self.assertEqual(options['connect_args'],
+                         {'options': '-c statement_timeout=5000'})
+
+    # test that SQLite keeps its own pool class
+    def test_sqlite_engine_options(self):
+        options = models.engine_options('sqlite:///capstone.db')
+        self.assertNotIn('poolclass', options)
+        self.assertNotIn('connect_args', options)
+
+    # test that checkouts are timed and the saturation is exported
+    def test_pool_metrics(self):
+        engine = create_engine('sqlite://',
+            poolclass=models.TimedQueuePool, pool_size=1, max_overflow=1)
+        observed = models.pool_checkout_wait.count
+        connection = engine.connect()
+        self.assertEqual(models.pool_checkout_wait.count, observed + 1)
+        self.assertIn('db_pool_saturation', models.registry.render())
+        connection.close()
+        engine.dispose()
+
+
+class castTestCase(localAuthTestCase):
+    """This class represents the movie cast test case"""
+
+    def setUp(self):
+        super().setUp()
+        for i in range(3):
+            Actor(name='actor_{}'.format(i), age=20, gender='male').insert()
+            Movie(title='movie_{}'.format(i), release_date='2022-1-1').insert()
+
+    def link(self, movie_id, actor_ids):
+        return self.client().post('/movies/{}/actors'.format(movie_id),
+            headers=self.headers('patch:movies'), json={'actor_ids': actor_ids})
+
+    def count_queries(self, url, headers):
+        statements = []
+        def count(conn, cursor, statement, parameters, context, executemany):
+            statements.append(statement)
+        with self.app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', count)
+            try:
+                response = self.client().get(url, headers=headers)
+            finally:
+                event.remove(db.engine, 'before_cursor_execute', count)
+        return response, len(statements)
+
+    # test that actors are added to a cast and listed from both sides
+    def test_cast_endpoints(self):
+        data = json.loads(self.link(1, [1, 2, 99]).data)
+        self.assertEqual(data['actors'], [1, 2])
+        self.assertEqual(data['missing'], [99])
+
+        headers = self.headers('get:movies', 'get:actors')
+        data = json.loads(self.client().get('/movies/1/actors', headers=headers).data)
+        self.assertEqual([actor['name'] for actor in data['actors']], ['actor_0', 'actor_1'])
+        data = json.loads(self.client().get('/actors/2/movies', headers=headers).data)
+        self.assertEqual([movie['title'] for movie in data['movies']], ['movie_0'])
+
+        response = self.client().get('/movies/99/actors', headers=headers)
+        self.assertEqual(response.status_code, 404)
+
+    # test that removing a movie removes it from the cast lists
+    def test_delete_cascades_to_cast(self):
+        self.link(1, [1])
+        self.client().delete('/movies/1', headers=self.headers('delete:movies'))
+        data = json.loads(self.client().get('/actors/1/movies',
+            headers=self.headers('get:movies', 'get:actors')).data)
+        self.assertEqual(data['movies'], [])
+
+    # test that ?include=cast costs the same number of queries for any page size
+    def test_include_cast_query_count(self):
+        self.link(1, [1, 2])
+        self.link(2, [3])
+        headers = self.headers('get:movies')
+        response, one_movie = self.count_queries('/movies?include=cast&limit=1', headers)
+        self.assertEqual(len(json.loads(response.data)['movies']), 1)
+        response, all_movies = self.count_queries('/movies?include=cast&fields=title', headers)
+        data = json.loads(response.data)
+        self.assertEqual(one_movie, all_movies)
+        self.assertEqual([len(movie['cast']) for movie in data['movies']], [2, 1, 0])
+        self.assertEqual(data['movies'][0]['cast'][0]['name'], 'actor_0')
+
+    # test that renaming an actor changes the ETag of the movies with their cast
+    def test_include_cast_etag(self):
+        headers = self.headers('get:movies')
+        etag = self.client().get('/movies?include=cast', headers=headers).headers['ETag']
+        with self.app.app_context():
+            actor = Actor.query.get(1)
+            actor.name = 'renamed'
+            actor.update()
+        response = self.client().get('/movies?include=cast',
+            headers=dict(headers, **{'If-None-Match': etag}))
+        self.assertEqual(response.status_code, 200)
+
+
+class filterTestCase(localAuthTestCase):
+    """This class represents the list filters test case"""
+
+    def setUp(self):
+        super().setUp()
+        Actor(name='Tom Hanks', age=65, gender='male').insert()
+        Actor(name='Tom_Cruise', age=59, gender='male').insert()
+        Actor(name='Meryl Streep', age=72, gender='female').insert()
+        Movie(title='Cast Away', release_date='2000-12-22').insert()
+        Movie(title='Top Gun', release_date='1986-05-16').insert()
+
+    def names(self, url, permission='get:actors', key='actors', field='name'):
+        response = self.client().get(url, headers=self.headers(permission))
+        self.assertEqual(response.status_code, 200)
+        return [row[field] for row in json.loads(response.data)[key]]
+
+    # test the prefix, substring, range and equality filters
+    def test_actor_filters(self):
+        self.assertEqual(self.names('/actors?name_prefix=Tom'), ['Tom Hanks', 'Tom_Cruise'])
+        self.assertEqual(self.names('/actors?name_contains=streep'), ['Meryl Streep'])
+        self.assertEqual(self.names('/actors?age_min=60&age_max=70'), ['Tom Hanks'])
+        self.assertEqual(self.names('/actors?gender=female'), ['Meryl Streep'])
+        self.assertEqual(self.names('/actors?name_prefix=Tom&age_max=60'), ['Tom_Cruise'])
+
+    # test that LIKE wildcards in a filter value are matched literally
+    def test_wildcards_are_escaped(self):
+        self.assertEqual(self.names('/actors?name_prefix=Tom_'), ['Tom_Cruise'])
+        self.assertEqual(self.names('/actors?name_contains=%25%25%25'), [])
+
+    # test the release date range of the movies
+    def test_release_date_range(self):
+        titles = self.names('/movies?release_from=1990-01-01', 'get:movies',
+                            'movies', 'title')
+        self.assertEqual(titles, ['Cast Away'])
+        titles = self.names('/movies?release_to=1990-01-01&title_prefix=Top',
+                            'get:movies', 'movies', 'title')
+        self.assertEqual(titles, ['Top Gun'])
+
+    # test that filters forcing a full scan or malformed ones are refused
+    def test_refused_filters(self):
+        headers = self.headers('get:actors', 'get:movies')
+        for url in ('/actors?name_contains=om', '/actors?name_prefix=',
+                    '/actors?age_min=old', '/actors?age_min=70&age_max=60',
+                    '/movies?release_from=22/12/2000'):
+            response = self.client().get(url, headers=headers)
+            self.assertEqual(response.status_code, 400, url)
+
+    # test that the export is narrowed by the same filters
+    def test_export_filters(self):
+        response = self.client().get('/actors/export?format=ndjson&gender=female',
+            headers=self.headers('get:actors'))
+        lines = response.data.decode().splitlines()
+        self.assertEqual([json.loads(line)['name'] for line in lines], ['Meryl Streep'])
+
+
+class releaseDateTestCase(localAuthTestCase):
+    """This class represents the typed release date test case"""
+
+    def post_movie(self, release_date):
+        return self.client().post('/movies', json={
+            'title': 'movie_1',
+            'release_date': release_date
+        }, headers=self.headers('post:movies'))
+
+    # test that dates are stored as dates and returned in ISO form
+    def test_release_date_is_a_date(self):
+        self.assertEqual(self.post_movie('2022-1-2').status_code, 200)
+        with self.app.app_context():
+            self.assertEqual(Movie.query.get(1).release_date, datetime.date(2022, 1, 2))
+        data = json.loads(self.client().get('/movies',
+            headers=self.headers('get:movies')).data)
+        self.assertEqual(data['movies'][0]['release_date'], '2022-01-02')
+
+    # test that dates which do not parse are refused
+    def test_invalid_release_date(self):
+        for release_date in ('2022-13-01', 'next year', 20220101):
+            self.assertEqual(self.post_movie(release_date).status_code, 422)
+        response = self.client().post('/movies/bulk',
+            json=[{'title': 'movie_1', 'release_date': '2022-02-30'}],
+            headers=self.headers('post:movies'))
+        data = json.loads(response.data)
+        self.assertEqual(response.status_code, 422)
+        self.assertIn('release_date', data['errors'][0]['errors'])
+
+    # test that dates compare as dates, not as strings
+    def test_release_date_range_is_chronological(self):
+        self.post_movie('2022-9-1')
+        self.post_movie('2022-10-1')
+        data = json.loads(self.client().get('/movies?release_from=2022-09-15',
+            headers=self.headers('get:movies')).data)
+        self.assertEqual([movie['release_date'] for movie in data['movies']],
+                         ['2022-10-01'])
+
+
+class searchTestCase(localAuthTestCase):
+    """This class represents the /search test case"""
+
+    def setUp(self):
+        super().setUp()
+        Actor(name='Tom Hanks', age=65, gender='male').insert()
+        Actor(name='Tom Holland', age=25, gender='male').insert()
+        Actor(name='Meryl Streep', age=72, gender='female').insert()
+        Movie(title='The Post', release_date='2017-12-22').insert()
+        Movie(title='Cast Away', release_date='2000-12-22').insert()
+
+    def search(self, q, **headers):
+        headers.update(self.headers('get:actors', 'get:movies'))
+        return self.client().get('/search?q=' + q, headers=headers)
+
+    # test that actors and movies are matched on whole words and prefixes
+    def test_search(self):
+        data = json.loads(self.search('tom hol').data)
+        self.assertEqual([actor['name'] for actor in data['actors']], ['Tom Holland'])
+        self.assertEqual(data['movies'], [])
+
+        data = json.loads(self.search('po').data)
+        self.assertEqual(data['actors'], [])
+        self.assertEqual([movie['title'] for movie in data['movies']], ['The Post'])
+        self.assertEqual(data['movies'][0]['release_date'], '2017-12-22')
+
+    # test that the index follows updates and deletes
+    def test_search_follows_writes(self):
+        with self.app.app_context():
+            actor = Actor.query.get(3)
+            actor.name = 'Meryl Tomlin'
+            actor.update()
+            Actor.query.get(1).delete()
+        data = json.loads(self.search('tom').data)
+        self.assertEqual([actor['name'] for actor in data['actors']],
+                         ['Tom Holland', 'Meryl Tomlin'])
+
+    # test that the substring match of other databases takes '_' literally
+    def test_generic_search_escapes_wildcards(self):
+        Actor(name='Tim_Roth', age=60, gender='male').insert()
+        statement = search.search_statement('generic', Actor, ['m_'], 10)
+        with self.app.app_context():
+            rows = db.session.execute(statement).all()
+        self.assertEqual([row.name for row in rows], ['Tim_Roth'])
+
+    # test that short queries and missing permissions are refused
+    def test_search_refused(self):
+        self.assertEqual(self.search('t').status_code, 400)
+        self.assertEqual(self.search('"*"').status_code, 400)
+        response = self.client().get('/search?q=tom',
+            headers=self.headers('get:actors'))
+        self.assertEqual(response.status_code, 403)
+
+    # test that unchanged results are answered with 304
+    def test_search_etag(self):
+        etag = self.search('tom').headers['ETag']
+        self.assertEqual(self.search('tom', **{'If-None-Match': etag}).status_code, 304)
+        Movie(title='Tomb Raider', release_date='2001-6-15').insert()
+        response = self.search('tom', **{'If-None-Match': etag})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(json.loads(response.data)['movies']), 1)
+
+
+class timingTestCase(localAuthTestCase):
+    """This class represents the per-request timing test case"""
+
+    def setUp(self):
+        super().setUp()
+        Actor(name='actor_1', age=22, gender='male').insert()
+
+    def server_timing(self, response):
+        entries = {}
+        for entry in response.headers['Server-Timing'].split(', '):
+            name, *params = entry.split(';')
+            entries[name] = dict(param.split('=', 1) for param in params)
+        return entries
+
+    # test that the phases and the statements of a request are reported
+    def test_server_timing_header(self):
+        response = self.client().get('/actors', headers=self.headers('get:actors'))
+        entries = self.server_timing(response)
+        self.assertEqual(set(entries), {'auth', 'db', 'serialize', 'app', 'total'})
+        # the table version lookup and the page
+        self.assertEqual(entries['db']['desc'], '"2 queries"')
+        self.assertGreater(float(entries['auth']['dur']), 0)
+        phases = sum(float(entries[name]['dur']) for name in ('auth', 'db', 'serialize', 'app'))
+        self.assertAlmostEqual(phases, float(entries['total']['dur']), delta=0.1)
+
+    # test that failed authentication is timed too
+    def test_auth_failure_is_timed(self):
+        response = self.client().get('/actors')
+        self.assertEqual(response.status_code, 401)
+        self.assertEqual(self.server_timing(response)['db']['desc'], '"0 queries"')
+
+    # test that the per-route histograms are exposed on /metrics
+    def test_route_histograms(self):
+        self.client().get('/actors/1/movies', headers=self.headers('get:actors', 'get:movies'))
+        metrics = self.get_metrics().data.decode()
+        labels = 'method="GET",route="/actors/<int:id>/movies"'
+        self.assertIn('http_request_duration_seconds_count{' + labels + '}', metrics)
+        self.assertIn('http_request_phase_seconds_count{method="GET",phase="db",'
+                      'route="/actors/<int:id>/movies"}', metrics)
+        self.assertIn('http_request_sql_statements_bucket{le="+Inf",' + labels + '}', metrics)
+
+
+class queryDiagnosticsTestCase(localAuthTestCase):
+    """This class represents the slow query log and N+1 detector test case"""
+
+    def setUp(self):
+        super().setUp()
+        self.diagnostics = models.query_diagnostics
+        self.diagnostics.clear()
+        self.diagnostics.enabled = True
+        for i in range(8):
+            Movie(title='movie_{}'.format(i), release_date='2022-1-1').insert()
+
+    def tearDown(self):
+        self.diagnostics.enabled = False
+        self.diagnostics.slow_query_ms = models.SLOW_QUERY_MS
+        self.diagnostics.clear()
+        super().tearDown()
+
+    # test that slow statements are reported with their route and parameters
+    def test_slow_query_log(self):
+        self.diagnostics.slow_query_ms = 0
+        with self.assertLogs('capstone.queries', 'WARNING'):
+            self.client().get('/movies?limit=3', headers=self.headers('get:movies'))
+        reports = self.diagnostics.reports_of('slow_query')
+        self.assertTrue(reports)
+        self.assertEqual({report['route'] for report in reports}, {'/movies'})
+        self.assertIn('4', reports[-1]['parameters'])
+
+    # test that lazy loading the cast of each movie is flagged as N+1
+    def test_n_plus_one_detected(self):
+        with self.app.test_request_context('/movies'):
+            for movie in Movie.query.all():
+                movie.actors
+        reports = self.diagnostics.reports_of('n_plus_one')
+        self.assertEqual(len(reports), 1)
+        self.assertEqual(reports[0]['route'], '/movies')
+        self.assertEqual(reports[0]['count'], 8)
+        self.assertIn('movie_actors', reports[0]['statement'])
+
+    # test that the eager loaded ?include=cast is not flagged
+    def test_include_is_not_n_plus_one(self):
+        response = self.client().get('/movies?include=cast',
+            headers=self.headers('get:movies'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.diagnostics.reports_of('n_plus_one'), [])
+
+    # test that statements differing only in their parameters share a shape
+    def test_statement_shape(self):
+        shape = models.QueryDiagnostics.shape
+        self.assertEqual(shape('SELECT * FROM actors WHERE id IN (?, ?,\n ?)'),
+                         shape('SELECT * FROM actors WHERE id IN (?)'))
+
+
+@unittest.skipIf(asgi is None, 'the ASGI mode needs requirements-asgi.txt')
+class asgiTestCase(localAuthTestCase):
+    """This class represents the ASGI serving mode test case"""
+
+    def setUp(self):
+        super().setUp()
+        # render every page, so both modes build their own body
+        self.saved_backend = cache.response_cache.backend
+        cache.response_cache.backend = cache.NullBackend()
+        self.asgi_app = asgi.AsgiApp(self.app, os.environ['DATABASE_TEST_URL'])
+        self.delegated = []
+        wsgi = self.asgi_app.wsgi
+
+        async def spy(scope, receive, send):
+            self.delegated.append(scope['path'])
+            await wsgi(scope, receive, send)
+        self.asgi_app.wsgi = spy
+
+        Actor(name='actor_1', age=22, gender='male').insert()
+        Actor(name='actor_2', age=45, gender='female').insert()
+        Movie(title='movie_1', release_date='2022-1-1').insert()
+
+    def tearDown(self):
+        cache.response_cache.backend = self.saved_backend
+        super().tearDown()
+
+    def asgi_request(self, method, url, headers=None, body=b''):
+        status, response_headers, body = asgi_request(
+            self.asgi_app, method, url, headers, body)
+        return status, {name.lower(): value for name, value in response_headers}, body
+
+    # test that the lists are served natively with the bytes of the WSGI app
+    def test_native_list_matches_wsgi(self):
+        headers = self.headers('get:actors', 'get:movies')
+        for url in ('/actors', '/actors?limit=1', '/actors?fields=name&age_min=30', '/movies',
+                    '/actors?shape=columnar'):
+            status, asgi_headers, body = self.asgi_request('GET', url, headers)
+            response = self.client().get(url, headers=headers)
+            self.assertEqual(status, 200)
+            self.assertEqual(body, response.data)
+            self.assertEqual(asgi_headers['etag'], response.headers['ETag'])
+            self.assertEqual(asgi_headers['content-type'], response.headers['Content-Type'])
+        self.assertEqual(self.delegated, [])
+
+    # test that the native path sends the headers of the WSGI app
+    def test_native_headers_match_wsgi(self):
+        headers = dict(self.headers('get:actors'),
+                       **{'Origin': 'https://casting.example', 'Accept-Encoding': 'gzip'})
+        with unittest.mock.patch.object(encoding, 'COMPRESS_MIN_SIZE', 0):
+            _, asgi_headers, _ = asgi_request(self.asgi_app, 'GET', '/actors', headers)
+            response = self.client().get('/actors', headers=headers)
+        self.assertEqual(self.delegated, [])
+
+        def tokens(values):
+            return {token.strip() for value in values for token in value.split(',')}
+        for name in ('Access-Control-Allow-Origin', 'Cache-Control', 'Content-Encoding',
+                     'Content-Type', 'ETag', 'Last-Modified'):
+            self.assertEqual([value for key, value in asgi_headers if key.lower() == name.lower()],
+                             response.headers.getlist(name), name)
+        self.assertEqual(tokens(value for key, value in asgi_headers if key.lower() == 'vary'),
+                         tokens(response.headers.getlist('Vary')))
+        server_timing = [value for key, value in asgi_headers if key.lower() == 'server-timing']
+        self.assertEqual(
+            [entry.split(';')[0] for entry in server_timing[0].split(', ')],
+            [entry.split(';')[0] for entry in response.headers['Server-Timing'].split(', ')])
+
+    # test that the native path compresses like the WSGI app
+    def test_native_compression(self):
+        headers = dict(self.headers('get:actors'), **{'Accept-Encoding': 'gzip'})
+        with unittest.mock.patch.object(encoding, 'COMPRESS_MIN_SIZE', 0):
+            status, asgi_headers, body = self.asgi_request('GET', '/actors', headers)
+            response = self.client().get('/actors', headers=headers)
+        self.assertEqual(status, 200)
+        self.assertEqual(asgi_headers['content-encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(body), gzip.decompress(response.data))
+        self.assertEqual(self.delegated, [])
+
+    # test that a statement the database refuses is answered with the 422 of the WSGI app
+    def test_native_database_errors(self):
+        headers = self.headers('get:actors')
+        for url in ('/actors?age_min=99999999999999999999',
+                    '/actors?after=' + queries.encode_cursor(10 ** 20)):
+            status, asgi_headers, body = self.asgi_request('GET', url, headers)
+            response = self.client().get(url, headers=headers)
+            self.assertEqual(response.status_code, 422)
+            self.assertEqual(status, 422)
+            self.assertEqual(body, response.data)
+            self.assertEqual(asgi_headers['content-type'], response.headers['Content-Type'])
+        self.assertEqual(self.delegated, [])
+
+    # test that the native path answers conditional requests with 304
+    def test_native_not_modified(self):
+        headers = self.headers('get:actors')
+        _, asgi_headers, _ = self.asgi_request('GET', '/actors', headers)
+        headers['If-None-Match'] = asgi_headers['etag']
+        status, _, body = self.asgi_request('GET', '/actors', headers)
+        self.assertEqual(status, 304)
+        self.assertEqual(body, b'')
+        self.assertEqual(self.delegated, [])
+
+    # test that failed authentication and invalid arguments get the WSGI errors
+    def test_errors_are_delegated(self):
+        status, _, body = self.asgi_request('GET', '/actors')
+        self.assertEqual(status, 401)
+        status, _, _ = self.asgi_request('GET', '/actors', self.headers('get:movies'))
+        self.assertEqual(status, 403)
+        status, _, _ = self.asgi_request('GET', '/actors?limit=0', self.headers('get:actors'))
+        self.assertEqual(status, 400)
+        self.assertEqual(self.delegated, ['/actors'] * 3)
+
+    # test that the requests handed to the WSGI app run side by side
+    def test_delegated_requests_run_in_parallel(self):
+        barrier = threading.Barrier(2, timeout=5)
+        insert = Actor.insert
+
+        def waiting_insert(actor):
+            barrier.wait()
+            insert(actor)
+
+        def post(name):
+            statuses.append(self.asgi_request('POST', '/actors', headers, json.dumps(
+                {'name': name, 'age': 30, 'gender': 'male'}).encode())[0])
+
+        headers = dict(self.headers('post:actors'), **{'Content-Type': 'application/json'})
+        statuses = []
+        with unittest.mock.patch.object(Actor, 'insert', waiting_insert):
+            threads = [threading.Thread(target=post, args=('actor_{}'.format(i),))
+                       for i in (3, 4)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        self.assertEqual(statuses, [200, 200])
+
+    # test that the native path answers the rate limits itself, charging once
+    def test_native_rate_limits(self):
+        saved_limiter = auth.limiter
+        auth.limiter = ratelimit.RateLimiter(ratelimit.MemoryStore(), rate=0.001, burst=2,
+                                             permission_limits={}, concurrency=1)
+        headers = self.headers('get:actors')
+        try:
+            # another request of the subject is in flight
+            auth.limiter.store.enter('auth0|local', 1)
+            status, _, body = self.asgi_request('GET', '/actors', headers)
+            self.assertEqual(status, 429)
+            self.assertEqual(json.loads(body)['code'], 'too_many_in_flight')
+            auth.limiter.store.leave('auth0|local')
+
+            # the refused request took one token of the burst, not two
+            status, _, _ = self.asgi_request('GET', '/actors', headers)
+            self.assertEqual(status, 200)
+            status, asgi_headers, body = self.asgi_request('GET', '/actors', headers)
+            self.assertEqual(status, 429)
+            self.assertEqual(asgi_headers['retry-after'], '1000')
+            self.assertEqual(body, self.client().get('/actors', headers=headers).data)
+        finally:
+            auth.limiter = saved_limiter
+        self.assertEqual(self.delegated, [])
+
+    # test that the other routes are served by the WSGI app
+    def test_other_routes_are_delegated(self):
+        headers = self.headers('get:actors', 'post:actors')
+        headers['Content-Type'] = 'application/json'
+        status, _, body = self.asgi_request(
+            'POST', '/actors', headers,
+            json.dumps({'name': 'actor_3', 'age': 30, 'gender': 'male'}).encode())
+        self.assertEqual(status, 200)
+        self.assertTrue(json.loads(body)['success'])
+
+        status, _, body = self.asgi_request('GET', '/actors?include=movies', headers)
+        self.assertEqual(status, 200)
+        self.assertEqual(len(json.loads(body)['actors']), 3)
+        self.assertEqual(self.delegated, ['/actors', '/actors'])
+
+    # test that the engine of the database is mapped to its asyncio driver
+    def test_async_engine_options(self):
+        url, options = asgi.async_engine_options('sqlite:////tmp/capstone.db')
+        self.assertEqual(url, 'sqlite+aiosqlite:////tmp/capstone.db')
+        self.assertNotIn('pool_size', options)
+        url, options = asgi.async_engine_options('postgresql://user@localhost:5432/capstone')
+        self.assertEqual(url, 'postgresql+asyncpg://user@localhost:5432/capstone')
+        self.assertEqual(options['pool_size'], models.DB_POOL_SIZE)
+
+
+class startupTestCase(localAuthTestCase):
+    """This class represents the application startup test case"""
+
+    # test that building the app does not touch the database
+    def test_create_app_without_database(self):
+        url = 'postgresql://capstone@127.0.0.1:1/unreachable'
+        with unittest.mock.patch.dict(os.environ, {'DATABASE_URL': url}):
+            app = create_app()
+        self.assertEqual(app.config['SQLALCHEMY_DATABASE_URI'], url)
+        self.assertEqual(app.test_client().get('/').status_code, 200)
+        # restore the binding of the shared db to the test database
+        setup_db(self.app, os.environ['DATABASE_TEST_URL'])
+
+    # test that the tables are left to the migrations unless asked for
+    def test_create_tables(self):
+        with tempfile.TemporaryDirectory() as directory:
+            url = 'sqlite:///' + os.path.join(directory, 'startup.db')
+            app = create_app()
+            setup_db(app, url)
+            with app.app_context():
+                self.assertEqual(inspect(db.engine).get_table_names(), [])
+            setup_db(app, url, create_tables=True)
+            with app.app_context():
+                self.assertIn('actors', inspect(db.engine).get_table_names())
+                db.engine.dispose()
+        setup_db(self.app, os.environ['DATABASE_TEST_URL'])
+
+    # test that a forked worker gets new pools instead of the parent connections
+    def test_engines_reset_after_fork(self):
+        with self.app.app_context():
+            engine = db.engine
+            Actor.query.count()
+            pool = engine.pool
+            # a connection the parent is using when it forks
+            parent_connection = engine.connect()
+            models.reset_engines_after_fork()
+            self.assertIn(engine, models.engines)
+            self.assertIsNot(engine.pool, pool)
+            self.assertEqual(Actor.query.count(), 0)
+            # the child left it open
+            self.assertEqual(parent_connection.exec_driver_sql('SELECT 1').scalar(), 1)
+            parent_connection.close()
+
+    # test that the migrations build the schema of the models on an empty database
+    def test_migrations_on_empty_database(self):
+        script = ('from flask_migrate import Migrate, upgrade\n'
+                  'from app import app\n'
+                  'from models import db\n'
+                  'Migrate(app, db)\n'
+                  'with app.app_context():\n'
+                  '    upgrade()\n')
+        with tempfile.TemporaryDirectory() as directory:
+            url = 'sqlite:///' + os.path.join(directory, 'fresh.db')
+            process = subprocess.run(
+                [sys.executable, '-c', script], env=dict(os.environ, DATABASE_URL=url),
+                capture_output=True, cwd=os.path.dirname(os.path.abspath(__file__)), text=True)
+            self.assertEqual(process.returncode, 0, process.stderr)
+            engine = create_engine(url)
+            tables = inspect(engine).get_table_names()
+            engine.dispose()
+        for table in db.metadata.tables:
+            self.assertIn(table, tables)
+
+    # test that the app does not start while a required setting is missing
+    def test_required_settings(self):
+        for name in ('DATABASE_URL', 'AUTH0_DOMAIN', 'API_AUDIENCE'):
+            env = {key: value for key, value in os.environ.items() if key != name}
+            process = subprocess.run(
+                [sys.executable, '-c', 'import app'], env=env, capture_output=True,
+                cwd=os.path.dirname(os.path.abspath(__file__)), text=True)
+            self.assertNotEqual(process.returncode, 0)
+            self.assertIn("KeyError: '{}'".format(name), process.stderr)
+
+
+class replicaTestCase(localAuthTestCase):
+    """This class represents the read replica routing test case"""
+
+    def setUp(self):
+        super().setUp()
+        # render every page, so each response comes from the database
+        self.saved_backend = cache.response_cache.backend
+        cache.response_cache.backend = cache.NullBackend()
+        self.router = replicas.replica_router
+        self.directory = tempfile.TemporaryDirectory()
+        self.replica_paths = ['sqlite:///' + os.path.join(self.directory.name, name)
+                              for name in ('replica_0.db', 'replica_1.db')]
+        setup_db(self.app, os.environ['DATABASE_TEST_URL'], replica_paths=self.replica_paths)
+        self.seed_replicas()
+        Actor(name='primary', age=22, gender='male').insert()
+
+    def tearDown(self):
+        with self.app.app_context():
+            for key in self.app.config['SQLALCHEMY_BINDS']:
+                db.get_engine(self.app, bind=key).dispose()
+        setup_db(self.app, os.environ['DATABASE_TEST_URL'], replica_paths=[])
+        self.router.clear()
+        cache.response_cache.backend = self.saved_backend
+        self.directory.cleanup()
+        super().tearDown()
+
+    def seed_replicas(self):
+        with self.app.app_context():
+            for index in range(len(self.replica_paths)):
+                engine = db.get_engine(self.app, bind='replica_{}'.format(index))
+                db.Model.metadata.create_all(engine)
+                with engine.begin() as connection:
+                    connection.execute(Actor.__table__.insert(), {
+                        'name': 'replica_{}'.format(index), 'age': 30, 'gender': 'female'})
+
+    def names(self, subject='auth0|reader'):
+        headers = {'Authorization': 'Bearer {}'.format(
+            make_token(['get:actors'], subject=subject))}
+        response = self.client().get('/actors', headers=headers)
+        self.assertEqual(response.status_code, 200)
+        return [actor['name'] for actor in json.loads(response.data)['actors']]
+
+    # test that reads are spread round-robin over the replicas
+    def test_reads_round_robin(self):
+        self.assertEqual([self.names() for _ in range(4)],
+                         [['replica_0'], ['replica_1'], ['replica_0'], ['replica_1']])
+
+    # test that writes go to the primary and their client reads them back
+    def test_read_your_writes(self):
+        headers = {'Authorization': 'Bearer {}'.format(
+            make_token(['post:actors'], subject='auth0|writer'))}
+        response = self.client().post('/actors', headers=headers, json={
+            'name': 'written', 'age': 40, 'gender': 'male'})
+        self.assertEqual(response.status_code, 200)
+
+        self.assertEqual(self.names('auth0|writer'), ['primary', 'written'])
+        self.assertIn(self.names('auth0|reader'), (['replica_0'], ['replica_1']))
+
+        self.router.read_your_writes, saved = 0, self.router.read_your_writes
+        try:
+            self.router.clock, clock = (lambda: clock() + 60), self.router.clock
+            self.assertIn(self.names('auth0|writer'), (['replica_0'], ['replica_1']))
+        finally:
+            self.router.clock = clock
+            self.router.read_your_writes = saved
+
+    # test that a replica that is down is skipped, and the primary used without any
+    def test_unhealthy_replicas(self):
+        missing = 'sqlite:///' + os.path.join(self.directory.name, 'missing', 'replica.db')
+        setup_db(self.app, os.environ['DATABASE_TEST_URL'],
+                 replica_paths=[self.replica_paths[0], missing])
+        self.assertEqual([self.names() for _ in range(3)], [['replica_0']] * 3)
+        self.assertEqual(self.router.healthy_count(), 1)
+
+        setup_db(self.app, os.environ['DATABASE_TEST_URL'], replica_paths=[missing])
+        fallbacks = self.router.fallbacks.value
+        self.assertEqual(self.names(), ['primary'])
+        self.assertEqual(self.router.fallbacks.value, fallbacks + 1)
+
+
+class idempotencyTestCase(localAuthTestCase):
+    """This class represents the Idempotency-Key test case"""
+
+    def setUp(self):
+        super().setUp()
+        self.saved_store = idempotency.store
+        idempotency.store = self.make_store()
+
+    def tearDown(self):
+        idempotency.store = self.saved_store
+        super().tearDown()
+
+    def make_store(self):
+        return idempotency.TableStore()
+
+    def post_actor(self, key=None, name='actor_1', subject='auth0|local'):
+        headers = {'Authorization': 'Bearer {}'.format(
+            make_token(['post:actors'], subject=subject))}
+        if key is not None:
+            headers['Idempotency-Key'] = key
+        return self.client().post('/actors', headers=headers, json={
+            'name': name, 'age': 30, 'gender': 'male'})
+
+    def count_actors(self):
+        with self.app.app_context():
+            return Actor.query.count()
+
+    # test that a retry replays the stored response without a second insert
+    def test_replay(self):
+        first = self.post_actor('key-1')
+        second = self.post_actor('key-1')
+        self.assertEqual(first.status_code, 200)
+        self.assertEqual(second.status_code, 200)
+        self.assertEqual(second.data, first.data)
+        self.assertEqual(second.headers['Idempotent-Replayed'], 'true')
+        self.assertNotIn('Idempotent-Replayed', first.headers)
+        self.assertEqual(self.count_actors(), 1)
+
+    # test that requests without a key, or with other keys, all run
+    def test_distinct_requests_run(self):
+        self.post_actor()
+        self.post_actor()
+        self.post_actor('key-1')
+        self.post_actor('key-2')
+        # keys are scoped to the client
+        self.post_actor('key-1', subject='auth0|other')
+        self.assertEqual(self.count_actors(), 5)
+
+    # test that a key reused with another body is refused
+    def test_key_reused_with_other_body(self):
+        self.post_actor('key-1')
+        response = self.post_actor('key-1', name='actor_2')
+        self.assertEqual(response.status_code, 422)
+        self.assertEqual(self.count_actors(), 1)
+
+    # test that a failed request frees its key for the retry
+    def test_failure_is_not_stored(self):
+        headers = self.headers('post:movies')
+        headers['Idempotency-Key'] = 'key-1'
+        response = self.client().post('/movies', headers=headers,
+                                      json={'title': 'movie_1', 'release_date': 'soon'})
+        self.assertEqual(response.status_code, 422)
+        response = self.client().post('/movies', headers=headers,
+                                      json={'title': 'movie_1', 'release_date': 'soon'})
+        self.assertEqual(response.status_code, 422)
+        self.assertNotIn('Idempotent-Replayed', response.headers)
+
+    # test that concurrent duplicates are serialized and run once
+    def test_concurrent_duplicates(self):
+        insert = Actor.insert
+
+        def slow_insert(actor):
+            time.sleep(0.2)
+            insert(actor)
+
+        responses = []
+        with unittest.mock.patch.object(Actor, 'insert', slow_insert):
+            threads = [threading.Thread(target=lambda: responses.append(self.post_actor('key-1')))
+                       for _ in range(3)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual([response.status_code for response in responses], [200] * 3)
+        self.assertEqual(sum('Idempotent-Replayed' in response.headers
+                             for response in responses), 2)
+        self.assertEqual(self.count_actors(), 1)
+
+    # test that a duplicate of a hanging request of this worker is refused in time
+    def test_key_held_by_hanging_request(self):
+        started = threading.Event()
+        release = threading.Event()
+        insert = Actor.insert
+
+        def hanging_insert(actor):
+            started.set()
+            release.wait(10)
+            insert(actor)
+
+        responses = []
+        with unittest.mock.patch.object(Actor, 'insert', hanging_insert):
+            thread = threading.Thread(target=lambda: responses.append(self.post_actor('key-1')))
+            thread.start()
+            self.assertTrue(started.wait(5))
+            start = time.monotonic()
+            with unittest.mock.patch.object(idempotency, 'IDEMPOTENCY_WAIT', 0.2):
+                response = self.post_actor('key-1')
+            waited = time.monotonic() - start
+            release.set()
+            thread.join()
+        self.assertEqual(response.status_code, 409)
+        self.assertLess(waited, 5)
+        self.assertEqual(responses[0].status_code, 200)
+        self.assertEqual(self.count_actors(), 1)
+
+    # test that a key held by another worker is waited for, then refused
+    def test_key_held_elsewhere(self):
+        with self.app.test_request_context('/actors', method='POST', json={
+                'name': 'actor_1', 'age': 30, 'gender': 'male'}):
+            flask.g.current_user = {'sub': 'auth0|local'}
+            key = idempotency.scoped_key('key-1')
+            fingerprint = hashlib.sha256(flask.request.get_data()).hexdigest()
+            idempotency.store.claim(key, fingerprint,
+                                    datetime.datetime.utcnow() + datetime.timedelta(seconds=30))
+
+        with unittest.mock.patch.object(idempotency, 'IDEMPOTENCY_WAIT', 0.2):
+            response = self.post_actor('key-1')
+        self.assertEqual(response.status_code, 409)
+        self.assertEqual(self.count_actors(), 0)
+
+    # test that an expired key runs again
+    def test_expired_key(self):
+        with unittest.mock.patch.object(idempotency, 'IDEMPOTENCY_TTL', -1):
+            self.post_actor('key-1')
+        response = self.post_actor('key-1')
+        self.assertNotIn('Idempotent-Replayed', response.headers)
+        self.assertEqual(self.count_actors(), 2)
+
+
+class memoryIdempotencyTestCase(idempotencyTestCase):
+    """This class runs the Idempotency-Key test case with the in-memory store"""
+
+    def make_store(self):
+        return idempotency.MemoryStore()
+
+
+class rateLimitTestCase(localAuthTestCase):
+    """This class represents the per-subject rate limit test case"""
+
+    def setUp(self):
+        super().setUp()
+        self.now = 1000.0
+        self.saved_limiter = auth.limiter
+        auth.limiter = self.make_limiter(ratelimit.MemoryStore())
+        Actor(name='actor_1', age=22, gender='male').insert()
+
+    def tearDown(self):
+        auth.limiter = self.saved_limiter
+        super().tearDown()
+
+    def make_limiter(self, store, **options):
+        options = dict({'rate': 1, 'burst': 2, 'permission_limits': {},
+                        'concurrency': 0}, **options)
+        return ratelimit.RateLimiter(store, clock=lambda: self.now, **options)
+
+    def get_actors(self, subject='auth0|local'):
+        return self.client().get('/actors', headers={'Authorization': 'Bearer {}'.format(
+            make_token(['get:actors', 'post:actors'], subject=subject))})
+
+    # test that a subject over its burst gets 429 until its bucket refills
+    def test_burst_then_limited(self):
+        self.assertEqual([self.get_actors().status_code for _ in range(3)], [200, 200, 429])
+        response = self.get_actors()
+        self.assertEqual(json.loads(response.data)['code'], 'rate_limited')
+        self.assertEqual(response.headers['Retry-After'], '1')
+        self.now += 1
+        self.assertEqual(self.get_actors().status_code, 200)
+        self.assertEqual(self.get_actors().status_code, 429)
+
+    # test that the limits of one subject do not affect another
+    def test_subjects_are_independent(self):
+        for _ in range(3):
+            self.get_actors()
+        self.assertEqual(self.get_actors('auth0|other').status_code, 200)
+
+    # test that the limit of a permission only applies to its endpoints
+    def test_permission_limits(self):
+        auth.limiter = self.make_limiter(
+            ratelimit.MemoryStore(), rate=0,
+            permission_limits=ratelimit.parse_permission_limits('post:actors=0.5/1'))
+        headers = self.headers('post:actors')
+        body = {'name': 'actor_2', 'age': 30, 'gender': 'male'}
+        self.assertEqual(self.client().post('/actors', headers=headers, json=body).status_code, 200)
+        response = self.client().post('/actors', headers=headers, json=body)
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response.headers['Retry-After'], '2')
+        self.assertEqual([self.get_actors().status_code for _ in range(5)], [200] * 5)
+
+    # test that a subject cannot run more than the cap of requests at once
+    def test_concurrency_cap(self):
+        auth.limiter = self.make_limiter(ratelimit.MemoryStore(), rate=0, concurrency=1)
+        started, release = threading.Event(), threading.Event()
+        insert = Actor.insert
+
+        def blocking_insert(actor):
+            started.set()
+            release.wait(5)
+            insert(actor)
+
+        responses = []
+        with unittest.mock.patch.object(Actor, 'insert', blocking_insert):
+            thread = threading.Thread(target=lambda: responses.append(self.client().post(
+                '/actors', headers=self.headers('post:actors'),
+                json={'name': 'actor_2', 'age': 30, 'gender': 'male'})))
+            thread.start()
+            started.wait(5)
+            response = self.get_actors()
+            release.set()
+            thread.join()
+
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(json.loads(response.data)['code'], 'too_many_in_flight')
+        self.assertEqual(responses[0].status_code, 200)
+        self.assertEqual(self.get_actors().status_code, 200)
+
+    # test that an export counts as in flight until its body is sent
+    def test_export_in_flight_until_sent(self):
+        auth.limiter = self.make_limiter(ratelimit.MemoryStore(), rate=0, concurrency=1)
+        started, release = threading.Event(), threading.Event()
+        export_rows = queries.export_rows
+
+        def blocking_export_rows(*args, **kwargs):
+            started.set()
+            release.wait(5)
+            yield from export_rows(*args, **kwargs)
+
+        def export():
+            with self.client().get('/actors/export', headers=headers) as response:
+                responses.append((response.status_code, response.data))
+
+        headers = self.headers('get:actors')
+        responses = []
+        with unittest.mock.patch('app.export_rows', blocking_export_rows):
+            thread = threading.Thread(target=export)
+            thread.start()
+            started.wait(5)
+            response = self.client().get('/actors/export', headers=headers)
+            release.set()
+            thread.join()
+
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(json.loads(response.data)['code'], 'too_many_in_flight')
+        self.assertEqual(responses[0][0], 200)
+        self.assertEqual(json.loads(responses[0][1])['actors'][0]['name'], 'actor_1')
+        self.assertEqual(self.client().get('/actors/export', headers=headers).status_code, 200)
+
+    # test that the memory store keeps at most maxsize buckets, dropping the least recently used
+    def test_memory_store_bound(self):
+        store = ratelimit.MemoryStore(maxsize=2)
+        for key in ('a', 'b', 'a', 'c'):
+            self.assertEqual(store.take([(key, 1, 2)], self.now), 0.0)
+            self.now += 0.1
+        self.assertEqual(list(store._buckets), ['a', 'c'])
+        # the active buckets keep their state
+        self.assertGreater(store.take([('a', 1, 2)], self.now), 0)
+        for key in range(100):
+            store.take([(key, 1, 1)], self.now)
+        self.assertEqual(len(store._buckets), 2)
+
+    # test that workers sharing a store share the buckets of a subject
+    def test_shared_store(self):
+        client = ratelimit.FakeSharedClient()
+        workers = [self.make_limiter(ratelimit.SharedStore(client), concurrency=1)
+                   for _ in range(2)]
+        required = frozenset(['get:actors'])
+        workers[0].check('auth0|local', required)
+        workers[1].check('auth0|local', required)
+        with self.assertRaises(ratelimit.RateLimitError) as raised:
+            workers[0].check('auth0|local', required)
+        self.assertEqual(raised.exception.retry_after, 1)
+        self.now += 1
+        workers[1].check('auth0|local', required)
+
+        with workers[0].in_flight('auth0|local'):
+            with self.assertRaises(ratelimit.RateLimitError):
+                with workers[1].in_flight('auth0|local'):
+                    pass
+        self.assertEqual(int(client.store['capstone:limit:flight:auth0|local']), 0)
+
+    # test that malformed permission limits are refused
+    def test_parse_permission_limits(self):
+        self.assertEqual(ratelimit.parse_permission_limits('post:actors=1/5, get:movies=10'),
+                         {'post:actors': (1.0, 5.0), 'get:movies': (10.0, 10.0)})
+        for value in ('post:actors', 'post:actors=0/5', '=1/5', 'post:actors=1/0.5'):
+            with self.assertRaises(ValueError):
+                ratelimit.parse_permission_limits(value)
+
+
+class encodingTestCase(localAuthTestCase):
+    """This class represents the response encoding and compression test case"""
+
+    def setUp(self):
+        super().setUp()
+        Actor(name='actor_1', age=22, gender='male').insert()
+        Actor(name='actor_2', age=45, gender='female').insert()
+        Movie(title='movie_1', release_date='2022-1-1').insert()
+
+    def get(self, url, **headers):
+        headers.update(self.headers('get:actors', 'get:movies'))
+        return self.client().get(url, headers=headers)
+
+    # test that the list bodies are compact json
+    def test_compact_json(self):
+        response = self.get('/actors')
+        self.assertNotIn(b': ', response.data)
+        self.assertNotIn(b', ', response.data)
+        self.assertEqual(json.loads(response.data)['actors'][0],
+                         {'id': 1, 'name': 'actor_1', 'age': 22, 'gender': 'male'})
+
+    # test the columnar shape of the lists
+    def test_columnar_shape(self):
+        data = json.loads(self.get('/actors?shape=columnar&fields=name').data)
+        self.assertEqual(data['actors'], {
+            'columns': ['id', 'name'],
+            'rows': [[1, 'actor_1'], [2, 'actor_2']]
+        })
+        data = json.loads(self.get('/movies?shape=columnar').data)
+        self.assertEqual(data['movies']['rows'], [[1, 'movie_1', '2022-01-01']])
+
+    # test that the included rows are one more column
+    def test_columnar_include(self):
+        self.client().post('/movies/1/actors', json={'actor_ids': [1]},
+            headers=self.headers('patch:movies'))
+        data = json.loads(self.get('/movies?shape=columnar&include=cast').data)
+        self.assertEqual(data['movies']['columns'], ['id', 'title', 'release_date', 'cast'])
+        self.assertEqual(data['movies']['rows'][0][3],
+                         [{'id': 1, 'name': 'actor_1', 'age': 22, 'gender': 'male'}])
+
+    # test that an unknown shape is a bad request
+    def test_unknown_shape(self):
+        self.assertEqual(self.get('/actors?shape=rows').status_code, 400)
+
+    # test that small bodies are sent uncompressed
+    def test_small_body_not_compressed(self):
+        response = self.get('/actors', **{'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', response.headers)
+        self.assertIn('Accept-Encoding', response.headers['Vary'])
+
+    # test the negotiation of the content coding above the threshold
+    def test_compression(self):
+        with unittest.mock.patch.object(encoding, 'COMPRESS_MIN_SIZE', 0):
+            response = self.get('/actors', **{'Accept-Encoding': 'gzip'})
+            self.assertEqual(response.headers['Content-Encoding'], 'gzip')
+            self.assertEqual(json.loads(gzip.decompress(response.data))['actors'][0]['id'], 1)
+            self.assertIn('Accept-Encoding', response.headers['Vary'])
+
+            response = self.get('/actors', **{'Accept-Encoding': 'gzip;q=0, identity'})
+            self.assertNotIn('Content-Encoding', response.headers)
+            self.assertEqual(json.loads(response.data)['actors'][0]['id'], 1)
+
+            if encoding.brotli is not None:
+                response = self.get('/actors', **{'Accept-Encoding': 'gzip, br'})
+                self.assertEqual(response.headers['Content-Encoding'], 'br')
+                self.assertEqual(json.loads(encoding.brotli.decompress(response.data))
+                                 ['actors'][0]['id'], 1)
+
+    # test that a cached body is compressed per request
+    def test_cached_body_compressed_per_request(self):
+        with unittest.mock.patch.object(encoding, 'COMPRESS_MIN_SIZE', 0):
+            plain = self.get('/actors')
+            compressed = self.get('/actors', **{'Accept-Encoding': 'gzip'})
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertEqual(gzip.decompress(compressed.data), plain.data)
+
+    # test the parsing of Accept-Encoding
+    def test_choose_encoding(self):
+        self.assertEqual(encoding.choose_encoding('gzip, deflate'), 'gzip')
+        self.assertEqual(encoding.choose_encoding('deflate'), None)
+        self.assertEqual(encoding.choose_encoding(None), None)
+        self.assertEqual(encoding.choose_encoding('*;q=0'), None)
+        with unittest.mock.patch.object(encoding, 'brotli', None):
+            self.assertEqual(encoding.choose_encoding('br, gzip;q=0.5'), 'gzip')
+        with unittest.mock.patch.object(encoding, 'brotli', object()):
+            # the highest q wins, br only breaks a tie
+            self.assertEqual(encoding.choose_encoding('br;q=0.1, gzip;q=1.0'), 'gzip')
+            self.assertEqual(encoding.choose_encoding('br;q=0.5, *;q=0.8'), 'gzip')
+            self.assertEqual(encoding.choose_encoding('gzip, br'), 'br')
+            self.assertEqual(encoding.choose_encoding('br;q=0.2, gzip;q=0'), 'br')
+
+    # test that both encoders write the same json
+    def test_encoders_agree(self):
+        body = {'success': True, 'actors': [{'id': 1, 'name': 'Zoë'}], 'next_cursor': None}
+        encoded = json.dumps(body, ensure_ascii=False, separators=(',', ':')).encode()
+        self.assertEqual(encoding.dumps(body), encoded)
+
+
+class asgiMode:
+    """Runs the tests of a route test case through the ASGI entry point"""
+
+    def setUp(self):
+        super().setUp()
+        asgi_app = asgi.AsgiApp(self.app, os.environ['DATABASE_TEST_URL'])
+        self.client = lambda: AsgiClient(asgi_app)
+
+
+skip_asgi = unittest.skipIf(asgi is None, 'needs the packages of requirements-asgi.txt')
+
+@skip_asgi
+class asgiPaginationTestCase(asgiMode, paginationTestCase):
+    pass
+
+@skip_asgi
+class asgiExportTestCase(asgiMode, exportTestCase):
+    pass
+
+@skip_asgi
+class asgiProjectionTestCase(asgiMode, projectionTestCase):
+    pass
+
+@skip_asgi
+class asgiConditionalGetTestCase(asgiMode, conditionalGetTestCase):
+    pass
+
+@skip_asgi
+class asgiResponseCacheTestCase(asgiMode, responseCacheTestCase):
+    pass
+
+@skip_asgi
+class asgiBulkCreateTestCase(asgiMode, bulkCreateTestCase):
+    pass
+
+@skip_asgi
+class asgiBulkEditDeleteTestCase(asgiMode, bulkEditDeleteTestCase):
+    pass
+
+@skip_asgi
+class asgiCastTestCase(asgiMode, castTestCase):
+    pass
+
+@skip_asgi
+class asgiFilterTestCase(asgiMode, filterTestCase):
+    pass
+
+@skip_asgi
+class asgiReleaseDateTestCase(asgiMode, releaseDateTestCase):
+    pass
+
+@skip_asgi
+class asgiSearchTestCase(asgiMode, searchTestCase):
+    pass
+
+@skip_asgi
+class asgiTimingTestCase(asgiMode, timingTestCase):
+    pass
+
+@skip_asgi
+class asgiQueryDiagnosticsTestCase(asgiMode, queryDiagnosticsTestCase):
+    pass
+
+@skip_asgi
+class asgiReplicaTestCase(asgiMode, replicaTestCase):
+    pass
+
+@skip_asgi
+class asgiIdempotencyTestCase(asgiMode, idempotencyTestCase):
+    pass
+
+@skip_asgi
+class asgiRateLimitTestCase(asgiMode, rateLimitTestCase):
+    pass
+
+@skip_asgi
+class asgiEncodingTestCase(asgiMode, encodingTestCase):
+    pass
+
+
 # Make the tests conveniently executable
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,176 @@
+import os
+import time
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from flask import g, has_request_context, request
+
+from metrics import Histogram, registry
+
+# send the phase breakdown to clients in a Server-Timing header
+SERVER_TIMING = os.environ.get('SERVER_TIMING', 'true').lower() == 'true'
+
+# buckets of the statements-per-request histogram
+STATEMENT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+'''
+RequestTimer
+    the time spent in each phase of one request
+    - auth: token verification and permission checks (requires_auth)
+    - db: SQL statements, measured by the engine events in models.py
+    - serialize: building the json of the response
+    the time not spent in any of them is reported as app
+'''
+class RequestTimer:
+    def __init__(self, route=None, method=None):
+        self.start = time.perf_counter()
+        self.route = route
+        self.method = method
+        self.phases = {'auth': 0.0, 'db': 0.0, 'serialize': 0.0}
+        self.statements = 0
+
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def breakdown(self):
+        total = time.perf_counter() - self.start
+        phases = dict(self.phases)
+        phases['app'] = max(total - sum(phases.values()), 0.0)
+        return phases, total
+
+'''
+native_timer
+    the timer of the request served outside of flask by the current
+    task, the native path of asgi.py, with its route and method
+'''
+native_timer = ContextVar('native_timer', default=None)
+
+'''
+current_timer()
+    return the timer of the request being handled, or None outside of
+    a request or before setup_timing() started one
+'''
+def current_timer():
+    if not has_request_context():
+        return native_timer.get()
+    return g.get('request_timer')
+
+'''
+phase(name)
+    a context manager adding the time spent in its block to a phase
+    of the current request
+    EXAMPLE
+        with phase('serialize'):
+            response = jsonify(body)
+'''
+@contextmanager
+def phase(name):
+    timer = current_timer()
+    if timer is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timer.add(name, time.perf_counter() - start)
+
+'''
+record_statement(seconds)
+    count one SQL statement and its duration in the current request
+'''
+def record_statement(seconds):
+    timer = current_timer()
+    if timer is not None:
+        timer.statements += 1
+        timer.add('db', seconds)
+
+
+'''
+RouteHistograms
+    histograms keyed by labels, created on first use, i.e. one per
+    (route, method)
+'''
+class RouteHistograms:
+    def __init__(self, buckets=Histogram.DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def observe(self, labels, value):
+        key = tuple(sorted(labels.items()))
+        histogram = self._histograms.get(key)
+        if histogram is None:
+            with self._lock:
+                histogram = self._histograms.setdefault(key, Histogram(self.buckets))
+        histogram.observe(value)
+
+    def samples(self):
+        return [(dict(key), histogram)
+                for key, histogram in sorted(self._histograms.items())]
+
+
+request_duration = RouteHistograms()
+phase_duration = RouteHistograms()
+request_statements = RouteHistograms(STATEMENT_BUCKETS)
+
+registry.histogram('http_request_duration_seconds',
+                   'Time spent handling requests, per route.',
+                   request_duration.samples)
+registry.histogram('http_request_phase_seconds',
+                   'Time spent in each phase of the requests, per route.',
+                   phase_duration.samples)
+registry.histogram('http_request_sql_statements',
+                   'SQL statements executed per request, per route.',
+                   request_statements.samples)
+
+'''
+finish_timer(timer, route, method)
+    observe the per-route histograms of a finished request
+    return the value of its Server-Timing header, or None when
+    SERVER_TIMING is off
+'''
+def finish_timer(timer, route, method):
+    phases, total = timer.breakdown()
+    labels = {'route': route, 'method': method}
+    request_duration.observe(labels, total)
+    request_statements.observe(labels, timer.statements)
+    for name, seconds in phases.items():
+        phase_duration.observe(dict(labels, phase=name), seconds)
+
+    if not SERVER_TIMING:
+        return None
+    entries = []
+    for name, seconds in phases.items():
+        entry = '{};dur={:.2f}'.format(name, seconds * 1000)
+        if name == 'db':
+            entry += ';desc="{} queries"'.format(timer.statements)
+        entries.append(entry)
+    entries.append('total;dur={:.2f}'.format(total * 1000))
+    return ', '.join(entries)
+
+'''
+setup_timing(app)
+    time every request of app: start a RequestTimer before the request,
+    then observe the per-route histograms and add the Server-Timing
+    header to the response
+    routes are labelled with their url rule, i.e. /actors/<id>, so the
+    number of histograms stays bounded
+'''
+def setup_timing(app):
+    @app.before_request
+    def start_request_timer():
+        g.request_timer = RequestTimer()
+
+    @app.after_request
+    def finish_request_timer(response):
+        timer = g.pop('request_timer', None)
+        if timer is None:
+            return response
+        server_timing = finish_timer(
+            timer, request.url_rule.rule if request.url_rule else 'unmatched',
+            request.method)
+        if server_timing is not None:
+            response.headers['Server-Timing'] = server_timing
+        return response